@@ -4,36 +4,111 @@
 # @Author  : Lewis Tian (taseikyo@gmail.com)
 # @Link    : github.com/taseikyo
 
-import io
-import json
 import os
 import subprocess
 import sys
+import threading
 import time
-from collections import namedtuple
-from urllib.request import urlopen
-
-from PyQt6.QtCore import QDir, QMutex, Qt, QThread, pyqtSignal
-from PyQt6.QtGui import QCursor, QIcon, QPixmap
+from collections import OrderedDict, defaultdict, namedtuple
+
+from PyQt6.QtCore import (
+    QAbstractTableModel,
+    QBuffer,
+    QDir,
+    QModelIndex,
+    QSize,
+    Qt,
+    QThread,
+    QTimer,
+    pyqtSignal,
+)
+from PyQt6.QtGui import QCursor, QIcon, QImage, QPixmap
 from PyQt6.QtWidgets import (
+    QAbstractItemView,
     QApplication,
+    QComboBox,
     QFileDialog,
     QHBoxLayout,
+    QHeaderView,
     QLabel,
     QLineEdit,
     QMessageBox,
     QProgressBar,
     QPushButton,
     QStatusBar,
+    QStyle,
+    QStyledItemDelegate,
+    QStyleOptionProgressBar,
+    QTableView,
     QVBoxLayout,
     QWidget,
 )
 
+from bilifav import MAX_JOBS, Batch, Sync
+from bilifav.api import (
+    api,
+    expand_favorites,
+    fetch_favorites,
+    iter_pages,
+    parse_space_id,
+    split_favorites,
+)
+from bilifav.cache import cache
+from bilifav.ordering import DEFAULT_ORDER
+from bilifav.processes import reaper
+from bilifav.progress import describe, format_eta, format_size
+from bilifav.ratelimit import limiter, parse_rate
+from bilifav.store import ContentStore, default_store_path
+from bilifav.sync import expand_parts
+
 WorkerRespnose = namedtuple(
-    "WorkerRespnose", "thumb_img title author medias media_counts publish_date"
+    "WorkerRespnose", "thumb_img title author listings media_counts publish_date"
 )
 
-DownloadCountsMutex = QMutex()
+# size of the thumbnail label
+THUMB_SIZE = (250, 141)
+# size of the covers in the media list
+ROW_THUMB_SIZE = (64, 36)
+# rows added to the media list at a time, as it is scrolled down
+FETCH_CHUNK = 100
+# covers of the media list kept in memory
+MAX_THUMBS = 500
+# milliseconds between two refreshes of the media list while downloading
+REFRESH_INTERVAL = 250
+
+# orders of the downloads, as shown in the order box
+ORDER_LABELS = {
+    "listing": "Listing order",
+    "shortest": "Shortest first",
+    "largest": "Largest first",
+    "newest": "Newest first",
+}
+
+# status of the videos in the media list
+DOWNLOADING = "Downloading"
+DOWNLOADED = "Downloaded"
+FAILED = "Failed"
+RETRYING = "Retrying"
+
+
+def fetch_thumbnail(url, size=THUMB_SIZE):
+    """fetch a cover image, return it scaled to `size`"""
+    key = url if size == THUMB_SIZE else f"{url}@{size[0]}x{size[1]}"
+    image = QImage()
+    data = cache.get(key)
+    if data is not None and image.loadFromData(data):
+        return image
+    image.loadFromData(api.get(url))
+    image = image.scaled(
+        *size,
+        Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.SmoothTransformation,
+    )
+    buffer = QBuffer()
+    buffer.open(QBuffer.OpenModeFlag.WriteOnly)
+    image.save(buffer, "JPG", 90)
+    cache.put(key, bytes(buffer.data()))
+    return image
 
 
 # seperate worker thread for background processing and to avoid UI freez
@@ -42,33 +117,37 @@ class WorkerThread(QThread):
     worker_response = pyqtSignal(WorkerRespnose)
     # setup error signal
     worker_err_response = pyqtSignal()
-    # additional parameter as url
+    # additional parameter as favorite ids or urls
 
-    def __init__(self, media_id):
+    def __init__(self, favorites):
         # invoke the __init__ of super as well
         super(WorkerThread, self).__init__()
-        self.media_id = media_id
+        self.favorites = favorites
 
     def run(self):
-        url = (
-            f"https://api.bilibili.com/medialist/gateway/base/spaceDetail?media_id={self.media_id}&"
-            "pn=1&ps=20&keyword=&order=mtime&type=0&tid=0&jsonp=jsonp"
-        )
         try:
-            data = json.loads(urlopen(url).read())
-            # load thumbnail image
-            pixmap = QPixmap()
-            pixmap.loadFromData(urlopen(str(data["data"]["info"]["cover"])).read())
+            # a space url stands for all the favorites of a user
+            listings = fetch_favorites(expand_favorites(self.favorites))
+            infos = [data["info"] for data in listings.values()]
+            # show the details of the first favorite
+            info = infos[0]
+            title = info["title"]
+            if len(infos) > 1:
+                title = f"{len(infos)} favorites: " + ", ".join(
+                    i["title"] for i in infos
+                )
+            # load thumbnail image, QPixmap is not safe outside the GUI thread
+            image = fetch_thumbnail(str(info["cover"]))
             # emitting the response signal
             #
             self.worker_response.emit(
                 WorkerRespnose(
-                    pixmap,
-                    data["data"]["info"]["title"],
-                    data["data"]["info"]["upper"]["name"],
-                    data["data"]["medias"],
-                    data["data"]["info"]["media_count"],
-                    data["data"]["info"]["ctime"],
+                    image,
+                    title,
+                    info["upper"]["name"],
+                    listings,
+                    sum(i["media_count"] for i in infos),
+                    info["ctime"],
                 )
             )
         except Exception as e:
@@ -77,235 +156,406 @@ class WorkerThread(QThread):
             self.worker_err_response.emit()
 
 
-class _BufferedReaderForFFmpeg(io.BufferedReader):
-    """Method `newline` overriden to *also* treat `\\r` as a line break."""
+# lists the remaining pages of the favorites for the media list
+class ListingThread(QThread):
+    # setup page signal, the favorite and the medias of a page with a row
+    # per part
+    page_listed = pyqtSignal(object, list)
 
-    def readline(self, size=-1):
-        if hasattr(self, "peek"):
+    def __init__(self, listings, parent=None):
+        super(ListingThread, self).__init__(parent)
+        self.listings = listings
 
-            def nreadahead():
-                readahead = self.peek(1)
-                if not readahead:
-                    return 1
-                n = (
-                    (readahead.find(b"\r") + 1)
-                    or (readahead.find(b"\n") + 1)
-                    or len(readahead)
-                )
-                if size >= 0:
-                    n = min(n, size)
-                return n
+    def run(self):
+        for media_id, data in self.listings.items():
+            try:
+                for medias in iter_pages(
+                    media_id, data["info"]["media_count"], data["medias"] or []
+                ):
+                    if self.isInterruptionRequested():
+                        return
+                    self.page_listed.emit(
+                        media_id,
+                        [part for media in medias for part in expand_parts(media)],
+                    )
+            except Exception as e:
+                print(e)
 
-        else:
 
-            def nreadahead():
-                return 1
+# loads the covers of the media list, the last requested first
+class ThumbnailThread(QThread):
+    # setup thumbnail signal with the cover url
+    thumbnail_loaded = pyqtSignal(str, QImage)
+    # setup dropped signal with the url of a cover not loaded, dropped from
+    # the queue or failed, so that it is requested again
+    thumbnail_dropped = pyqtSignal(str)
 
-        if size is None:
-            size = -1
-        else:
+    def __init__(self):
+        super(ThumbnailThread, self).__init__()
+        self.lock = threading.Lock()
+        self.has_urls = threading.Condition(self.lock)
+        self.urls = []
+
+    def request(self, url):
+        with self.lock:
+            self.urls.append(url)
+            # rows scrolled past long ago are not worth loading anymore
+            dropped = self.urls[:-FETCH_CHUNK]
+            del self.urls[:-FETCH_CHUNK]
+            self.has_urls.notify()
+        for old in dropped:
+            self.thumbnail_dropped.emit(old)
+
+    def forget(self):
+        with self.lock:
+            self.urls.clear()
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            with self.lock:
+                if not self.urls:
+                    self.has_urls.wait(1)
+                    continue
+                url = self.urls.pop()
             try:
-                size_index = size.__index__
-            except AttributeError:
-                raise TypeError(f"{size!r} is not an integer")
-            else:
-                size = size_index()
-        res = bytearray()
-        while size < 0 or len(res) < size:
-            b = self.read(nreadahead())
-            if not b:
-                break
-            res += b
-            if os.linesep == "\r\n":
-                # Windows
-                if res.endswith(b"\r"):
-                    if self.peek(1).startswith(b"\n"):
-                        # \r\n encountered
-                        res += self.read(1)
-                    break
-            else:
-                # Unix
-                if res.endswith(b"\r") or res.endswith(b"\n"):
-                    break
-        return bytes(res)
+                self.thumbnail_loaded.emit(url, fetch_thumbnail(url, ROW_THUMB_SIZE))
+            except Exception as e:
+                print(e)
+                self.thumbnail_dropped.emit(url)
+
+
+class MediaModel(QAbstractTableModel):
+    """
+    Videos of the favorites, a row per video or part
+
+    Listed medias are kept aside and turned into rows `FETCH_CHUNK` at a
+    time as the view scrolls down (`canFetchMore`/`fetchMore`). Covers are
+    only loaded for the rows the view paints. The download threads only
+    record the status of the videos with `set_status`, `refresh` applies
+    it from the GUI thread along with the progress of the running videos,
+    in one `dataChanged` per refresh
+    """
+
+    COLUMNS = ("Title", "Duration", "Size", "Status", "Progress")
+    TITLE, DURATION, SIZE, STATUS, PROGRESS = range(len(COLUMNS))
+
+    def __init__(self):
+        super(MediaModel, self).__init__()
+        # (media id, media) of each row
+        self.rows = []
+        # medias listed but not in the rows yet
+        self.pending = []
+        # (media id, bvid) -> row, a video saved in several favorites has a
+        # row in each of them
+        self.row_of = {}
+        # cover url -> rows
+        self.cover_rows = defaultdict(list)
+        # (media id, bvid) -> status, and (media id, bvid) -> (bytes done,
+        # bytes total, percent)
+        self.status = {}
+        self.progress = {}
+        # cover url -> QPixmap, the least recently loaded first
+        self.thumbs = OrderedDict()
+        self.requested = set()
+        # (media id, bvid) -> status set by the download threads, not applied
+        # yet
+        self.lock = threading.Lock()
+        self.changes = {}
+        self.loader = ThumbnailThread()
+        self.loader.thumbnail_loaded.connect(self.thumbnail_slot)
+        self.loader.thumbnail_dropped.connect(self.dropped_slot)
+        self.loader.start()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if (
+            orientation == Qt.Orientation.Horizontal
+            and role == Qt.ItemDataRole.DisplayRole
+        ):
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        media_id, media = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.display((media_id, media["bvid"]), media, column)
+        if role == Qt.ItemDataRole.ToolTipRole and column == self.TITLE:
+            return media.get("title")
+        if role == Qt.ItemDataRole.DecorationRole and column == self.TITLE:
+            return self.thumbnail(media.get("cover"))
+        return None
+
+    def display(self, key, media, column):
+        if column == self.TITLE:
+            return media.get("title")
+        if column == self.DURATION:
+            return format_eta(media.get("duration"))
+        if column == self.SIZE:
+            total = self.progress.get(key, (0, 0, 0))[1]
+            return format_size(total) if total else ""
+        if column == self.STATUS:
+            return self.status.get(key, "")
+        if column == self.PROGRESS:
+            if key in self.progress:
+                return int(self.progress[key][2])
+            return 100 if self.status.get(key) == DOWNLOADED else None
+        return None
+
+    def thumbnail(self, url):
+        """the cover of `url`, loaded in the background the first time"""
+        if not url:
+            return None
+        pixmap = self.thumbs.get(url)
+        if pixmap is None and url not in self.requested:
+            self.requested.add(url)
+            self.loader.request(url)
+        return pixmap
+
+    def thumbnail_slot(self, url, image):
+        if url not in self.cover_rows:
+            # loaded for a list that was cleared since
+            return
+        self.thumbs[url] = QPixmap.fromImage(image)
+        if len(self.thumbs) > MAX_THUMBS:
+            old, _ = self.thumbs.popitem(last=False)
+            # loaded again when its rows are painted again
+            self.requested.discard(old)
+        rows = self.cover_rows[url]
+        self.dataChanged.emit(
+            self.index(min(rows), self.TITLE),
+            self.index(max(rows), self.TITLE),
+            [Qt.ItemDataRole.DecorationRole],
+        )
+
+    def dropped_slot(self, url):
+        # requested again when its rows are painted again
+        self.requested.discard(url)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and bool(self.pending)
+
+    def fetchMore(self, parent=QModelIndex()):
+        count = min(FETCH_CHUNK, len(self.pending))
+        if parent.isValid() or not count:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + count - 1)
+        for row, (media_id, media) in enumerate(self.pending[:count], first):
+            self.row_of[media_id, media["bvid"]] = row
+            self.cover_rows[media.get("cover")].append(row)
+            self.rows.append((media_id, media))
+        del self.pending[:count]
+        self.endInsertRows()
+
+    def add_medias(self, media_id, medias):
+        self.pending.extend((media_id, media) for media in medias)
+        # the view only asks for more rows once scrolled to the bottom
+        if len(self.rows) < FETCH_CHUNK:
+            self.fetchMore()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.pending = []
+        self.row_of = {}
+        self.cover_rows = defaultdict(list)
+        self.thumbs.clear()
+        self.requested = set()
+        self.loader.forget()
+        self.endResetModel()
+        self.reset_status()
+
+    def reset_status(self):
+        with self.lock:
+            self.changes = {}
+        self.status = {}
+        self.progress = {}
+        if self.rows:
+            self.dataChanged.emit(
+                self.index(0, self.SIZE),
+                self.index(len(self.rows) - 1, self.PROGRESS),
+            )
+
+    def set_status(self, media_id, bvid, status):
+        """record the status of a video of a favorite, from any thread"""
+        with self.lock:
+            self.changes[media_id, bvid] = status
+
+    def refresh(self, active):
+        """
+        Apply the recorded statuses and `active`, the progress of the
+        running videos by (media id, bvid)
+        """
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        touched = set()
+        for key, progress in active.items():
+            if self.status.get(key) in (DOWNLOADED, FAILED):
+                # downloaded again
+                self.status.pop(key)
+            if self.progress.get(key) != progress:
+                self.progress[key] = progress
+                self.status[key] = DOWNLOADING
+                touched.add(key)
+        for key, status in changes.items():
+            self.status[key] = status
+            if status in (FAILED, RETRYING):
+                self.progress.pop(key, None)
+            touched.add(key)
+        rows = [self.row_of[key] for key in touched if key in self.row_of]
+        if rows:
+            self.dataChanged.emit(
+                self.index(min(rows), self.SIZE),
+                self.index(max(rows), self.PROGRESS),
+            )
+
+    def stop(self):
+        self.loader.requestInterruption()
+        self.loader.wait()
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    """paints the progress column as progress bars"""
+
+    def paint(self, painter, option, index):
+        value = index.data()
+        if value is None:
+            super(ProgressDelegate, self).paint(painter, option, index)
+            return
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(4, 8, -4, -8)
+        bar.state = option.state | QStyle.StateFlag.State_Horizontal
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = value
+        bar.text = f"{value}%"
+        bar.textVisible = True
+        QApplication.style().drawControl(
+            QStyle.ControlElement.CE_ProgressBar, bar, painter
+        )
 
 
 # download thread
 class DownloadThread(QThread):
     # setup download respomse signal
     download_response = pyqtSignal(int)
+    # setup download stats signal (rate and ETA)
+    download_stats = pyqtSignal(str)
     # setup download complete signal
     download_complete = pyqtSignal(str)
     # setup download error signal
     download_err = pyqtSignal()
 
-    def __init__(self, media_id, media_counts, first_page_medias, output_path):
+    def __init__(
+        self,
+        listings,
+        output_path,
+        max_jobs=MAX_JOBS,
+        order=DEFAULT_ORDER,
+        on_status=None,
+    ):
         super(DownloadThread, self).__init__()
-        self.media_id = media_id
-        self.media_counts = media_counts
-        self.page_medias = first_page_medias
         self.output_path = output_path
-
-        # set multithreads to False
-        self.is_multithreads = True
-        self.threads = {}
-
-    def run(self):
-        if self.is_multithreads:
-            self.multi()
+        self.paused = False
+        # called with the media id, the bvid and the status of each finished
+        # video
+        self.on_status = on_status
+        # videos already downloaded for another favorite are only linked
+        store = ContentStore(default_store_path(output_path))
+        if len(listings) > 1:
+            # many favorites share the download queue and the jobs
+            self.sync = Batch(
+                list(listings),
+                output_path,
+                jobs=max_jobs,
+                listings=listings,
+                store=store,
+                order=order,
+                on_progress=self.progress_slot,
+                on_complete=lambda media_id, bvid: self.status_slot(
+                    media_id, bvid, DOWNLOADED
+                ),
+                on_error=lambda media_id, bvid: self.status_slot(
+                    media_id, bvid, FAILED
+                ),
+                on_retry=lambda media_id, bvid: self.status_slot(
+                    media_id, bvid, RETRYING
+                ),
+            )
         else:
-            self.single()
-
-    def single(self):
-        try:
-            counts = 0
-            page = 2
-            while True:
-                # download video using annie
-                for media in self.page_medias:
-                    per_counts = 0
-                    cmd = f"annie -o {self.output_path} https://www.bilibili.com/video/{media['bvid']}"
-                    print(cmd)
-                    # os.system(cmd)
-                    self.process = subprocess.Popen(
-                        cmd,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                    )
-                    stdout = _BufferedReaderForFFmpeg(self.process.stdout.raw)
-                    while True:
-                        line = stdout.readline()
-                        if not line:
-                            break
-                        try:
-                            line = line.decode("utf-8")
-                        except UnicodeDecodeError:
-                            line = line.decode("gbk")
-                        print(line)
-                        try:
-                            per_counts = float(line.split("%")[0].split(" ")[-1])
-                        except:
-                            pass
-                        self.download_response.emit(
-                            int((counts + per_counts / 100) / self.media_counts * 100)
-                        )
-                    counts += 1
-
-                if counts >= self.media_counts:
-                    break
-                url = (
-                    f"https://api.bilibili.com/medialist/gateway/base/spaceDetail?media_id={self.media_id}&"
-                    f"pn={page}&ps=20&keyword=&order=mtime&type=0&tid=0&jsonp=jsonp"
-                )
-                page += 1
-                data = json.loads(urlopen(url).read())
-                self.page_medias = data["data"]["medias"]
-        except Exception as e:
-            print(e)
-            # emitting the error signal
-            self.download_err.emit()
-
-        self.download_complete.emit(self.output_path)
+            media_id, data = next(iter(listings.items()))
+            self.sync = Sync(
+                media_id,
+                output_path,
+                jobs=max_jobs,
+                media_counts=data["info"]["media_count"],
+                first_page_medias=data["medias"] or [],
+                store=store,
+                order=order,
+                on_progress=self.progress_slot,
+                on_complete=lambda bvid: self.status_slot(media_id, bvid, DOWNLOADED),
+                on_error=lambda bvid: self.status_slot(media_id, bvid, FAILED),
+                on_retry=lambda bvid: self.status_slot(media_id, bvid, RETRYING),
+            )
 
-    def multi(self):
-        """
-        多线程下载就不显示细节进度条了
-        同步太麻烦了
-        """
-        # videos counts
-        self.download_counts = 0
-        # progress counts
-        self.cur_progress = 0
+    def syncs(self):
+        if isinstance(self.sync, Batch):
+            return list(self.sync.syncs.values())
+        return [self.sync]
+
+    def active(self):
+        """progress of the running videos by (media id, bvid), for the media list"""
+        active = {}
+        for sync in self.syncs():
+            for bvid, progress in sync.progress.running().items():
+                active[sync.media_id, bvid] = progress
+        return active
+
+    def status_slot(self, media_id, bvid, status):
+        # runs in the worker threads
+        if self.on_status:
+            self.on_status(media_id, bvid, status)
+
+    def progress_slot(self, stats):
+        # runs in the sync's reporter thread a few times per second
+        self.download_response.emit(stats.percent)
+        if self.paused:
+            self.download_stats.emit(f"Paused, {describe(stats)}")
+        else:
+            self.download_stats.emit(describe(stats))
 
+    def run(self):
         try:
-            counts = 0
-            page = 2
-            while True:
-                # download video using annie
-                for media in self.page_medias:
-                    bvid = media["bvid"]
-                    self.threads[bvid] = Annie(bvid, self.output_path)
-                    self.threads[bvid].annie_download_complete.connect(
-                        self.download_finished_slot
-                    )
-                    self.threads[bvid].annie_download_err.connect(
-                        self.download_err.emit
-                    )
-                    self.threads[bvid].start()
-                    counts += 1
-
-                if counts >= self.media_counts:
-                    break
-                url = (
-                    f"https://api.bilibili.com/medialist/gateway/base/spaceDetail?media_id={self.media_id}&"
-                    f"pn={page}&ps=20&keyword=&order=mtime&type=0&tid=0&jsonp=jsonp"
-                )
-                page += 1
-                data = json.loads(urlopen(url).read())
-                self.page_medias = data["data"]["medias"]
+            ok = self.sync.run()
         except Exception as e:
             print(e)
+            ok = False
+        if self.sync.stopped:
+            return
+        if not ok:
             # emitting the error signal
             self.download_err.emit()
-
-        while self.download_counts != self.media_counts:
-            pass
         self.download_complete.emit(self.output_path)
 
-    def download_finished_slot(self, bvid):
-        # Remove threads that have completed their tasks
-        del self.threads[bvid]
-        # lock
-        DownloadCountsMutex.lock()
-        self.download_counts += 1
-        DownloadCountsMutex.unlock()
-
-        self.download_response.emit(int(self.download_counts / self.media_counts * 100))
-
     def terminate(self):
-        super(DownloadThread, self).terminate()
-
-        if self.is_multithreads:
-            for t in self.threads.values():
-                subprocess.call(f"TASKKILL /F /PID {t.process.pid} /T")
-        else:
-            subprocess.call(f"TASKKILL /F /PID {self.process.pid} /T")
-
+        # the thread exits once the running videos are stopped, the ones
+        # that do not exit in time are killed by the reaper
+        self.sync.stop()
 
-# download video using annie (for multithreads)
-class Annie(QThread):
-    annie_download_complete = pyqtSignal(str)
-    annie_download_err = pyqtSignal()
+    def pause(self):
+        # the running videos are suspended, and resumed where they were
+        self.paused = True
+        self.sync.pause()
 
-    def __init__(self, bvid, output_path):
-        super(Annie, self).__init__()
-        self.bvid = bvid
-        self.output_path = output_path
-        self.process = None
-
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
-
-    def run(self):
-        cmd = f"annie -o {self.output_path} https://www.bilibili.com/video/{self.bvid}"
-        print(cmd)
-        try:
-            self.process = subprocess.Popen(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-            stdout = _BufferedReaderForFFmpeg(self.process.stdout.raw)
-            while True:
-                line = stdout.readline()
-                if not line:
-                    break
-        except:
-            self.annie_download_err.emit()
-
-        self.annie_download_complete.emit(self.bvid)
+    def resume(self):
+        self.paused = False
+        self.sync.resume()
 
 
 class B23Download(QWidget):
@@ -323,7 +573,7 @@ class B23Download(QWidget):
         # setup some window specific things
         self.setWindowTitle("Bilibili Favorite Downloader")
         self.setWindowIcon(QIcon("images/icon_bilibili.ico"))
-        self.setFixedSize(705, 343)
+        self.setFixedSize(705, 643)
 
         # parent layout
         main_layout = QVBoxLayout()
@@ -347,6 +597,22 @@ class B23Download(QWidget):
         self.output_btn.setToolTip(self.output_path)
         self.output_btn.clicked.connect(self.set_output_path)
 
+        # bandwidth limit, applied to the running downloads as well
+        self.limit_edit = QLineEdit()
+        self.limit_edit.setPlaceholderText("⏱ No limit")
+        self.limit_edit.setToolTip("Bandwidth limit of all downloads, such as 2M")
+        self.limit_edit.setFixedWidth(120)
+        self.limit_edit.editingFinished.connect(self.set_limit)
+
+        # order the videos are downloaded in
+        self.order_box = QComboBox()
+        for order, label in ORDER_LABELS.items():
+            self.order_box.addItem(label, order)
+        self.order_box.setToolTip(
+            "Shortest first finishes the most videos early, largest first leaves "
+            "no long video alone at the end"
+        )
+
         # status bar
         self.status_bar = QStatusBar()
 
@@ -375,6 +641,39 @@ class B23Download(QWidget):
 
         # progress bar
         self.progress_bar = QProgressBar()
+        # whether the progress text is white, None until the first update
+        self.progress_light = None
+
+        # every video of the favorites, with its status and progress
+        self.media_model = MediaModel()
+        self.media_view = QTableView()
+        self.media_view.setModel(self.media_model)
+        self.media_view.setItemDelegateForColumn(
+            MediaModel.PROGRESS, ProgressDelegate(self.media_view)
+        )
+        self.media_view.setIconSize(QSize(*ROW_THUMB_SIZE))
+        self.media_view.setWordWrap(False)
+        self.media_view.setShowGrid(False)
+        self.media_view.setSelectionBehavior(
+            QAbstractItemView.SelectionBehavior.SelectRows
+        )
+        self.media_view.verticalHeader().hide()
+        # fixed row heights, so that the view never measures the rows
+        self.media_view.verticalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.Fixed
+        )
+        self.media_view.verticalHeader().setDefaultSectionSize(ROW_THUMB_SIZE[1] + 6)
+        header = self.media_view.horizontalHeader()
+        header.setSectionResizeMode(MediaModel.TITLE, QHeaderView.ResizeMode.Stretch)
+        for column in (MediaModel.DURATION, MediaModel.SIZE, MediaModel.STATUS):
+            header.resizeSection(column, 90)
+        header.resizeSection(MediaModel.PROGRESS, 110)
+
+        # applies the status of the videos to the media list
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(REFRESH_INTERVAL)
+        self.refresh_timer.timeout.connect(self.refresh_media_list)
+        self.listing_thread = None
 
         # download options
         self.download_btn = QPushButton(" Download Videos ")
@@ -384,6 +683,12 @@ class B23Download(QWidget):
         self.download_btn.setShortcut("Ctrl+Return")
         self.download_btn.setMinimumWidth(200)
 
+        # pause the running download, keeping the progress of its videos
+        self.pause_btn = QPushButton("Pause")
+        self.pause_btn.setCursor(QCursor(Qt.CursorShape.PointingHandCursor))
+        self.pause_btn.clicked.connect(self.pause_slot)
+        self.pause_btn.setEnabled(False)
+
         # add widgets and layouts
         top_layout.addWidget(self.url_edit)
         top_layout.addWidget(self.get_btn)
@@ -399,12 +704,15 @@ class B23Download(QWidget):
 
         # download section
         bottom_right_layout.addWidget(self.download_btn)
+        bottom_right_layout.addWidget(self.pause_btn)
         bottom_main_layout.addWidget(self.progress_bar)
         bottom_main_layout.addSpacing(10)
         bottom_main_layout.addLayout(bottom_right_layout)
 
         # status bar
         self.status_bar.setSizeGripEnabled(False)
+        self.status_bar.addPermanentWidget(self.order_box)
+        self.status_bar.addPermanentWidget(self.limit_edit)
         self.status_bar.addPermanentWidget(self.output_btn)
 
         # add content to parent layout
@@ -413,6 +721,8 @@ class B23Download(QWidget):
         main_layout.addLayout(mid_main_layout)
         main_layout.addSpacing(5)
         main_layout.addLayout(bottom_main_layout)
+        main_layout.addSpacing(10)
+        main_layout.addWidget(self.media_view)
         main_layout.addWidget(self.status_bar)
 
     # set output path slot
@@ -424,6 +734,17 @@ class B23Download(QWidget):
             # update tooltip
             self.output_btn.setToolTip(path)
 
+    # bandwidth limit slot
+    def set_limit(self):
+        try:
+            limiter.set_rate(parse_rate(self.limit_edit.text()))
+        except ValueError:
+            self.message_box.warning(
+                self,
+                "Error",
+                "Input a correct bandwidth limit!\nFor example: 500K, 2M or off",
+            )
+
     # get button slot
     def get_details(self):
         text = self.url_edit.text().strip()
@@ -431,13 +752,19 @@ class B23Download(QWidget):
         if not text:
             return
 
-        if text.find("fid") < 0:
+        # favorite urls or ids, or space urls, separated by spaces or commas
+        favorites = split_favorites(text)
+        if not all(
+            part.find("fid") >= 0 or part.isdigit() or parse_space_id(part)
+            for part in favorites
+        ):
             self.message_box.warning(
                 self,
                 "Error",
                 (
                     "Input a correct favorite URL!\n"
-                    "For example: https://space.bilibili.com/xxx/favlist?fid=xxx..."
+                    "For example: https://space.bilibili.com/xxx/favlist?fid=xxx...\n"
+                    "or https://space.bilibili.com/xxx/favlist for all favorites"
                 ),
             )
             return
@@ -449,8 +776,7 @@ class B23Download(QWidget):
             # set fetching flag
             self.is_fetching = True
             # setup a worker thread to keep UI responsive
-            self.media_id = text.split("fid=")[-1].split("&")[0]
-            self.worker = WorkerThread(self.media_id)
+            self.worker = WorkerThread(favorites)
             self.worker.start()
             # catch the finished signal
             self.worker.finished.connect(self.finished_slot)
@@ -492,18 +818,25 @@ class B23Download(QWidget):
             self.is_downloading = True
             # set button to stop
             self.get_btn.setText("Stop")
+            self.pause_btn.setText("Pause")
+            self.pause_btn.setEnabled(True)
             self.download_thread = DownloadThread(
-                self.media_id,
-                self.media_counts,
-                self.first_page_medias,
+                self.listings,
                 self.output_path,
+                order=self.order_box.currentData(),
+                on_status=self.media_model.set_status,
             )
+            # clear the status of the last download
+            self.media_model.reset_status()
             # start the thread
             self.download_thread.start()
+            self.refresh_timer.start()
             # catch the finished signal
             self.download_thread.finished.connect(self.download_finished_slot)
             # catch the response signal
             self.download_thread.download_response.connect(self.download_response_slot)
+            # catch the stats signal
+            self.download_thread.download_stats.connect(self.status_bar.showMessage)
             # catch the complete signal
             self.download_thread.download_complete.connect(self.download_complete_slot)
             # catch the error signal
@@ -530,15 +863,24 @@ class B23Download(QWidget):
         # set back the button text
         self.get_btn.setText("Get")
         # set the actual thumbnail of requested video
-        self.thumb.setPixmap(res.thumb_img)
+        self.thumb.setPixmap(QPixmap.fromImage(res.thumb_img))
         # slice the title if it is more than the limit
         if len(res.title) > 50:
             self.title.setText(f"Title: {res.title[:50]}...")
         else:
             self.title.setText(f"Title: {res.title}")
-        # cache first page medias
-        self.first_page_medias = res.medias
-        self.media_counts = res.media_counts
+        # cache first page medias of every favorite
+        self.listings = res.listings
+        # list the videos, the remaining pages in the background
+        if self.listing_thread is not None:
+            # still listing the favorites of the last Get
+            self.listing_thread.page_listed.disconnect()
+            self.listing_thread.requestInterruption()
+        self.media_model.clear()
+        # owned by the window, so that it can finish after being replaced
+        self.listing_thread = ListingThread(res.listings, self)
+        self.listing_thread.page_listed.connect(self.media_model.add_medias)
+        self.listing_thread.start()
         # set leftover details
         self.author.setText(f"Author: {res.author}")
         self.length.setText(f"Videos: {res.media_counts}")
@@ -558,26 +900,40 @@ class B23Download(QWidget):
         # set back the button text
         self.get_btn.setText("Get")
 
+    # media list refresh slot
+    def refresh_media_list(self):
+        self.media_model.refresh(self.download_thread.active())
+
     # download finished slot
     def download_finished_slot(self):
+        # show the last statuses
+        self.refresh_timer.stop()
+        self.refresh_media_list()
         # set back the button text
         self.get_btn.setText("Get")
         # now enable the download options
         self.download_btn.setDisabled(False)
+        self.pause_btn.setEnabled(False)
         # unset downloading flag
         self.is_downloading = False
         # reset pogress bar
         self.progress_bar.reset()
+        # clear the download stats
+        self.status_bar.clearMessage()
 
     # download response slot
     def download_response_slot(self, per):
         # update progress bar
         self.progress_bar.setValue(per)
-        # adjust the font color to maintain the contrast
-        if per > 52:
-            self.progress_bar.setStyleSheet("QProgressBar { color: #fff }")
-        else:
-            self.progress_bar.setStyleSheet("QProgressBar { color: #000 }")
+        # adjust the font color to maintain the contrast, restyling is costly
+        # so only do it when the threshold is crossed
+        light = per > 52
+        if light != self.progress_light:
+            self.progress_light = light
+            if light:
+                self.progress_bar.setStyleSheet("QProgressBar { color: #fff }")
+            else:
+                self.progress_bar.setStyleSheet("QProgressBar { color: #000 }")
 
     # download complete slot
     def download_complete_slot(self, location):
@@ -596,6 +952,27 @@ class B23Download(QWidget):
         ):
             subprocess.Popen(f"explorer /select,{location}")
 
+    # pause slot
+    def pause_slot(self):
+        if self.pause_btn.text() == "Pause":
+            self.download_thread.pause()
+            self.pause_btn.setText("Resume")
+        else:
+            self.download_thread.resume()
+            self.pause_btn.setText("Pause")
+
+    # stop the background threads with the window
+    def closeEvent(self, event):
+        if self.listing_thread is not None:
+            self.listing_thread.requestInterruption()
+        self.media_model.stop()
+        if self.is_downloading:
+            # no annie or ffmpeg outlives the window
+            self.download_thread.terminate()
+            self.download_thread.wait()
+            reaper.wait()
+        super(B23Download, self).closeEvent(event)
+
     # download error slot
     def download_err_slot(self):
         # show the error message
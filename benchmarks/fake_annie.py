@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the annie executable: `fake_annie.py -o DIR URL...`
+
+Starts in BENCH_STARTUP seconds, then for each URL writes a video of
+BENCH_VIDEO_SIZE bytes into DIR at BENCH_RATE bytes/s (0 for as fast as
+possible) and prints annie's info block and progress bar, redrawn every
+BENCH_REFRESH seconds. A share BENCH_ANNIE_ERRORS of the videos fail,
+picked by their bvid so that runs are repeatable, and are reported like
+annie does before it goes on with the next URL
+"""
+
+import os
+import sys
+import time
+import zlib
+
+VIDEO_SIZE = int(os.environ.get("BENCH_VIDEO_SIZE", 1024 * 1024))
+RATE = float(os.environ.get("BENCH_RATE", 0))
+REFRESH = float(os.environ.get("BENCH_REFRESH", 0.1))
+ERRORS = float(os.environ.get("BENCH_ANNIE_ERRORS", 0))
+STARTUP = float(os.environ.get("BENCH_STARTUP", 0))
+CHUNK_SIZE = 64 * 1024
+BAR_WIDTH = 40
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.2f} {unit}"
+        size /= 1024
+    return f"{size:.2f} GiB"
+
+
+def progress_line(done, total, rate, elapsed):
+    filled = BAR_WIDTH * done // max(total, 1)
+    bar = "=" * filled + (">" if filled < BAR_WIDTH else "")
+    left = (total - done) / rate if rate else 0
+    return (
+        f"\r {format_size(done)} / {format_size(total)} "
+        f"[{bar:-<{BAR_WIDTH + 1}}] {done / max(total, 1) * 100:.2f}% "
+        f"{format_size(rate)}/s {left:.0f}s"
+    )
+
+
+def main(argv):
+    output = argv[argv.index("-o") + 1] if "-o" in argv else "."
+    urls = [arg for arg in argv if "://" in arg]
+    # loading the config and the cookies of annie
+    time.sleep(STARTUP)
+    failed = False
+    for url in urls:
+        if not download(url, output):
+            sys.stdout.write(f"Downloading {url} error:\nrequest error: HTTP 412\n")
+            failed = True
+    return 1 if failed else 0
+
+
+def download(url, output):
+    bvid = url.rstrip("/").rsplit("/", 1)[-1]
+    out = sys.stdout
+
+    out.write(
+        f"\n Site:      哔哩哔哩 bilibili.com\n Title:     {bvid}\n"
+        f" Type:      video\n Stream:   \n     [default]  -------------------\n"
+        f"     Quality:         高清 1080P\n"
+        f"     Size:            {format_size(VIDEO_SIZE)} ({VIDEO_SIZE} Bytes)\n"
+        "     # download with: annie -f default ...\n\n"
+    )
+    out.flush()
+
+    if zlib.crc32(bvid.encode()) % 10000 < ERRORS * 10000:
+        return False
+
+    chunk = b"\0" * CHUNK_SIZE
+    start = time.perf_counter()
+    last = None
+    done = 0
+    with open(os.path.join(output, f"{bvid}.mp4"), "wb") as f:
+        while True:
+            now = time.perf_counter()
+            elapsed = now - start
+            if last is None or now - last >= REFRESH or done == VIDEO_SIZE:
+                last = now
+                rate = done / elapsed if elapsed > 0 else 0
+                out.write(progress_line(done, VIDEO_SIZE, rate, elapsed))
+                out.flush()
+            if done == VIDEO_SIZE:
+                break
+            n = min(CHUNK_SIZE, VIDEO_SIZE - done)
+            f.write(chunk[:n])
+            done += n
+            if RATE:
+                # hold back to the set rate
+                ahead = done / RATE - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+    out.write("\n")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
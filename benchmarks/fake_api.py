@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the favorite listing API of api.bilibili.com
+
+Serves `/medialist/gateway/base/spaceDetail` for favorites of `count`
+videos, answering every request after `latency` seconds and failing a
+share `error_rate` of them like a throttled api.bilibili.com does
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeApi:
+    def __init__(self, count, latency=0.0, error_rate=0.0, seed=0):
+        self.count = count
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body = api.handle(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, path):
+        """return the status and body of the response to `path`"""
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            # bilibili answers 412 when requests are too frequent
+            return 412, b'{"code": -412, "message": "request was banned"}'
+
+        parts = urlsplit(path)
+        if parts.path != "/medialist/gateway/base/spaceDetail":
+            return 404, b'{"code": -404, "message": "not found"}'
+        query = parse_qs(parts.query)
+        media_id = query.get("media_id", ["0"])[0]
+        page = int(query.get("pn", ["1"])[0])
+        size = int(query.get("ps", ["20"])[0])
+        return 200, json.dumps(self.listing(media_id, page, size)).encode()
+
+    def listing(self, media_id, page, size):
+        medias = [
+            {
+                "id": i,
+                "bvid": f"BV{media_id}x{i:07d}",
+                "title": f"video {i}",
+                "cover": "",
+                "duration": 60 + i % 600,
+                "page": 1,
+                # newest first, like the real listing
+                "fav_time": 1600000000 + self.count - i,
+                "upper": {"mid": 1, "name": "bench"},
+            }
+            for i in range((page - 1) * size, min(page * size, self.count))
+        ]
+        return {
+            "code": 0,
+            "message": "0",
+            "data": {
+                "info": {
+                    "id": media_id,
+                    "title": f"bench {self.count}",
+                    "cover": "",
+                    "media_count": self.count,
+                    "ctime": 1600000000,
+                    "upper": {"mid": 1, "name": "bench"},
+                },
+                "medias": medias or None,
+            },
+        }
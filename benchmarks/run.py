@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of listing and downloading a favorite
+
+Every case runs in its own process against a local stand-in for the
+listing API (`fake_api.py`) and a fake annie (`fake_annie.py`), and
+reports the listing time, the time to the first download, the end-to-end
+throughput, the CPU time and the peak RSS as JSON:
+
+    python benchmarks/run.py -o head.json
+    python benchmarks/run.py --compare base.json head.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.dirname(os.path.abspath(__file__))
+# favorite sizes benchmarked by default
+SIZES = [20, 1000, 10000]
+# metrics compared between two runs, and whether higher is better
+METRICS = {
+    "listing_time": False,
+    "first_start": False,
+    "first_complete": False,
+    "elapsed": False,
+    "videos_per_second": True,
+    "bytes_per_second": True,
+    "cpu_time": False,
+    "peak_rss": False,
+}
+
+
+def make_annie(bin_dir):
+    """put an `annie` running fake_annie.py into `bin_dir`"""
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, "annie")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{HERE}/fake_annie.py" "$@"\n')
+    os.chmod(path, 0o755)
+
+
+def peak_rss(usage):
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def run_case(args):
+    """benchmark a favorite of `args.case` videos, return the results"""
+    import resource
+
+    tmp = tempfile.mkdtemp(prefix="bilifav-bench-")
+    try:
+        # before importing bilifav, its cache lives in the cache dir
+        os.environ["XDG_CACHE_HOME"] = os.path.join(tmp, "cache")
+        make_annie(os.path.join(tmp, "bin"))
+        os.environ["PATH"] = os.path.join(tmp, "bin") + os.pathsep + os.environ["PATH"]
+        os.environ["BENCH_VIDEO_SIZE"] = str(args.video_size)
+        os.environ["BENCH_RATE"] = str(args.rate)
+        os.environ["BENCH_ANNIE_ERRORS"] = str(args.annie_errors)
+        os.environ["BENCH_STARTUP"] = str(args.startup)
+        sys.path.insert(0, ROOT)
+        sys.path.insert(0, HERE)
+
+        import bilifav.api
+        from bilifav.api import api, fetch_listing, iter_pages
+        from bilifav.failures import RETRY_DELAYS
+        from bilifav.sync import Sync
+        from fake_api import FakeApi
+
+        server = FakeApi(args.case, args.latency, args.error_rate).start()
+        bilifav.api.API_BASE = server.url
+        output = os.path.join(tmp, "videos")
+        times = {}
+
+        class TimedSync(Sync):
+            def start_slot(self, bvid):
+                times.setdefault("first_start", time.perf_counter())
+                super(TimedSync, self).start_slot(bvid)
+
+        def complete(bvid):
+            times.setdefault("first_complete", time.perf_counter())
+
+        # the backends print to stdout, which carries the results
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            # listing alone, of a favorite the sync does not touch
+            start = time.perf_counter()
+            data = fetch_listing("1", 1)["data"]
+            listed = sum(
+                len(medias)
+                for medias in iter_pages(
+                    "1", data["info"]["media_count"], data["medias"] or []
+                )
+            )
+            listing_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            task = TimedSync(
+                "2",
+                output,
+                jobs=args.jobs,
+                batch_size=args.batch_size,
+                retry_delays=dict.fromkeys(RETRY_DELAYS, args.retry_delay),
+                on_complete=complete,
+            )
+            ok = task.run()
+            elapsed = time.perf_counter() - start
+
+        downloaded = task.queue.finished - task.queue.failed
+        size = sum(
+            entry.stat().st_size
+            for entry in os.scandir(output)
+            if entry.name.endswith(".mp4")
+        )
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server.stop()
+        return {
+            "items": args.case,
+            "listed": listed,
+            "listing_time": listing_time,
+            "first_start": times.get("first_start", start) - start,
+            "first_complete": times.get("first_complete", start) - start,
+            "elapsed": elapsed,
+            "downloaded": downloaded,
+            "failed": task.queue.failed,
+            "ok": ok,
+            "videos_per_second": downloaded / elapsed,
+            "bytes_per_second": size / elapsed,
+            "cpu_time": usage.ru_utime + usage.ru_stime,
+            # spent by the fake annie processes, not by the downloader
+            "children_cpu_time": children.ru_utime + children.ru_stime,
+            "peak_rss": peak_rss(usage),
+            "api": dict(api.stats(), served=server.requests, errors=server.errors),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(args):
+    params = {
+        "jobs": args.jobs,
+        "video_size": args.video_size,
+        "rate": args.rate,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "annie_errors": args.annie_errors,
+        "startup": args.startup,
+        "batch_size": args.batch_size,
+        "retry_delay": args.retry_delay,
+    }
+    results = []
+    for size in args.sizes:
+        print(f"benchmarking {size} items...", file=sys.stderr)
+        cmd = [sys.executable, os.path.abspath(__file__), "--case", str(size)]
+        for name, value in params.items():
+            cmd += ["--" + name.replace("_", "-"), str(value)]
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, text=True)
+        result = json.loads(out.stdout)
+        print(
+            f"  listing {result['listing_time']:.2f}s, "
+            f"first download {result['first_complete']:.2f}s, "
+            f"{result['videos_per_second']:.1f} videos/s, "
+            f"cpu {result['cpu_time']:.2f}s, "
+            f"rss {result['peak_rss'] / 1024 / 1024:.1f} MiB",
+            file=sys.stderr,
+        )
+        results.append(result)
+    return {
+        "commit": git_commit(),
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }
+
+
+def compare(base_path, head_path):
+    """print the change of every metric between two result files"""
+    with open(base_path) as f:
+        base = {r["items"]: r for r in json.load(f)["results"]}
+    with open(head_path) as f:
+        head = {r["items"]: r for r in json.load(f)["results"]}
+    for items in sorted(base.keys() & head.keys()):
+        print(f"{items} items")
+        for metric, higher_is_better in METRICS.items():
+            old, new = base[items][metric], head[items][metric]
+            change = (new - old) / old * 100 if old else 0.0
+            better = (change > 0) == higher_is_better
+            mark = "" if abs(change) < 5 else (" better" if better else " WORSE")
+            print(f"  {metric:<18} {old:>14.3f} {new:>14.3f} {change:+7.1f}%{mark}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=SIZES,
+        help="favorite sizes to benchmark (default: %(default)s)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=4)
+    parser.add_argument(
+        "--video-size", type=int, default=256 * 1024, help="bytes of each video"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="bytes/s of each fake annie, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds per api request"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of failed api requests"
+    )
+    parser.add_argument(
+        "--annie-errors", type=float, default=0.0, help="share of failed downloads"
+    )
+    parser.add_argument(
+        "--startup",
+        type=float,
+        default=0.0,
+        help="seconds each fake annie takes to start",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="most videos per annie run"
+    )
+    parser.add_argument(
+        "--retry-delay",
+        type=float,
+        default=0.01,
+        help="seconds before the first retry of a failed download, the fake "
+        "annie is not really throttled (default: %(default)s)",
+    )
+    parser.add_argument("-o", "--output", help="write the results to this file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "HEAD"), help="compare two results"
+    )
+    parser.add_argument("--case", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    if args.case is not None:
+        json.dump(run_case(args), sys.stdout)
+        return 0
+
+    report = run_all(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
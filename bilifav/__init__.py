@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+"""
+Qt-free core of the Bilibili favorite downloader
+
+Lists a favorite through the Bilibili API and downloads its videos with
+annie, see `python -m bilifav --help` for the command line interface
+"""
+
+from .batch import Batch
+from .sync import MAX_JOBS, Sync
+
+__all__ = ["MAX_JOBS", "Batch", "Sync"]
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+from .cli import main
+
+# the post-processing pool may import this module in its processes
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+from .backend import Backend, split_job
+from .failures import error_text
+from .metrics import metrics
+from .processes import CAN_SUSPEND, reaper, resume, spawn, suspend
+from .ratelimit import MAX_WAIT, limiter
+
+# size of the selected stream in annie's info output, `Size: 1.00 MiB (1048576 Bytes)`
+ANNIE_SIZE = re.compile(rb"\((\d+) Bytes\)")
+# annie's progress bar, `1.00 MiB / 2.00 MiB [===>---] 50.00% 1.00 MiB/s 1s`
+ANNIE_PROGRESS = re.compile(
+    rb"([\d.]+) ?([KMGT]?i?B) / ([\d.]+) ?([KMGT]?i?B)\D*?(\d+(?:\.\d+)?)%"
+)
+UNITS = {
+    b"B": 1,
+    b"KiB": 1024,
+    b"MiB": 1024**2,
+    b"GiB": 1024**3,
+    b"TiB": 1024**4,
+    b"KB": 1000,
+    b"MB": 1000**2,
+    b"GB": 1000**3,
+    b"TB": 1000**4,
+}
+# annie redraws its progress bar with `\r`
+LINE_BREAK = re.compile(rb"\r\n|[\r\n]")
+# bytes read from annie's output at once
+CHUNK_SIZE = 64 * 1024
+# seconds between two progress reports of a video
+PROGRESS_INTERVAL = 0.2
+# lines of annie's output kept as the error of a failed video
+MESSAGE_LINES = 3
+
+
+def iter_lines(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yield the lines of `stream`, treating `\\r` as a line break too
+
+    Reads whatever is available in chunks instead of peeking byte by byte,
+    annie redraws its progress bar many times per second
+    """
+    rest = b""
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        lines = LINE_BREAK.split(rest + chunk)
+        rest = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if rest:
+        yield rest
+
+
+def parse_progress(line):
+    """return the bytes done, bytes total and percentage of a progress line"""
+    match = ANNIE_PROGRESS.search(line)
+    if not match:
+        return None
+    done, done_unit, total, total_unit, percent = match.groups()
+    return (
+        int(float(done) * UNITS.get(done_unit, 1)),
+        int(float(total) * UNITS.get(total_unit, 1)),
+        float(percent),
+    )
+
+
+def join_lines(lines):
+    return b"\n".join(lines).decode("utf-8", "replace") or None
+
+
+def video_url(job):
+    bvid, page = split_job(job)
+    url = f"https://www.bilibili.com/video/{bvid}"
+    if page:
+        url += f"?p={page}"
+    return url
+
+
+def find_job(line, urls):
+    """return the job whose URL is in the output `line`, None if there is none"""
+    # the longest first, `?p=1` and `?p=12` of a video share their start
+    for url in sorted(urls, key=len, reverse=True):
+        if url.encode() in line:
+            return urls[url]
+    return None
+
+
+class AnnieBackend(Backend):
+    """
+    Download with an annie process per video, or per batch of videos
+
+    annie cannot limit its own rate, so it is suspended whenever the bytes
+    it reports exceed the bandwidth limit, and while the download is
+    paused (not supported on Windows, where a paused download goes on).
+    Each run is a process group of its own, stopped by the `reaper`
+    """
+
+    name = "annie"
+    batched = True
+
+    def __init__(self, output_path):
+        super(AnnieBackend, self).__init__(output_path)
+        self.process = None
+        # held while annie is started, stopped, suspended or resumed
+        self.lock = threading.Lock()
+
+    def download(self, bvid, on_progress=None):
+        results = {}
+
+        def progress(job, done, total, percent):
+            on_progress(done, total, percent)
+
+        def result(job, ok, size):
+            results[job] = ok, size
+
+        self.download_batch([bvid], on_progress and progress, result)
+        return results[bvid]
+
+    def download_batch(self, bvids, on_progress=None, on_result=None):
+        """
+        Download the videos with one annie run, splitting its output by video
+
+        annie goes through its URLs in order and prints the info block of a
+        video, opened by its `Site:` line, before downloading it, so the
+        size and the progress lines that follow belong to that video. The
+        block names no URL, it belongs to the first video not finished yet.
+        A video failed when annie reports a `Downloading URL error`,
+        followed by the error, or when the run ends before its block, or in
+        the middle of it by a signal. A video without an error line that
+        annie left for the next one is done
+        """
+        # URL -> job, in the order annie downloads them
+        urls = {video_url(bvid): bvid for bvid in bvids}
+        cmd = ["annie", "-o", self.output_path, *urls]
+        self.failure = None
+        self.message = None
+        # in the order of the URLs
+        pending = list(bvids)
+        # video being downloaded, its size and when its transfer began
+        current = bvids[0]
+        size = None
+        resolved = None
+        # whether annie printed the info block of `current`
+        opened = False
+        failed = False
+        # video annie reported an error for, and the lines of the error
+        erroring = None
+        error = []
+        # last lines of the current video that are not progress
+        output = deque(maxlen=MESSAGE_LINES)
+        limit = limiter.job()
+
+        def finish(bvid, ok, failure=None, message=None):
+            # read by the worker from the result callback
+            self.failure = None if ok else failure
+            self.message = None if ok else message
+            pending.remove(bvid)
+            if on_result:
+                on_result(bvid, ok, size if bvid == current else None)
+
+        def fail_erroring():
+            nonlocal erroring
+            if erroring in pending:
+                finish(erroring, False, "annie_exit", join_lines(error))
+            erroring = None
+
+        def complete_current():
+            # annie went on with the next video without an error
+            if opened and current in pending:
+                self.observe_download(resolved or started, moved)
+                finish(current, True)
+
+        try:
+            with self.lock, metrics.span("spawn", bvid=bvids[0], cmd=cmd):
+                if self.stopped:
+                    for bvid in list(pending):
+                        finish(bvid, False, "stopped")
+                    return
+                # annie itself leads the process group, not a shell that
+                # would exit before it
+                self.process = spawn(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+                if self.paused and CAN_SUSPEND:
+                    suspend(self.process)
+            # when the video began to be looked up, and annie was last
+            # seen transferring, after which the next video is looked up
+            started = moved = time.perf_counter()
+            last = 0.0
+            done = 0
+            for line in iter_lines(self.process.stdout):
+                if b"%" not in line:
+                    if line.lstrip().startswith(b"Site:"):
+                        # the info block of the next video
+                        fail_erroring()
+                        complete_current()
+                        if pending:
+                            opened = True
+                            current, size, resolved = pending[0], None, None
+                            started = moved
+                            done = 0
+                            output.clear()
+                        continue
+                    # `Downloading URL error:`, the only line with a URL
+                    bvid = find_job(line, urls) if b"error" in line else None
+                    if bvid in pending:
+                        fail_erroring()
+                        if bvid != current:
+                            complete_current()
+                        failed = True
+                        erroring, error = bvid, []
+                        continue
+                    if erroring is not None and len(error) < MESSAGE_LINES:
+                        error.append(line)
+                        continue
+                    output.append(line)
+                    match = ANNIE_SIZE.search(line)
+                    if match and size is None:
+                        size = int(match.group(1))
+                elif current in pending:
+                    moved = time.perf_counter()
+                    if resolved is None:
+                        # annie has looked up the streams, the transfer begins
+                        resolved = moved
+                        metrics.observe(
+                            "bilifav_stage_seconds", resolved - started, stage="resolve"
+                        )
+                    # report at most once per interval, but follow every
+                    # update while the bandwidth is limited
+                    now = time.monotonic()
+                    report = on_progress and now - last >= PROGRESS_INTERVAL
+                    if not report and not limiter.active():
+                        continue
+                    progress = parse_progress(line)
+                    if not progress:
+                        continue
+                    if report:
+                        last = now
+                        on_progress(current, *progress)
+                    # annie starts a new bar for each stream
+                    if progress[0] > done:
+                        limit.reserve(progress[0] - done)
+                    done = progress[0]
+                    self.throttle(limit)
+            returncode = self.process.wait()
+            fail_erroring()
+            if current in pending:
+                self.observe_download(resolved or started, time.perf_counter())
+        except Exception as e:
+            print(e)
+            for bvid in list(pending):
+                finish(bvid, False, type(e).__name__, error_text(e))
+            return
+        finally:
+            with self.lock:
+                self.process = None
+            limit.close()
+        message = join_lines(output)
+        if current in pending:
+            # a non-zero exit is explained by the error of another video,
+            # unless annie was killed by a signal
+            if returncode == 0 or returncode > 0 and failed:
+                finish(current, True)
+            else:
+                failure = "annie_exit" if returncode > 0 else "killed"
+                finish(current, False, failure, message)
+        for bvid in list(pending):
+            # never reached
+            failure = "annie_exit" if returncode >= 0 else "killed"
+            finish(bvid, False, failure, message)
+
+    @staticmethod
+    def observe_download(start, end):
+        metrics.observe("bilifav_stage_seconds", end - start, stage="download")
+
+    def throttle(self, limit):
+        """suspend annie while the bandwidth limit is exceeded"""
+        if not CAN_SUSPEND or limit.wait_time() <= 0:
+            return
+        process = self.process
+        suspend(process)
+        try:
+            while not self.stopped:
+                wait = limit.wait_time()
+                if wait <= 0:
+                    break
+                time.sleep(min(wait, MAX_WAIT))
+        finally:
+            with self.lock:
+                # paused meanwhile, it stays suspended
+                if not self.paused:
+                    resume(process)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            if self.process:
+                reaper.stop(self.process)
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            if self.process and CAN_SUSPEND:
+                suspend(self.process)
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            if self.process and CAN_SUSPEND:
+                resume(self.process)
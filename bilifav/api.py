@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import http.client
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+from .cache import CACHE_TTL, cache
+from .metrics import metrics
+
+# default number of listing pages fetched at the same time
+MAX_FETCHES = 8
+# medias per listing page
+PAGE_SIZE = 20
+
+# http client settings
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/90.0.4430.212 Safari/537.36"
+)
+HTTP_TIMEOUT = 10
+HTTP_RETRIES = 4
+HTTP_BACKOFF = 0.5
+# seconds an idle keep-alive connection is kept, servers close them sooner
+# or later and a closed one is only found out when it is used
+MAX_IDLE_AGE = 15
+# responses worth retrying, bilibili answers 412 when requests are too frequent
+RETRY_STATUS = {412, 429, 500, 502, 503, 504}
+# and the codes of the JSON responses it sends with HTTP 200 instead
+RETRY_CODES = {-412, -509}
+
+API_BASE = "https://api.bilibili.com"
+
+# `space.bilibili.com/<mid>/favlist`, standing for every favorite of a user
+SPACE_URL = re.compile(r"space\.bilibili\.com/(\d+)")
+
+
+class ApiError(Exception):
+    def __init__(self, url, status, message=None):
+        super(ApiError, self).__init__(f"{message or f'HTTP {status}'}: {url}")
+        self.url = url
+        self.status = status
+
+
+class ApiClient:
+    """
+    HTTP client shared by all threads
+
+    Keeps idle keep-alive connections per host for reuse, applies a timeout
+    to every request and retries throttled or failed requests with an
+    exponential backoff. A reused connection the server closed meanwhile is
+    replaced at once, without counting as a try. `stats` returns the
+    counters it tracks
+    """
+
+    def __init__(
+        self,
+        timeout=HTTP_TIMEOUT,
+        retries=HTTP_RETRIES,
+        backoff=HTTP_BACKOFF,
+        max_idle=MAX_FETCHES,
+        max_idle_age=MAX_IDLE_AGE,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self.max_idle_age = max_idle_age
+        self.lock = threading.Lock()
+        # idle connections by (scheme, host), with when they were released
+        self.pool = {}
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def acquire(self, scheme, host):
+        """return a connection to `host` and whether it was used before"""
+        expired = []
+        with self.lock:
+            idle = self.pool.get((scheme, host), [])
+            # the oldest first
+            while idle and time.monotonic() - idle[0][1] > self.max_idle_age:
+                expired.append(idle.pop(0)[0])
+            conn = idle.pop()[0] if idle else None
+        for old in expired:
+            old.close()
+        if conn is not None:
+            return conn, True
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=self.timeout)
+        return conn, False
+
+    def release(self, scheme, host, conn):
+        with self.lock:
+            idle = self.pool.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def request(self, url, headers=None):
+        """send one GET request, return the status, headers and body"""
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        while True:
+            conn, reused = self.acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request(
+                    "GET",
+                    path,
+                    headers={
+                        "User-Agent": USER_AGENT,
+                        "Referer": "https://www.bilibili.com/",
+                        "Accept-Encoding": "gzip",
+                        **(headers or {}),
+                    },
+                )
+                res = conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                if reused:
+                    # closed by the server while idle, before any response
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+        try:
+            body = res.read()
+        except Exception:
+            conn.close()
+            raise
+        if res.will_close:
+            conn.close()
+        else:
+            self.release(parts.scheme, parts.netloc, conn)
+        if res.getheader("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return res.status, res.headers, body
+
+    def fetch(self, url, headers=None):
+        """
+        Return the status, headers and body of `url`, following redirects
+        and retrying on failure
+        """
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            delay = self.backoff * 2**attempt
+            try:
+                status, res_headers, body = self.request(url, headers)
+                if status in (301, 302, 303, 307, 308) and res_headers.get("Location"):
+                    url = res_headers["Location"]
+                    status, res_headers, body = self.request(url, headers)
+                err = None if status < 400 else ApiError(url, status)
+                code, message = refused(body) if status == 200 else (None, None)
+                if code is not None:
+                    # retried like the status it stands for
+                    status, err = code, ApiError(url, code, message)
+                retry_after = res_headers.get("Retry-After", "")
+                if status in (412, 429) and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            except (OSError, http.client.HTTPException) as e:
+                status, err = None, e
+            self.record(time.perf_counter() - start)
+            if err is None:
+                return status, res_headers, body
+            if attempt == self.retries or (
+                status is not None
+                and status not in RETRY_STATUS
+                and status not in RETRY_CODES
+            ):
+                break
+            with self.lock:
+                self.retried += 1
+            metrics.inc("bilifav_api_retries_total")
+            time.sleep(delay)
+        with self.lock:
+            self.failures += 1
+        metrics.inc("bilifav_api_failures_total", reason=status or type(err).__name__)
+        raise err
+
+    def get(self, url, headers=None):
+        """return the body of `url`, following redirects and retrying on failure"""
+        return self.fetch(url, headers)[2]
+
+    def record(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        metrics.inc("bilifav_api_requests_total")
+        metrics.observe("bilifav_api_request_seconds", latency)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retried,
+                "failures": self.failures,
+                "avg_latency": self.latency / self.requests if self.requests else 0.0,
+                "max_latency": self.max_latency,
+            }
+
+
+# shared by all threads
+api = ApiClient()
+
+
+def refused(body):
+    """
+    Return the code and the message of a JSON body refusing the request
+    for being too frequent, (None, None) for any other body
+    """
+    # only JSON objects are parsed, not the video streams
+    if not body.startswith(b"{"):
+        return None, None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None, None
+    code = data.get("code") if isinstance(data, dict) else None
+    if code not in RETRY_CODES:
+        return None, None
+    # `code -412` is told apart as throttled by `failures.classify`
+    return code, f"code {code} {data.get('message') or ''}".rstrip()
+
+
+def parse_media_id(text):
+    """return the favorite id of a favorite URL (`...favlist?fid=xxx`) or a bare id"""
+    text = text.strip()
+    if "fid=" in text:
+        return text.split("fid=")[-1].split("&")[0]
+    if text.isdigit():
+        return text
+    raise ValueError(f"not a favorite URL: {text}")
+
+
+def parse_space_id(text):
+    """return the user id of a space URL without a `fid`, None otherwise"""
+    if "fid=" in text:
+        return None
+    match = SPACE_URL.search(text)
+    return match.group(1) if match else None
+
+
+def split_favorites(text):
+    """split a list of favorite ids or URLs separated by spaces or commas"""
+    return [part for part in re.split(r"[\s,]+", text) if part]
+
+
+def expand_favorites(texts):
+    """
+    Return the favorite ids of a list of favorite ids or URLs, where a
+    space URL stands for every favorite created by that user
+    """
+    media_ids = []
+    for text in texts:
+        mid = parse_space_id(text)
+        if mid is None:
+            ids = [parse_media_id(text)]
+        else:
+            ids = [str(folder["id"]) for folder in fetch_folders(mid)]
+        for media_id in ids:
+            if media_id not in media_ids:
+                media_ids.append(media_id)
+    return media_ids
+
+
+def api_url(path):
+    return API_BASE + path
+
+
+def fetch_json(url):
+    """fetch a Bilibili API response, return its data"""
+    data = json.loads(api.get(url))
+    if data.get("code") != 0:
+        raise ApiError(url, data.get("code"), data.get("message"))
+    return data["data"]
+
+
+def space_detail_url(media_id, page):
+    return api_url(
+        f"/medialist/gateway/base/spaceDetail?media_id={media_id}&"
+        f"pn={page}&ps={PAGE_SIZE}&keyword=&order=mtime&type=0&tid=0&jsonp=jsonp"
+    )
+
+
+def fetch_listing(media_id, page, fresh=False):
+    """
+    Fetch a listing page, return the decoded response. A `fresh` page is
+    fetched past the cache, to see the videos favorited since, and cached
+    """
+    url = space_detail_url(media_id, page)
+    body = None if fresh else cache.get(url, CACHE_TTL)
+    if body is not None:
+        metrics.inc("bilifav_listing_pages_total", cache="hit")
+        return json.loads(body)
+    metrics.inc("bilifav_listing_pages_total", cache="miss")
+    with metrics.span("listing", media_id=str(media_id), page=page):
+        body = api.get(url)
+    data = json.loads(body)
+    # do not cache errors such as an invalid or private favorite
+    if data.get("code") == 0:
+        cache.put(url, body)
+    return data
+
+
+def fetch_folders(mid):
+    """return the favorites created by the user `mid`"""
+    data = fetch_json(api_url(f"/x/v3/fav/folder/created/list-all?up_mid={mid}"))
+    return (data or {}).get("list") or []
+
+
+def fetch_favorites(media_ids, max_fetches=MAX_FETCHES):
+    """
+    Fetch the first listing page of each favorite concurrently, return the
+    listing data by favorite id, leaving out the favorites that failed
+    """
+
+    def fetch(media_id):
+        try:
+            data = fetch_listing(media_id, 1)
+        except Exception as e:
+            print(f"{media_id}: {e}")
+            return None
+        if data.get("code") != 0:
+            print(f"{media_id}: {data.get('message')}")
+            return None
+        return data["data"]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_fetches, len(media_ids)))) as ex:
+        listings = zip(media_ids, ex.map(fetch, media_ids))
+        return {media_id: data for media_id, data in listings if data}
+
+
+def fetch_page(media_id, page, fresh=False):
+    """fetch a listing page, return its medias"""
+    return fetch_listing(media_id, page, fresh)["data"]["medias"] or []
+
+
+def iter_pages(
+    media_id,
+    media_counts,
+    first_page_medias,
+    max_fetches=MAX_FETCHES,
+    ordered=False,
+    fresh=False,
+):
+    """
+    Yield the medias of every listing page, starting with the first page
+
+    The page count is known from `media_counts`, so the remaining pages are
+    fetched concurrently (at most `max_fetches` at a time) and yielded as
+    soon as they arrive, or in listing order if `ordered` is set. They are
+    `fresh` pages if set, see `fetch_listing`
+    """
+    yield first_page_medias
+    pages = -(-media_counts // PAGE_SIZE)
+    if pages < 2:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_fetches, pages - 1))
+    try:
+        futures = [
+            executor.submit(fetch_page, media_id, page, fresh)
+            for page in range(2, pages + 1)
+        ]
+        for future in futures if ordered else as_completed(futures):
+            yield future.result()
+    finally:
+        # stop fetching if the consumer gave up early
+        executor.shutdown(wait=False, cancel_futures=True)
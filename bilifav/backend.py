@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# default downloader backend
+DEFAULT_BACKEND = "annie"
+
+
+class Stopped(Exception):
+    """a download, or its post-processing, was stopped on purpose"""
+
+
+def part_job(bvid, page):
+    """job of one part of a multi-part video, such as `BV1xx411c7mD-p2`"""
+    return f"{bvid}-p{page}"
+
+
+def split_job(job):
+    """return the bvid of a job and its part, None for a whole video"""
+    bvid, sep, page = job.partition("-p")
+    if sep and page.isdigit():
+        return bvid, int(page)
+    return job, None
+
+
+class Backend:
+    """
+    Downloads one video at a time into `output_path`
+
+    Each worker owns its own backend instance, so `stop` only aborts the
+    download of that worker. A `stop` or a `pause` before the download
+    started applies to it as soon as it starts
+    """
+
+    name = None
+    # whether `download_batch` downloads many videos with one process
+    batched = False
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        # why the last download failed, such as `annie_exit` or `mux`, and
+        # its error output, classified by `failures.classify`
+        self.failure = None
+        self.message = None
+        self.stopped = False
+        self.paused = False
+
+    def download(self, bvid, on_progress=None):
+        """
+        Download a video, or one of its parts if `bvid` is a `part_job`,
+        return whether it succeeded and its size in bytes (None if unknown),
+        setting `failure` when it did not. The size is a future when the
+        video is still post-processed once downloaded.
+        `on_progress(done, total, percent)` is called with the bytes done
+        and total as the download goes
+        """
+        raise NotImplementedError
+
+    def download_batch(self, bvids, on_progress=None, on_result=None):
+        """
+        Download many videos one after another, calling
+        `on_result(bvid, ok, size)` once each video is done, with `failure`
+        and `message` set for it, and `on_progress(bvid, done, total, percent)` as they go.
+        Backends that are `batched` download them with a single process
+        """
+        for bvid in bvids:
+            report = on_progress and (
+                lambda done, total, percent, bvid=bvid: on_progress(
+                    bvid, done, total, percent
+                )
+            )
+            ok, size = self.download(bvid, report)
+            if on_result:
+                on_result(bvid, ok, size)
+
+    def partial_paths(self):
+        """files of the running download a later run can resume from"""
+        return []
+
+    def reset(self, paused=False):
+        """
+        Forget the last `stop` before the next download, which starts
+        suspended if `paused`
+        """
+        self.stopped = False
+        if paused:
+            self.pause()
+        else:
+            self.resume()
+
+    def stop(self):
+        """abort the running download"""
+        self.stopped = True
+
+    def pause(self):
+        """suspend the running download, keeping what it has done"""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+
+def backend_names():
+    return ["annie", "native"]
+
+
+def get_backend(name):
+    """return the backend class registered as `name`"""
+    if name == "annie":
+        from .annie import AnnieBackend
+
+        return AnnieBackend
+    if name == "native":
+        from .native import NativeBackend
+
+        return NativeBackend
+    raise ValueError(f"unknown backend: {name}")
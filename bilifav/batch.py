@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from .backend import DEFAULT_BACKEND
+from .concurrency import AdaptiveConcurrency
+from .index import DownloadIndex
+from .journal import Journal
+from .ordering import DEFAULT_ORDER
+from .postprocess import post
+from .progress import REPORT_INTERVAL, combine
+from .scheduler import FairQueue
+from .sync import MAX_JOBS, Sync, batch_videos
+from .worker import Worker
+
+
+class PoolWorker(Worker):
+    """worker of a `Batch`, downloading the videos of every favorite"""
+
+    def __init__(self, batch):
+        super(PoolWorker, self).__init__(
+            batch.queue,
+            None,
+            concurrency=batch.concurrency,
+            batch_size=batch.batch_size,
+            peers=batch.jobs,
+        )
+        self.batch = batch
+        # sync -> backend downloading its videos
+        self.backends = {}
+
+    def run(self):
+        while True:
+            self.acquire()
+            batch = self.queue.get_batch(self.batch_size, self.share())
+            if batch is None:
+                self.release()
+                break
+            lane, bvids = batch
+            sync = self.batch.syncs[lane]
+            if sync not in self.backends:
+                self.backends[sync] = sync.make_backend()
+            self.backend = self.backends[sync]
+            self.on_start = sync.start_slot
+            self.on_progress = sync.progress_slot
+            self.on_complete = sync.complete_slot
+            self.on_error = sync.error_slot
+            self.on_retry = sync.retry_slot
+            self.kind = None
+            self.process_batch(lane, bvids)
+            self.release(self.kind)
+
+
+class Batch:
+    """
+    Download the videos of many favorites into `output_path`
+
+    Every favorite is listed by its own `Sync`, but their videos go through
+    one `FairQueue` served by `jobs` shared workers, which take the videos
+    of the favorites in turn. The favorites share the index and the journal
+    of the output directory, like syncs run one after another.
+
+    `listings` optionally maps a favorite id to the data of its first
+    listing page, `store` is the content store shared by the favorites.
+    With `adaptive`, `jobs` is only the most workers, the number of videos
+    downloaded at the same time follows an `AdaptiveConcurrency`, and
+    `batch_size` is the most videos of a favorite a worker downloads with
+    one annie run, see `Worker`. Each favorite takes its videos in the
+    `order` of `ORDERS`, and retries them after `retry_delays`.
+    `on_progress(stats)` is called with the combined `ProgressStats` of the
+    favorites, `on_complete(media_id, bvid)` and `on_error(media_id, bvid)`
+    after each video, `on_retry(media_id, bvid)` when a video is put back
+    for a retry
+    """
+
+    def __init__(
+        self,
+        media_ids,
+        output_path,
+        jobs=MAX_JOBS,
+        backend=DEFAULT_BACKEND,
+        listings=None,
+        store=None,
+        adaptive=False,
+        batch_size=1,
+        order=DEFAULT_ORDER,
+        retry_delays=None,
+        on_progress=None,
+        on_complete=None,
+        on_error=None,
+        on_retry=None,
+    ):
+        self.output_path = output_path
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_error = on_error
+
+        self.queue = FairQueue(retry_delays)
+        self.jobs = max(1, jobs)
+        self.batch_size = batch_videos(backend, store, batch_size)
+        self.concurrency = AdaptiveConcurrency(self.jobs) if adaptive else None
+        # lane -> sync putting its videos into it
+        self.syncs = {}
+        self.index = None
+        self.journal = None
+        self.workers = self.make_workers()
+        self.reported = threading.Event()
+        self.stopped = False
+
+        listings = listings or {}
+        for media_id in media_ids:
+            data = listings.get(media_id)
+            Sync(
+                media_id,
+                output_path,
+                jobs=jobs,
+                backend=backend,
+                media_counts=data and data["info"]["media_count"],
+                first_page_medias=data and (data["medias"] or []),
+                on_complete=self.slot(on_complete, media_id),
+                on_error=self.slot(on_error, media_id),
+                on_retry=self.slot(on_retry, media_id),
+                batch=self,
+                store=store,
+                order=order,
+            )
+        # favorites that failed
+        self.failed = set()
+
+    def make_workers(self):
+        return [PoolWorker(self) for _ in range(self.jobs)]
+
+    def start_workers(self):
+        for t in self.workers:
+            t.start()
+
+    def join_workers(self):
+        for t in self.workers:
+            t.join()
+
+    def lane(self, sync):
+        """return the queue `sync` puts its videos into"""
+        lane = self.queue.lane()
+        self.syncs[lane] = sync
+        return lane
+
+    @staticmethod
+    def slot(callback, media_id):
+        if callback is None:
+            return None
+        return lambda bvid: callback(media_id, bvid)
+
+    def run(self):
+        """download every favorite, return whether every video succeeded"""
+        os.makedirs(self.output_path, exist_ok=True)
+        self.index = DownloadIndex(self.output_path)
+        self.journal = Journal(self.output_path)
+        try:
+            return self.download()
+        finally:
+            self.journal.compact()
+            self.journal.close()
+            self.index.close()
+            post.close()
+
+    def download(self):
+        self.start_workers()
+        reporter = threading.Thread(target=self.report, daemon=True)
+        reporter.start()
+
+        # list the favorites at the same time, their videos are queued as
+        # soon as their pages arrive
+        feeders = [
+            threading.Thread(target=self.run_sync, args=(sync,), daemon=True)
+            for sync in self.syncs.values()
+        ]
+        for t in feeders:
+            t.start()
+        for t in feeders:
+            t.join()
+
+        # every lane is drained, let the workers exit
+        self.queue.close()
+        self.join_workers()
+        self.reported.set()
+        reporter.join()
+        return not self.failed and not self.stopped
+
+    def run_sync(self, sync):
+        try:
+            ok = sync.run()
+        except Exception as e:
+            print(f"{sync.media_id}: {e}")
+            ok = False
+        finally:
+            # a sync that failed before queueing anything
+            sync.queue.close()
+        if not ok:
+            self.failed.add(sync.media_id)
+
+    def listed(self):
+        """the syncs whose favorite size is known"""
+        return [s for s in self.syncs.values() if s.media_counts is not None]
+
+    def report(self):
+        while True:
+            done = self.reported.wait(REPORT_INTERVAL)
+            if self.on_progress:
+                self.on_progress(
+                    combine(
+                        [s.progress.snapshot(s.total_counts()) for s in self.listed()]
+                    )
+                )
+            if done:
+                break
+
+    def stop(self):
+        """drop the queued videos and abort the running downloads"""
+        self.stopped = True
+        for sync in self.syncs.values():
+            sync.stop()
+        self.queue.close()
+
+    def pause(self):
+        """
+        Hand out no more videos and suspend the running downloads of every
+        favorite until `resume`, keeping what they downloaded
+        """
+        self.queue.pause()
+        for t in self.workers:
+            t.pause()
+
+    def resume(self):
+        for t in self.workers:
+            t.resume()
+        self.queue.resume()
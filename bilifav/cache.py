@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+# on-disk cache of listing pages and thumbnails
+CACHE_SIZE = 64 * 1024 * 1024
+# seconds a cached listing page stays fresh
+CACHE_TTL = 600
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "bili-favorite-downloader")
+
+
+class DiskCache:
+    """
+    Size-bounded LRU cache of bytes on disk
+
+    Every entry is a file named by the hash of its key, its mtime is when it
+    was stored (checked against the ttl) and its atime when it was last used
+    (the least recently used entries are evicted first). The directory,
+    `cache_dir()` by default, is only created and scanned on first use
+    """
+
+    def __init__(self, path=None, max_bytes=CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # entry name -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.loaded = False
+
+    def load(self):
+        """create the directory and find the entries in it, the lock is held"""
+        if self.loaded:
+            return
+        if self.path is None:
+            self.path = cache_dir()
+        os.makedirs(self.path, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                found.append((st.st_atime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        self.loaded = True
+
+    def get(self, key, ttl=None):
+        """return the cached bytes, None if missing or older than `ttl` seconds"""
+        name = sha1(key.encode()).hexdigest()
+        with self.lock:
+            self.load()
+            if name not in self.entries:
+                return None
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+                now = time.time()
+                if ttl is not None and now - st.st_mtime > ttl:
+                    return None
+                with open(path, "rb") as f:
+                    data = f.read()
+                # mark as recently used, keep the store time
+                os.utime(path, (now, st.st_mtime))
+            except OSError:
+                self.size -= self.entries.pop(name, 0)
+                return None
+            self.entries.move_to_end(name)
+            return data
+
+    def put(self, key, data):
+        name = sha1(key.encode()).hexdigest()
+        with self.lock:
+            self.load()
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with self.lock:
+            os.replace(tmp, os.path.join(self.path, name))
+            self.size += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            # evict the least recently used entries
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(os.path.join(self.path, old))
+                except OSError:
+                    pass
+
+
+# shared by every sync in the process
+cache = DiskCache()
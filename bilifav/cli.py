@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from .api import expand_favorites, parse_media_id, parse_space_id
+from .backend import DEFAULT_BACKEND, backend_names
+from .batch import Batch
+from .cluster import (
+    COORDINATOR_HOST,
+    COORDINATOR_PORT,
+    LEASE_TIME,
+    Coordinator,
+    WorkerNode,
+)
+from .failures import RETRY_DELAYS, Failure, parse_retry_delays
+from .index import INDEX_NAME, DownloadIndex
+from .metrics import METRICS_INTERVAL, metrics
+from .ordering import DEFAULT_ORDER, order_names
+from .postprocess import POST_JOBS, TRANSCODES, post
+from .processes import reaper
+from .progress import describe
+from .ratelimit import limiter, parse_rate, parse_schedule
+from .store import ContentStore
+from .sync import MAX_JOBS, Sync
+
+
+def run_task(task):
+    """
+    Run a `Sync`, a `Batch` or a `WorkerNode`, stopping its downloads on
+    Ctrl-C. Ctrl-Z pauses them before the process is suspended, they run in
+    process groups of their own the shell does not suspend
+    """
+    suspendable = (
+        hasattr(signal, "SIGTSTP")
+        and threading.current_thread() is threading.main_thread()
+    )
+    if suspendable:
+
+        def suspend(signum, frame):
+            task.pause()
+            signal.signal(signal.SIGTSTP, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTSTP)
+            # continued by the shell
+            signal.signal(signal.SIGTSTP, suspend)
+            task.resume()
+
+        previous = signal.signal(signal.SIGTSTP, suspend)
+    try:
+        return task.run()
+    except KeyboardInterrupt:
+        task.stop()
+        raise
+    finally:
+        if suspendable:
+            signal.signal(signal.SIGTSTP, previous)
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def sync(media_id, output_path, **options):
+    """
+    Sync a favorite, printing the progress, return whether it succeeded,
+    `options` are passed to `Sync`
+    """
+
+    def progress(stats):
+        sys.stderr.write(f"\r[{stats.percent:3d}%] {media_id}: {describe(stats)}  ")
+        sys.stderr.flush()
+
+    task = Sync(media_id, output_path, on_progress=progress, **options)
+    start = time.time()
+    try:
+        ok = run_task(task)
+    except Exception as e:
+        print(f"{media_id}: {e}", file=sys.stderr)
+        return False
+    sys.stderr.write("\n")
+    summary(task, time.time() - start)
+    return ok
+
+
+def sync_batch(media_ids, output_path, task_class=Batch, **options):
+    """
+    Sync many favorites through one download queue, like `sync`, the queue
+    is served by `task_class`, a `Batch` or a `Coordinator`
+    """
+
+    def progress(stats):
+        sys.stderr.write(
+            f"\r[{stats.percent:3d}%] {len(media_ids)} favorites: {describe(stats)}  "
+        )
+        sys.stderr.flush()
+
+    task = task_class(media_ids, output_path, on_progress=progress, **options)
+    start = time.time()
+    ok = run_task(task)
+    sys.stderr.write("\n")
+    for sync_task in task.syncs.values():
+        summary(sync_task, time.time() - start)
+    return ok
+
+
+def summary(task, elapsed):
+    failed = task.queue.failed
+    print(
+        f"{task.media_id}: {task.queue.finished - failed} downloaded, "
+        f"{failed} failed, {task.skipped} skipped, {task.linked} linked, "
+        f"{task.unavailable} unavailable, {task.retries} retries in {elapsed:.1f}s"
+    )
+    for bvid, failure in task.missing.items():
+        print(f"  missing: {bvid} ({failure_text(failure)})")
+
+
+def failure_text(failure):
+    text = failure.kind
+    if failure.attempts:
+        text += f" after {failure.attempts} attempts"
+    if failure.message:
+        # the last line of the error output
+        text += ": " + failure.message.strip().splitlines()[-1]
+    return text
+
+
+def sync_all(favorites, output_path, **options):
+    """sync favorite ids or URLs, expanding the space URLs"""
+    try:
+        media_ids = expand_favorites(favorites)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return False
+    if len(media_ids) == 1:
+        return sync(media_ids[0], output_path, **options)
+    return sync_batch(media_ids, output_path, **options)
+
+
+def sync_options(args):
+    """options of `Sync` and `Batch` given on the command line"""
+    options = {
+        "jobs": args.jobs,
+        "backend": args.backend,
+        "store": ContentStore(args.store) if args.store else None,
+        "adaptive": args.adaptive,
+    }
+    # a worker leases its videos one at a time, in the order of the
+    # coordinator, which retries them
+    for name in ("batch_size", "order", "retry_delays"):
+        if name in args:
+            options[name] = getattr(args, name)
+    return options
+
+
+def cmd_sync(args):
+    return 0 if sync_all(args.favorites, args.output, **sync_options(args)) else 1
+
+
+def cmd_daemon(args):
+    options = sync_options(args)
+    while True:
+        try:
+            # expanded every time, to pick up the favorites created since
+            sync_all(args.favorites, args.output, **options)
+        except Exception as e:
+            # a network outage or a broken favorite, tried again next pass
+            print(f"sync failed: {e}", file=sys.stderr)
+        time.sleep(args.interval)
+
+
+def cmd_coordinator(args):
+    try:
+        media_ids = expand_favorites(args.favorites)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"serving {len(media_ids)} favorites at http://{args.host}:{args.port}")
+    try:
+        ok = sync_batch(
+            media_ids,
+            args.output,
+            task_class=Coordinator,
+            host=args.host,
+            port=args.port,
+            lease_time=args.lease_time,
+            order=args.order,
+            retry_delays=args.retry_delays,
+        )
+    except OSError as e:
+        # the port is taken, most of the time
+        print(e, file=sys.stderr)
+        return 1
+    return 0 if ok else 1
+
+
+def cmd_worker(args):
+    def complete(bvid, size):
+        print(f"{bvid}: downloaded")
+
+    def error(bvid, failure):
+        print(f"{bvid}: failed ({failure_text(failure)})")
+
+    task = WorkerNode(
+        args.coordinator,
+        args.output,
+        on_complete=complete,
+        on_error=error,
+        **sync_options(args),
+    )
+    run_task(task)
+    return 0
+
+
+def cmd_missing(args):
+    """print the videos on the dead-letter list of the output directory"""
+    if not os.path.exists(os.path.join(args.output, INDEX_NAME)):
+        print(f"{args.output}: nothing synced there", file=sys.stderr)
+        return 1
+    try:
+        media_ids = expand_favorites(args.favorites) if args.favorites else [None]
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    index = DownloadIndex(args.output)
+    try:
+        if args.clear:
+            n = sum(index.clear_dead_letters(media_id) for media_id in media_ids)
+            print(f"{n} videos forgotten, the next sync tries them again")
+            return 0
+        for media_id in media_ids:
+            for letter in index.dead_letters(media_id):
+                failure = Failure(*(letter[key] for key in Failure._fields))
+                print(f"{letter['media_id']} {letter['bvid']}: {failure_text(failure)}")
+    finally:
+        index.close()
+    return 0
+
+
+def watch_limit_file(path, interval=1):
+    """apply the rate written in `path` whenever the file changes"""
+    mtime = None
+    while True:
+        try:
+            stamp = os.path.getmtime(path)
+            if stamp != mtime:
+                mtime = stamp
+                with open(path) as f:
+                    limiter.set_rate(parse_rate(f.read()))
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+        time.sleep(interval)
+
+
+def apply_limits(args):
+    limiter.set_rate(args.limit)
+    limiter.set_job_rate(args.job_limit)
+    limiter.set_schedule(args.schedule)
+    if args.limit_file:
+        threading.Thread(
+            target=watch_limit_file, args=(args.limit_file,), daemon=True
+        ).start()
+
+
+def write_metrics(path, interval=METRICS_INTERVAL):
+    """keep writing the metrics to `path`"""
+    while True:
+        time.sleep(interval)
+        try:
+            metrics.write(path)
+        except OSError as e:
+            print(f"{path}: {e}", file=sys.stderr)
+
+
+def apply_metrics(args):
+    if args.trace:
+        metrics.set_trace(args.trace)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        threading.Thread(
+            target=write_metrics, args=(args.metrics_file,), daemon=True
+        ).start()
+
+
+def rate_arg(text):
+    try:
+        return parse_rate(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def schedule_arg(text):
+    try:
+        return parse_schedule(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def retry_delays_arg(text):
+    try:
+        return parse_retry_delays(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def favorite_arg(text):
+    """a favorite id or URL, or a space URL kept for `expand_favorites`"""
+    if parse_space_id(text):
+        return text
+    try:
+        return parse_media_id(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bilifav", description="Download Bilibili favorites"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = commands.add_parser("sync", help="download favorites once")
+    sync_parser.add_argument(
+        "favorites",
+        nargs="+",
+        type=favorite_arg,
+        help="favorite ids or URLs, or space.bilibili.com/<mid>/favlist URLs "
+        "for every favorite of a user",
+    )
+    sync_parser.set_defaults(func=cmd_sync)
+
+    daemon_parser = commands.add_parser(
+        "daemon", help="keep favorites in sync, checking them periodically"
+    )
+    daemon_parser.add_argument(
+        "favorites",
+        nargs="+",
+        type=favorite_arg,
+        help="favorite ids or URLs, or space URLs",
+    )
+    daemon_parser.add_argument(
+        "--interval",
+        type=float,
+        default=3600,
+        help="seconds between two syncs (default: %(default)s)",
+    )
+    daemon_parser.set_defaults(func=cmd_daemon)
+
+    coordinator_parser = commands.add_parser(
+        "coordinator", help="lease the videos of favorites to workers over HTTP"
+    )
+    coordinator_parser.add_argument(
+        "favorites",
+        nargs="+",
+        type=favorite_arg,
+        help="favorite ids or URLs, or space URLs",
+    )
+    coordinator_parser.add_argument(
+        "--host",
+        default=COORDINATOR_HOST,
+        help="address to listen on, 0.0.0.0 for workers on other machines "
+        "(default: %(default)s)",
+    )
+    coordinator_parser.add_argument(
+        "--port", type=int, default=COORDINATOR_PORT, help="(default: %(default)s)"
+    )
+    coordinator_parser.add_argument(
+        "--lease-time",
+        type=float,
+        default=LEASE_TIME,
+        help="seconds before the video of a silent worker is given to another "
+        "one (default: %(default)s)",
+    )
+    coordinator_parser.set_defaults(func=cmd_coordinator)
+
+    worker_parser = commands.add_parser(
+        "worker", help="download the videos leased by a coordinator"
+    )
+    worker_parser.add_argument(
+        "coordinator", help="URL of the coordinator, such as http://host:8360"
+    )
+    worker_parser.set_defaults(func=cmd_worker)
+
+    missing_parser = commands.add_parser(
+        "missing", help="list the videos the syncs gave up on, and why"
+    )
+    missing_parser.add_argument(
+        "favorites",
+        nargs="*",
+        type=favorite_arg,
+        help="favorite ids or URLs, or space URLs (default: every favorite)",
+    )
+    missing_parser.add_argument(
+        "-o", "--output", default="videos", help="output directory"
+    )
+    missing_parser.add_argument(
+        "--clear",
+        action="store_true",
+        help="forget them, so that the next sync tries the unavailable ones again",
+    )
+    missing_parser.set_defaults(func=cmd_missing)
+
+    for p in (sync_parser, daemon_parser, coordinator_parser, worker_parser):
+        p.add_argument("-o", "--output", default="videos", help="output directory")
+        p.add_argument(
+            "--metrics-file",
+            help="file the metrics are written to in the Prometheus text format, "
+            f"every {METRICS_INTERVAL}s and on exit",
+        )
+        p.add_argument(
+            "--metrics-port",
+            type=int,
+            help="serve the metrics at http://localhost:PORT/metrics",
+        )
+        p.add_argument(
+            "--trace", help="file the timing of every stage is appended to (JSON)"
+        )
+
+    # the coordinator downloads nothing itself
+    for p in (sync_parser, daemon_parser, worker_parser):
+        p.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=MAX_JOBS,
+            help="videos downloaded at the same time (default: %(default)s)",
+        )
+        p.add_argument(
+            "--adaptive",
+            action="store_true",
+            help="find the number of videos downloaded at the same time, up to "
+            "--jobs, backing off when bilibili throttles the downloads",
+        )
+        p.add_argument(
+            "-b",
+            "--backend",
+            choices=backend_names(),
+            default=DEFAULT_BACKEND,
+            help="downloader: an annie process per video, or native in-process "
+            "range requests muxed with ffmpeg (default: %(default)s)",
+        )
+        p.add_argument(
+            "--store",
+            help="content store shared by output directories: videos are "
+            "downloaded into it once and hardlinked into the output directory",
+        )
+        p.add_argument(
+            "--limit",
+            type=rate_arg,
+            help="bandwidth limit of all downloads together, such as 2M (bytes/s)",
+        )
+        p.add_argument(
+            "--job-limit", type=rate_arg, help="bandwidth limit of each download"
+        )
+        p.add_argument(
+            "--schedule",
+            type=schedule_arg,
+            default=[],
+            help="bandwidth limits by time of day, overriding --limit, "
+            "such as 09:00-18:00=1M,18:00-09:00=off",
+        )
+        p.add_argument(
+            "--limit-file",
+            help="file holding the bandwidth limit, re-read when it changes",
+        )
+        p.add_argument(
+            "--post-jobs",
+            type=int,
+            default=POST_JOBS,
+            help="processes muxing the downloaded streams of the native backend, "
+            "0 to mux in the download slot (default: one per core)",
+        )
+        p.add_argument(
+            "--transcode",
+            choices=sorted(TRANSCODES),
+            help="transcode the videos of the native backend to this codec",
+        )
+        p.add_argument(
+            "--embed",
+            action="store_true",
+            help="embed the cover and the title into the videos of the native backend",
+        )
+
+    for p in (sync_parser, daemon_parser, coordinator_parser):
+        p.add_argument(
+            "--order",
+            choices=order_names(),
+            default=DEFAULT_ORDER,
+            help="order the queued videos are downloaded in: as listed, the "
+            "shortest first for the most videos per hour, the largest first so "
+            "that no long video is left alone at the end, or the newest "
+            "favorites first (default: %(default)s)",
+        )
+        p.add_argument(
+            "--retry-delays",
+            type=retry_delays_arg,
+            default=RETRY_DELAYS,
+            help="seconds before the first retry of a video that failed, doubled "
+            "after each one, for every kind or by kind such as "
+            "throttled=60,network=2 (default: "
+            + ",".join(f"{kind}={delay}" for kind, delay in RETRY_DELAYS.items())
+            + ")",
+        )
+
+    for p in (sync_parser, daemon_parser):
+        p.add_argument(
+            "--batch-size",
+            type=int,
+            default=1,
+            help="most videos downloaded by one annie run, fewer when few are "
+            "left, saving the start of annie for favorites of short videos "
+            "(default: %(default)s)",
+        )
+
+    args = parser.parse_args(argv)
+    if "limit" in args:
+        apply_limits(args)
+        post.configure(args.post_jobs, args.transcode, args.embed)
+    if "trace" in args:
+        apply_metrics(args)
+    # terminated like with Ctrl-C, so that the downloads are stopped too
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        return args.func(args)
+    except KeyboardInterrupt:
+        # the stopped downloads exit, or are killed
+        reaper.wait()
+        return 130
+    finally:
+        if getattr(args, "metrics_file", None):
+            metrics.write(args.metrics_file)
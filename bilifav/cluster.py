@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .backend import DEFAULT_BACKEND, get_backend
+from .batch import Batch
+from .concurrency import AdaptiveConcurrency
+from .failures import Failure, classify
+from .metrics import metrics
+from .postprocess import post
+from .sync import MAX_JOBS, make_backend
+from .worker import Worker, finish_job, record_job
+
+# default address of the coordinator
+COORDINATOR_HOST = "127.0.0.1"
+COORDINATOR_PORT = 8360
+# seconds a leased video stays assigned to a worker without a heartbeat
+LEASE_TIME = 60
+# seconds a worker waits at most for a video in one lease request
+LEASE_POLL = 10
+# attempts of a worker to reach the coordinator before giving up
+CLIENT_RETRIES = 5
+CLIENT_BACKOFF = 1
+
+
+class Lease:
+    """video leased to a remote worker, in the worker list of its sync"""
+
+    def __init__(self, lane, bvid, worker, lease_time):
+        self.id = uuid.uuid4().hex
+        self.lane = lane
+        self.bvid = bvid
+        self.worker = worker
+        self.lease_time = lease_time
+        self.expires = time.monotonic() + lease_time
+        self.start = time.perf_counter()
+        # the video is downloaded elsewhere, `stop` is passed on by the
+        # answer to the next heartbeat
+        self.backend = self
+        self.cancelled = False
+
+    def renew(self):
+        self.expires = time.monotonic() + self.lease_time
+
+    def partial_paths(self):
+        return []
+
+    def stop(self):
+        self.cancelled = True
+
+    def pause(self):
+        # the leased video finishes, the queue leases no other one
+        pass
+
+    def resume(self):
+        pass
+
+
+class Coordinator(Batch):
+    """
+    Lease the videos of many favorites to workers on other machines
+
+    The favorites are listed and queued like in a `Batch`, but the videos
+    are downloaded by `WorkerNode`s, which ask for them over HTTP at
+    http://host:port. A video is leased to a worker for `lease_time`
+    seconds, renewed by the heartbeats the worker sends while downloading
+    it. A lease that expires, because its worker died or lost the network,
+    is put back first in line for another worker, and a late result of an
+    expired lease is refused, so that every video is counted once. A video
+    that failed for a transient reason is leased again after its backoff.
+
+    The coordinator keeps the index and the journal of `output_path`, the
+    videos stay where the workers download them
+    """
+
+    def __init__(
+        self,
+        media_ids,
+        output_path,
+        host=COORDINATOR_HOST,
+        port=COORDINATOR_PORT,
+        lease_time=LEASE_TIME,
+        **options,
+    ):
+        self.host = host
+        self.port = port
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        # lease id -> Lease
+        self.leases = {}
+        self.server = None
+        # set once every video is finished, the workers are told to exit
+        self.done = threading.Event()
+        super(Coordinator, self).__init__(media_ids, output_path, **options)
+
+    def make_workers(self):
+        # the running leases, updated in place since the syncs share it
+        return []
+
+    def start_workers(self):
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                handler = coordinator.routes().get(self.path)
+                if handler is None:
+                    self.send_error(404)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self.send_error(400)
+                    return
+                status, reply = handler(request)
+                body = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.reap, daemon=True).start()
+
+    def join_workers(self):
+        self.done.set()
+        # answer the pending lease requests before going away
+        time.sleep(0.5)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def routes(self):
+        return {
+            "/lease": self.lease,
+            "/heartbeat": self.heartbeat,
+            "/complete": self.complete,
+        }
+
+    def lease(self, request):
+        job = self.queue.get(LEASE_POLL)
+        if job is None:
+            # closed, hold the worker until it can be told to exit
+            if self.queue.closed:
+                self.done.wait(LEASE_POLL)
+            return 200, {"job": None, "done": self.done.is_set()}
+        lane, bvid = job
+        lease = Lease(lane, bvid, request.get("worker"), self.lease_time)
+        with self.lock:
+            self.leases[lease.id] = lease
+            self.workers.append(lease)
+        metrics.inc("bilifav_leases_total")
+        self.syncs[lane].start_slot(bvid)
+        return 200, {
+            "lease": lease.id,
+            "job": bvid,
+            "media_id": self.syncs[lane].media_id,
+            "lease_time": self.lease_time,
+        }
+
+    def heartbeat(self, request):
+        with self.lock:
+            lease = self.leases.get(request.get("lease"))
+            if lease is not None:
+                lease.renew()
+        if lease is None:
+            # expired and leased again
+            return 409, {}
+        if request.get("total") is not None:
+            self.syncs[lease.lane].progress_slot(
+                lease.bvid, request["done"], request["total"], request["percent"]
+            )
+        return 200, {"cancel": lease.cancelled}
+
+    def complete(self, request):
+        with self.lock:
+            lease = self.leases.pop(request.get("lease"), None)
+            if lease is not None:
+                self.workers.remove(lease)
+        if lease is None:
+            return 409, {}
+        ok = bool(request.get("ok"))
+        failure = None if ok else request.get("failure") or "unknown"
+        size = request.get("size")
+        record_job(ok, size, failure, time.perf_counter() - lease.start)
+        self.finish(lease, ok, size, failure, request.get("message"))
+        return 200, {}
+
+    def finish(self, lease, ok, size=None, failure=None, message=None):
+        """count the video of `lease` as finished or retry it, like a `Worker`"""
+        sync = self.syncs[lease.lane]
+        finish_job(
+            lease.lane,
+            lease.bvid,
+            ok,
+            size,
+            failure,
+            message,
+            (sync.complete_slot, sync.error_slot, sync.retry_slot),
+        )
+
+    def reap(self):
+        """put back the videos of the expired leases"""
+        while not self.done.wait(min(self.lease_time / 4, 1)):
+            now = time.monotonic()
+            with self.lock:
+                expired = [l for l in self.leases.values() if l.expires < now]
+                for lease in expired:
+                    del self.leases[lease.id]
+                    self.workers.remove(lease)
+            for lease in expired:
+                metrics.inc("bilifav_leases_expired_total")
+                sync = self.syncs[lease.lane]
+                if sync.stopped:
+                    self.finish(lease, False, failure="stopped")
+                    continue
+                print(f"{lease.bvid}: lease of {lease.worker} expired, requeued")
+                sync.progress.remove(lease.bvid)
+                self.queue.requeue(lease.lane, lease.bvid)
+
+
+class Client:
+    """JSON over HTTP client of a coordinator"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def post(self, path, request):
+        """
+        Return the status and the reply of the coordinator, retrying while
+        it cannot be reached
+        """
+        data = json.dumps(request).encode()
+        for attempt in range(CLIENT_RETRIES):
+            req = urllib.request.Request(
+                self.url + path,
+                data=data,
+                headers={"Content-Type": "application/json"},
+                method="POST",
+            )
+            try:
+                with urllib.request.urlopen(req, timeout=LEASE_POLL * 2) as r:
+                    return r.status, json.loads(r.read())
+            except urllib.error.HTTPError as e:
+                if e.code < 500:
+                    return e.code, {}
+                error = e
+            except (OSError, ValueError) as e:
+                error = e
+            if attempt < CLIENT_RETRIES - 1:
+                time.sleep(CLIENT_BACKOFF * 2**attempt)
+        raise error
+
+
+class RemoteWorker(Worker):
+    """
+    Worker downloading the videos leased by a coordinator, sending a
+    heartbeat every third of the lease time while a video downloads.
+    Once `stop`ped, it leases no other video and its running one is not
+    reported, so that its lease expires and the video goes to another worker
+    """
+
+    def __init__(
+        self,
+        client,
+        backend,
+        name,
+        on_complete=None,
+        on_error=None,
+        concurrency=None,
+    ):
+        super(RemoteWorker, self).__init__(
+            None,
+            backend,
+            on_complete=on_complete,
+            on_error=on_error,
+            concurrency=concurrency,
+        )
+        self.client = client
+        self.name = name
+        self.on_progress = self.progress_slot
+        # bytes done, bytes total and percent of the video
+        self.latest = None
+        self.lost = False
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            self.acquire()
+            try:
+                status, reply = self.client.post("/lease", {"worker": self.name})
+            except Exception as e:
+                print(f"{self.client.url}: {e}")
+                status, reply = None, None
+            if status != 200:
+                if status is not None:
+                    print(f"{self.client.url}: lease refused ({status})")
+                self.release()
+                break
+            if reply["job"] is None:
+                self.release()
+                if reply["done"]:
+                    break
+                continue
+            self.kind = None
+            self.process_lease(reply)
+            self.release(self.kind)
+
+    def process_lease(self, lease):
+        self.bvid = lease["job"]
+        self.latest = None
+        self.lost = False
+        with self.lock:
+            if self.stopped:
+                # leased while stopping, left to expire
+                return
+            # the stop of the last lease
+            self.backend.reset(self.paused)
+        stopped = threading.Event()
+        beats = threading.Thread(target=self.beat, args=(lease, stopped), daemon=True)
+        beats.start()
+        start = time.perf_counter()
+        ok, size = self.download(self.bvid)
+        failure, message = self.backend.failure, self.backend.message
+        if isinstance(size, Future):
+            # the lease is held until the video is post-processed
+            ok, size, failure, message = self.settle(size)
+        record_job(ok, size, failure, time.perf_counter() - start)
+        # retried by the coordinator
+        self.kind = None if ok else classify(failure, message)
+        stopped.set()
+        beats.join()
+        bvid, self.bvid = self.bvid, None
+        if self.lost or self.stopped:
+            # leased to another worker meanwhile, or about to be
+            return
+        request = {
+            "lease": lease["lease"],
+            "ok": ok,
+            "size": size,
+            "failure": failure,
+            "message": message,
+        }
+        try:
+            status, _ = self.client.post("/complete", request)
+        except Exception as e:
+            print(f"{self.client.url}: {e}")
+            return
+        if status != 200:
+            return
+        if ok:
+            if self.on_complete:
+                self.on_complete(bvid, size)
+        elif self.on_error:
+            self.on_error(bvid, Failure(self.kind, failure, message, None))
+
+    def beat(self, lease, stopped):
+        while not stopped.wait(lease["lease_time"] / 3):
+            request = {"lease": lease["lease"]}
+            if self.latest is not None:
+                request.update(zip(("done", "total", "percent"), self.latest))
+            try:
+                status, reply = self.client.post("/heartbeat", request)
+            except Exception as e:
+                print(f"{self.client.url}: {e}")
+                continue
+            if status != 200 or reply.get("cancel"):
+                # expired or stopped, abort the download
+                self.lost = status != 200
+                self.backend.stop()
+                break
+
+    def progress_slot(self, bvid, done, total, percent):
+        self.latest = (done, total, percent)
+
+    def stop(self):
+        """abort the running download and lease no other video"""
+        with self.lock:
+            self.stopped = True
+            self.backend.stop()
+
+
+class WorkerNode:
+    """
+    Download the videos leased by the coordinator at `url` into
+    `output_path`, `jobs` at the same time
+
+    With `adaptive`, `jobs` is only the most workers, see `Sync`.
+    `on_complete(bvid, size)` and `on_error(bvid, failure)` are called after
+    each video, from the worker threads, a failed video may be leased again
+    by the coordinator
+    """
+
+    def __init__(
+        self,
+        url,
+        output_path,
+        jobs=MAX_JOBS,
+        backend=DEFAULT_BACKEND,
+        store=None,
+        adaptive=False,
+        on_complete=None,
+        on_error=None,
+    ):
+        self.client = Client(url)
+        self.output_path = output_path
+        self.backend = get_backend(backend)
+        self.store = store
+        name = f"{socket.gethostname()}-{os.getpid()}"
+        concurrency = AdaptiveConcurrency(jobs) if adaptive else None
+        self.workers = [
+            RemoteWorker(
+                self.client,
+                make_backend(self.backend, self.output_path, store),
+                f"{name}-{i}",
+                on_complete=on_complete,
+                on_error=on_error,
+                concurrency=concurrency,
+            )
+            for i in range(max(1, jobs))
+        ]
+
+    def run(self):
+        """download until the coordinator has no more videos"""
+        os.makedirs(self.output_path, exist_ok=True)
+        for t in self.workers:
+            t.start()
+        try:
+            for t in self.workers:
+                t.join()
+        finally:
+            # the videos still muxed are finished before the worker exits
+            post.close()
+
+    def stop(self):
+        """abort the running downloads and lease no more videos, the leases expire"""
+        for t in self.workers:
+            t.stop()
+
+    def pause(self):
+        """
+        Suspend the running downloads, and the ones of the next leases,
+        until `resume`. The heartbeats go on, so that the leases are kept
+        """
+        for t in self.workers:
+            t.pause()
+
+    def resume(self):
+        for t in self.workers:
+            t.resume()
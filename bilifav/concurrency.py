@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from .failures import ERROR, NETWORK, THROTTLED
+from .metrics import metrics
+
+# seconds of downloads measured before the target is raised
+ADJUST_INTERVAL = 5
+# relative gain of throughput worth another job
+MIN_GAIN = 0.05
+# share of the target kept after a throttling signal
+BACKOFF = 0.5
+# kinds of failures that are a sign of throttling, the other ones are the
+# fault of the video or of this machine
+THROTTLE_KINDS = {THROTTLED, NETWORK, ERROR}
+
+
+def throttle_reason(kind):
+    """the throttling signal of a failed download, None if it is not one"""
+    return kind if kind in THROTTLE_KINDS else None
+
+
+class AdaptiveConcurrency:
+    """
+    Number of videos downloaded at the same time, sized by AIMD
+
+    Workers take a slot with `acquire` before each video and give it back
+    with `release`. Every `ADJUST_INTERVAL` seconds the throughput of the
+    finished interval is compared with the one before: the target grows by
+    one job while it keeps improving, and the last job is taken back when
+    it made things worse. A throttling signal, a download refused by
+    bilibili, a network error or a failure of unknown kind, halves the
+    target at once, at most once per interval. The target and the reason
+    of each change go to the metrics
+    """
+
+    def __init__(self, maximum, minimum=1, start=2):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.target = max(min(start, self.maximum), minimum)
+        self.lock = threading.Lock()
+        self.has_slot = threading.Condition(self.lock)
+        self.running = 0
+        # bytes downloaded in the current interval, and when it began
+        self.bytes = 0
+        self.since = time.monotonic()
+        # throughput of the last interval, and whether it ended with a raise
+        self.rate = 0.0
+        self.raised = False
+        # no backing off again before this time
+        self.calm = 0.0
+        metrics.set("bilifav_concurrency_target", self.target)
+
+    def acquire(self):
+        with self.lock:
+            while self.running >= self.target:
+                self.has_slot.wait()
+            self.running += 1
+
+    def release(self, kind=None):
+        """give back a slot, `kind` is the kind of failure of the video or None"""
+        reason = throttle_reason(kind)
+        with self.lock:
+            self.running -= 1
+            if reason:
+                self.back_off(reason)
+            self.has_slot.notify()
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+            now = time.monotonic()
+            if now - self.since >= ADJUST_INTERVAL:
+                self.adjust(self.bytes / (now - self.since))
+                self.bytes = 0
+                self.since = now
+
+    def adjust(self, rate):
+        """end an interval at `rate` bytes/s, the lock is held"""
+        if self.raised and rate < self.rate * (1 - MIN_GAIN):
+            # the last job added slowed the downloads down
+            self.set_target(self.target - 1, "no_gain")
+            self.raised = False
+        elif rate > self.rate * (1 + MIN_GAIN) and self.running >= self.target:
+            # every slot is busy and the throughput still grows
+            self.raised = self.set_target(self.target + 1, "throughput")
+        else:
+            self.raised = False
+        self.rate = rate
+
+    def back_off(self, reason):
+        now = time.monotonic()
+        if now < self.calm:
+            # a burst of failures counts once
+            return
+        self.calm = now + ADJUST_INTERVAL
+        self.set_target(int(self.target * BACKOFF), reason)
+        self.raised = False
+        # measure the new target from scratch
+        self.rate = 0.0
+        self.bytes = 0
+        self.since = now
+
+    def set_target(self, target, reason):
+        """return whether the target changed, the lock is held"""
+        target = max(self.minimum, min(target, self.maximum))
+        if target == self.target:
+            return False
+        direction = "up" if target > self.target else "down"
+        self.target = target
+        metrics.set("bilifav_concurrency_target", target)
+        metrics.inc(
+            "bilifav_concurrency_changes_total", direction=direction, reason=reason
+        )
+        self.has_slot.notify_all()
+        return True
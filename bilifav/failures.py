@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import re
+from collections import namedtuple
+
+# kinds of failures of a video
+THROTTLED = "throttled"
+NETWORK = "network"
+# deleted, hidden or region-locked
+UNAVAILABLE = "unavailable"
+DISK = "disk"
+# aborted on purpose, resumed by the next run
+STOPPED = "stopped"
+ERROR = "error"
+
+# kinds retried in the same run -> seconds before the first retry, doubled
+# after each one
+RETRY_DELAYS = {THROTTLED: 30, NETWORK: 5, ERROR: 5}
+# retries of a video before it is put on the dead-letter list
+RETRIES = 3
+# kinds of the dead letters that later syncs skip, the other ones are
+# tried again by the next sync
+PERMANENT = {UNAVAILABLE}
+
+# why a video failed: its kind, the failure code of the backend, such as
+# `annie_exit`, the error output and the attempts made
+Failure = namedtuple("Failure", "kind reason message attempts")
+
+# the first kind whose pattern matches the failure code or the error output
+PATTERNS = [
+    (
+        DISK,
+        r"no space left|disk quota|read-only file system|permission denied|"
+        r"\bENOSPC\b|\bEDQUOT\b|\bEROFS\b",
+    ),
+    (
+        UNAVAILABLE,
+        r"HTTP 404\b|404 not found|code (-404|62002|62004|62012|-10403)\b|"
+        r"啥都木有|稿件不可见|地区|region|not available|deleted",
+    ),
+    (
+        THROTTLED,
+        r"HTTP (412|429)\b|code (-412|-509|-799)\b|too many requests|"
+        r"precondition failed|请求过于频繁|请求被拦截",
+    ),
+    (
+        NETWORK,
+        r"time(d)? ?out|connection (reset|refused|aborted)|reset by peer|"
+        r"broken pipe|\bEOF\b|no such host|name resolution|name or service|"
+        r"network is unreachable|handshake|RemoteDisconnected|IncompleteRead|"
+        r"URLError|ConnectionError",
+    ),
+]
+PATTERNS = [(kind, re.compile(pattern, re.I)) for kind, pattern in PATTERNS]
+
+
+def classify(reason, message=None):
+    """the kind of a failure from the failure code of the backend and its output"""
+    if reason in ("stopped", "killed"):
+        return STOPPED
+    text = f"{reason or ''}\n{message or ''}"
+    for kind, pattern in PATTERNS:
+        if pattern.search(text):
+            return kind
+    return ERROR
+
+
+def retry_delay(kind, attempts, delays=None):
+    """
+    Seconds before a video that failed `attempts` times, the last time with
+    `kind`, is tried again, None if it is not. `delays` maps the kinds to
+    the first delay, `RETRY_DELAYS` by default
+    """
+    delays = RETRY_DELAYS if delays is None else delays
+    if kind not in delays or attempts > RETRIES:
+        return None
+    return delays[kind] * 2 ** (attempts - 1)
+
+
+def parse_retry_delays(text):
+    """
+    Parse the first retry delays such as `throttled=60,network=2`, the
+    kinds left out keep their default, or a number of seconds for every
+    kind retried
+    """
+    text = text.strip()
+    try:
+        return dict.fromkeys(RETRY_DELAYS, float(text))
+    except ValueError:
+        pass
+    delays = dict(RETRY_DELAYS)
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        kind, _, seconds = part.partition("=")
+        kind = kind.strip()
+        if kind not in RETRY_DELAYS:
+            raise ValueError(f"not a retried kind: {kind}")
+        try:
+            delays[kind] = float(seconds)
+        except ValueError:
+            raise ValueError(f"not a delay: {part}")
+    return delays
+
+
+def error_text(e):
+    """the error output of an exception, with the code of an API error"""
+    text = f"{type(e).__name__}: {e}"
+    status = getattr(e, "status", None)
+    if status is not None:
+        text += f" (code {status})"
+    return text
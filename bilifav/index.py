@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+
+# download index kept in the output directory
+INDEX_NAME = ".favorites.db"
+
+
+class DownloadIndex:
+    """
+    Persistent record of the downloaded videos of each favorite
+
+    Kept in a SQLite database in the output directory, so that a later sync
+    skips the videos already downloaded and stops listing the favorite once
+    it reaches the videos favorited before the last sync. The videos a sync
+    gave up on are kept on a dead-letter list with the kind of their failure
+    until they are downloaded
+    """
+
+    def __init__(self, output_path):
+        self.lock = threading.Lock()
+        # shared by the annie workers, serialized by the lock
+        self.conn = sqlite3.connect(
+            os.path.join(output_path, INDEX_NAME), check_same_thread=False
+        )
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "media_id TEXT, bvid TEXT, title TEXT, fav_time INTEGER, "
+                "done INTEGER DEFAULT 0, size INTEGER, mtime INTEGER, "
+                "PRIMARY KEY (media_id, bvid))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS syncs ("
+                "media_id TEXT PRIMARY KEY, last_sync INTEGER)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letters ("
+                "media_id TEXT, bvid TEXT, kind TEXT, reason TEXT, message TEXT, "
+                "attempts INTEGER, mtime INTEGER, PRIMARY KEY (media_id, bvid))"
+            )
+
+    def execute(self, sql, args=()):
+        with self.lock, self.conn:
+            return self.conn.execute(sql, args).fetchall()
+
+    def last_sync(self, media_id):
+        """fav_time of the newest video seen by the last sync, 0 if never synced"""
+        rows = self.execute(
+            "SELECT last_sync FROM syncs WHERE media_id = ?", (str(media_id),)
+        )
+        return rows[0][0] if rows else 0
+
+    def set_last_sync(self, media_id, fav_time):
+        self.execute(
+            "INSERT OR REPLACE INTO syncs (media_id, last_sync) VALUES (?, ?)",
+            (str(media_id), fav_time),
+        )
+
+    def completed(self, media_id):
+        rows = self.execute(
+            "SELECT bvid FROM downloads WHERE media_id = ? AND done = 1",
+            (str(media_id),),
+        )
+        return {bvid for bvid, in rows}
+
+    def pending(self, media_id):
+        """videos queued by an earlier sync but never completed"""
+        rows = self.execute(
+            "SELECT bvid, title, fav_time FROM downloads "
+            "WHERE media_id = ? AND done = 0 ORDER BY fav_time DESC",
+            (str(media_id),),
+        )
+        return [{"bvid": b, "title": t, "fav_time": f} for b, t, f in rows]
+
+    def add(self, media_id, media):
+        self.execute(
+            "INSERT OR IGNORE INTO downloads (media_id, bvid, title, fav_time) "
+            "VALUES (?, ?, ?, ?)",
+            (str(media_id), media["bvid"], media.get("title"), media.get("fav_time")),
+        )
+
+    def mark_done(self, media_id, bvid, size=None):
+        self.execute(
+            "UPDATE downloads SET done = 1, size = ?, mtime = ? "
+            "WHERE media_id = ? AND bvid = ?",
+            (size, int(time.time()), str(media_id), bvid),
+        )
+        self.execute(
+            "DELETE FROM dead_letters WHERE media_id = ? AND bvid = ?",
+            (str(media_id), bvid),
+        )
+
+    def add_dead_letter(self, media_id, bvid, failure):
+        """put a video that failed with the `Failure` on the dead-letter list"""
+        self.execute(
+            "INSERT OR REPLACE INTO dead_letters "
+            "(media_id, bvid, kind, reason, message, attempts, mtime) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(media_id), bvid, *failure, int(time.time())),
+        )
+
+    def dead_letters(self, media_id=None, kinds=None):
+        """the dead letters of a favorite, or of all, of the given kinds or all"""
+        sql = "SELECT media_id, bvid, kind, reason, message, attempts, mtime "
+        sql += "FROM dead_letters WHERE (? IS NULL OR media_id = ?)"
+        args = [media_id and str(media_id)] * 2
+        if kinds is not None:
+            sql += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            args += list(kinds)
+        rows = self.execute(sql + " ORDER BY media_id, mtime", args)
+        keys = ("media_id", "bvid", "kind", "reason", "message", "attempts", "mtime")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def clear_dead_letters(self, media_id=None):
+        """forget the dead letters, so that the next sync tries them again"""
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM dead_letters WHERE (? IS NULL OR media_id = ?)",
+                [media_id and str(media_id)] * 2,
+            ).rowcount
+
+    def close(self):
+        self.conn.close()
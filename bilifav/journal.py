@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+# job journal kept in the output directory
+JOURNAL_NAME = ".journal"
+# seconds between two progress records of a running job
+JOURNAL_INTERVAL = 5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Journal:
+    """
+    Append-only log of the state of every download job
+
+    Each line is a JSON record of a job: its favorite, bvid, state, the
+    partial files of the backend and the bytes done. Replaying the file
+    gives the last state of every job, so a sync that was interrupted,
+    stopped or crashed resumes its unfinished jobs first. A record that
+    starts, completes or fails a job is synced to disk. Queued and progress
+    records are only flushed, a lost queued record is listed again by the
+    next sync. A line torn by a crash is cut off before appending
+    """
+
+    def __init__(self, output_path):
+        self.path = os.path.join(output_path, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        # (media_id, bvid) -> last record
+        self.jobs = self.replay()
+        self.repair()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def replay(self):
+        jobs = {}
+        if not os.path.exists(self.path):
+            return jobs
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                jobs[(record["media_id"], record["bvid"])] = record
+        return jobs
+
+    def repair(self):
+        """
+        Cut off a last line torn by a crash, the next record would
+        otherwise be appended to it and lost with it
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                # back to the end of the last complete line
+                start = max(end - 4096, 0)
+                f.seek(start)
+                chunk = f.read(end - start)
+                newline = chunk.rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+
+    def record(self, media_id, bvid, state, paths=None, done=None):
+        record = {
+            "time": int(time.time()),
+            "media_id": str(media_id),
+            "bvid": bvid,
+            "state": state,
+        }
+        if paths:
+            record["paths"] = paths
+        if done is not None:
+            record["bytes"] = done
+        with self.lock:
+            last = self.jobs.get((record["media_id"], bvid))
+            self.jobs[(record["media_id"], bvid)] = record
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            if state != QUEUED and (last is None or last["state"] != state):
+                os.fsync(self.file.fileno())
+
+    def unfinished(self, media_id):
+        """
+        Return the records of the jobs of a favorite that never completed,
+        the ones interrupted while running first, most advanced first
+        """
+        with self.lock:
+            records = [
+                r
+                for (m, _), r in self.jobs.items()
+                if m == str(media_id) and r["state"] != DONE
+            ]
+        return sorted(
+            records, key=lambda r: (r["state"] != RUNNING, -r.get("bytes", 0))
+        )
+
+    def compact(self):
+        """rewrite the journal with the unfinished jobs only"""
+        with self.lock:
+            self.file.close()
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for key, record in list(self.jobs.items()):
+                    if record["state"] == DONE:
+                        del self.jobs[key]
+                    else:
+                        f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the buckets of the histograms of durations, in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# upper bounds of the buckets of the histograms of rates, 16 KiB/s to 64 MiB/s
+RATE_BUCKETS = tuple(16 * 1024 * 2**i for i in range(13))
+# seconds between two writes of the metrics file
+METRICS_INTERVAL = 15
+
+HELP = {
+    "bilifav_api_requests_total": "API requests sent, retries included",
+    "bilifav_api_request_seconds": "Latency of API requests",
+    "bilifav_api_retries_total": "API requests retried",
+    "bilifav_api_failures_total": "API requests failed after the last retry",
+    "bilifav_listing_pages_total": "Listing pages fetched, by cache result",
+    "bilifav_queue_wait_seconds": "Time videos waited in the download queue",
+    "bilifav_stage_seconds": "Time spent in each stage of the pipeline",
+    "bilifav_jobs_total": "Videos downloaded, by result",
+    "bilifav_job_seconds": "Time to download a video",
+    "bilifav_job_bytes_per_second": "Download rate of each video",
+    "bilifav_failures_total": "Failed videos, by reason",
+    "bilifav_dedup_total": "Videos found in the content store, by stage",
+    "bilifav_store_links_total": "Files linked from the content store, by kind",
+    "bilifav_leases_total": "Videos leased to remote workers",
+    "bilifav_leases_expired_total": "Leases expired without a heartbeat",
+    "bilifav_concurrency_target": "Videos allowed to download at the same time",
+    "bilifav_concurrency_changes_total": "Changes of the concurrency target, by reason",
+    "bilifav_retries_total": "Failed videos put back for a retry, by kind",
+    "bilifav_dead_letters_total": "Videos given up on, by kind of failure",
+    "bilifav_processes_killed_total": "Stopped processes killed after the grace period",
+}
+
+
+def label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last slot counts the values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the pipeline, shared by all threads
+
+    Metrics are named and labelled like Prometheus ones, `render` returns
+    them in its text format. `span` times a stage of the pipeline into the
+    `bilifav_stage_seconds` histogram and, once a trace file is set,
+    appends the span to it as a JSON line
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> value
+        self.gauges = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        self.trace = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """time the block as `stage`, `attrs` only go to the trace"""
+        start = time.time()
+        clock = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            duration = time.perf_counter() - clock
+            self.observe("bilifav_stage_seconds", duration, stage=stage)
+            if self.trace:
+                record = {"stage": stage, "start": start, "duration": duration}
+                record.update(attrs, ok=ok)
+                with self.lock:
+                    self.trace.write(json.dumps(record) + "\n")
+                    self.trace.flush()
+
+    def set_trace(self, path):
+        """append the spans to the JSON lines file `path`"""
+        with self.lock:
+            if self.trace:
+                self.trace.close()
+            self.trace = open(path, "a", encoding="utf-8") if path else None
+
+    def render(self):
+        """return the metrics in the Prometheus text format"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(
+                (key, (h.buckets, list(h.counts), h.count, h.sum))
+                for key, h in self.histograms.items()
+            )
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), value in gauges:
+            describe(name, "gauge")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(buckets + ("+Inf",), counts):
+                cumulative += n
+                le = label_text(labels, [("le", bound)])
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """write the metrics to `path`, for a textfile collector"""
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def snapshot(self):
+        """
+        Return the counters, the gauges and the count, sum and max of the
+        histograms
+        """
+        with self.lock:
+            counters = {
+                name + label_text(labels): value
+                for (name, labels), value in self.counters.items()
+            }
+            gauges = {
+                name + label_text(labels): value
+                for (name, labels), value in self.gauges.items()
+            }
+            histograms = {
+                name + label_text(labels): histogram
+                for (name, labels), histogram in self.histograms.items()
+            }
+            histograms = {
+                name: {"count": h.count, "sum": h.sum, "max": h.max}
+                for name, h in histograms.items()
+            }
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def serve(self, port, host=""):
+        """serve the metrics at http://host:port/metrics in a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def diff(before, after):
+    """
+    Return the change between two snapshots, the max of a histogram is the
+    one of the whole process and the gauges are their last value
+    """
+    counters = {
+        name: value - before["counters"].get(name, 0)
+        for name, value in after["counters"].items()
+        if value != before["counters"].get(name, 0)
+    }
+    histograms = {}
+    for name, h in after["histograms"].items():
+        old = before["histograms"].get(name, {"count": 0, "sum": 0.0})
+        count = h["count"] - old["count"]
+        if count:
+            histograms[name] = {
+                "count": count,
+                "sum": h["sum"] - old["sum"],
+                "mean": (h["sum"] - old["sum"]) / count,
+                "max": h["max"],
+            }
+    return {"counters": counters, "gauges": after["gauges"], "histograms": histograms}
+
+
+# shared by every sync of the process
+metrics = Metrics()
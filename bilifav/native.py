@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .api import api, api_url, fetch_json
+from .backend import Backend, Stopped, split_job
+from .metrics import metrics
+from .postprocess import ffmpeg_command, finish_task, post, temp_path
+from .processes import CAN_SUSPEND, reaper, resume, spawn, suspend
+from .ratelimit import MAX_WAIT, limiter
+
+# bytes fetched by one range request
+SEGMENT_SIZE = 4 * 1024 * 1024
+# range requests of a stream running at the same time
+CONNECTIONS = 4
+# characters not allowed in file names on Windows
+UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+def safe_name(title):
+    return UNSAFE_CHARS.sub(" ", title).strip() or "untitled"
+
+
+def stream_url(stream):
+    return stream.get("baseUrl") or stream.get("base_url")
+
+
+def resolve(bvid, page=None):
+    """
+    Return the title, the urls of the best DASH video and audio streams
+    and the url of the cover of a video, or of its part `page`
+    """
+    view = fetch_json(api_url(f"/x/web-interface/view?bvid={bvid}"))
+    title, cid = view["title"], view["cid"]
+    if page:
+        part = view["pages"][page - 1]
+        title, cid = f"{title} P{page} {part['part']}", part["cid"]
+    play = fetch_json(
+        api_url(f"/x/player/playurl?bvid={bvid}&cid={cid}&fnval=16&fourk=1")
+    )
+    dash = play["dash"]
+    video = max(dash["video"], key=lambda s: (s["id"], s["bandwidth"]))
+    audio = None
+    if dash.get("audio"):
+        audio = stream_url(max(dash["audio"], key=lambda s: s["bandwidth"]))
+    return title, stream_url(video), audio, view.get("pic")
+
+
+class SegmentedDownload:
+    """
+    Download `url` into `path` with parallel range requests
+
+    The data is written to `path.part` and the index of every finished
+    segment is appended to `path.part.done`, so an interrupted download
+    resumes with the missing segments only. No segment starts while the
+    event `running` is cleared, the ones already started go on
+    """
+
+    def __init__(
+        self,
+        url,
+        path,
+        connections=CONNECTIONS,
+        segment_size=SEGMENT_SIZE,
+        limit=None,
+        running=None,
+    ):
+        self.url = url
+        self.limit = limit
+        self.running = running
+        self.path = path
+        self.part = path + ".part"
+        self.log = path + ".part.done"
+        self.connections = connections
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.total = None
+        self.done = 0
+        self.stopped = False
+
+    def probe(self):
+        """learn the size of the stream"""
+        status, headers, body = api.fetch(
+            self.url, {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+        )
+        if status == 206:
+            self.total = int(headers["Content-Range"].rsplit("/", 1)[-1])
+        else:
+            # no range support, the whole stream came back
+            self.total = len(body)
+            with open(self.part, "wb") as f:
+                f.write(body)
+            self.segment_size = max(self.total, 1)
+            with open(self.log, "w") as f:
+                f.write("0\n")
+        return self.total
+
+    def finished_segments(self):
+        if not os.path.exists(self.log) or not os.path.exists(self.part):
+            return set()
+        with open(self.log) as f:
+            # a line cut short by a crash is not finished, `1` may be `12`
+            return {
+                int(line)
+                for line in f
+                if line.endswith("\n") and line.strip().isdigit()
+            }
+
+    def run(self, on_progress=None):
+        if self.total is None:
+            self.probe()
+        segments = -(-self.total // self.segment_size)
+        finished = self.finished_segments()
+        if not finished:
+            with open(self.part, "wb") as f:
+                f.truncate(self.total)
+        self.done = sum(
+            end - start + 1 for start, end in map(self.segment_range, finished)
+        )
+        if on_progress:
+            on_progress()
+
+        with open(self.log, "a") as log, ThreadPoolExecutor(self.connections) as ex:
+            if not self.log_ends_with_newline():
+                # the next index goes on a line of its own
+                log.write("\n")
+
+            def fetch(i):
+                self.wait_running()
+                if self.stopped:
+                    raise Stopped()
+                start, end = self.segment_range(i)
+                if self.limit:
+                    self.limit.consume(end - start + 1, lambda: self.stopped)
+                    if self.stopped:
+                        raise Stopped()
+                status, _, body = api.fetch(
+                    self.url,
+                    {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"},
+                )
+                if status != 206 or len(body) != end - start + 1:
+                    raise IOError(f"bad range response for bytes {start}-{end}")
+                with open(self.part, "r+b") as f:
+                    f.seek(start)
+                    f.write(body)
+                with self.lock:
+                    log.write(f"{i}\n")
+                    log.flush()
+                    self.done += len(body)
+                if on_progress:
+                    on_progress()
+
+            futures = [
+                ex.submit(fetch, i) for i in range(segments) if i not in finished
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # do not start the remaining segments
+                self.stopped = True
+                raise
+
+        os.replace(self.part, self.path)
+        os.remove(self.log)
+
+    def log_ends_with_newline(self):
+        with open(self.log, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if not f.tell():
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def segment_range(self, i):
+        start = i * self.segment_size
+        return start, min(start + self.segment_size, self.total) - 1
+
+    def wait_running(self):
+        """wait while the download is paused, until it is stopped"""
+        while self.running is not None and not self.running.wait(MAX_WAIT):
+            if self.stopped:
+                return
+
+    def stop(self):
+        self.stopped = True
+
+
+class NativeBackend(Backend):
+    """
+    Download in process: resolve the DASH streams of a video, fetch them
+    with parallel range requests over pooled connections and mux them
+    with ffmpeg. When the pool of the `PostProcessor` muxes, `download`
+    returns a future of the size of the video instead of the size, and the
+    task in the pool is stopped, paused and resumed with the backend
+    """
+
+    name = "native"
+
+    def __init__(self, output_path):
+        super(NativeBackend, self).__init__(output_path)
+        self.streams = []
+        self.process = None
+        # tasks submitted to the `PostProcessor` and not finished yet
+        self.tasks = []
+        # held while ffmpeg is started, stopped, suspended or resumed
+        self.lock = threading.Lock()
+        # cleared while the download is paused
+        self.running = threading.Event()
+        self.running.set()
+
+    def download(self, bvid, on_progress=None):
+        self.failure = None
+        with metrics.span("resolve", bvid=bvid):
+            title, video_url, audio_url, cover_url = resolve(*split_job(bvid))
+        target = os.path.join(self.output_path, safe_name(title) + ".mp4")
+        limit = limiter.job()
+        try:
+            ok = self.download_streams(target, video_url, audio_url, limit, on_progress)
+        finally:
+            limit.close()
+        if not ok:
+            return False, None
+        cover = None
+        if post.embed and cover_url:
+            cover = self.fetch_cover(cover_url, target)
+        task = post.task([stream.path for stream in self.streams], target, title, cover)
+        if not post.needed(task):
+            return True, os.path.getsize(target)
+        if post.active():
+            # muxed while this worker downloads the next video
+            return True, self.submit(task)
+        with metrics.span("mux", path=target):
+            muxed = self.mux(task)
+        if not muxed:
+            self.failure = "stopped" if self.stopped else "mux"
+            return False, None
+        return True, os.path.getsize(target)
+
+    def download_streams(self, target, video_url, audio_url, limit, on_progress):
+        if audio_url is None:
+            paths = [target]
+        else:
+            paths = [target + ".video.m4s", target + ".audio.m4s"]
+        self.streams = [
+            SegmentedDownload(url, path, limit=limit, running=self.running)
+            for url, path in zip((video_url, audio_url), paths)
+        ]
+        if self.stopped:
+            # before the streams could be stopped
+            self.failure = "stopped"
+            return False
+
+        total = sum(stream.probe() for stream in self.streams)
+
+        def progress():
+            done = sum(stream.done for stream in self.streams)
+            on_progress(done, total, done / max(total, 1) * 100)
+
+        try:
+            with metrics.span("download", path=target, bytes=total):
+                for stream in self.streams:
+                    stream.run(progress if on_progress else None)
+        except Stopped:
+            self.failure = "stopped"
+            return False
+        return True
+
+    def fetch_cover(self, url, target):
+        """download the cover to embed next to `target`, None if it failed"""
+        path = target + ".cover.jpg"
+        try:
+            with open(path, "wb") as f:
+                f.write(api.get(url))
+        except Exception as e:
+            print(e)
+            return None
+        return path
+
+    def submit(self, task):
+        with self.lock:
+            self.tasks.append(task)
+            future = post.submit(task)
+            if self.stopped:
+                post.stop([task])
+            elif self.paused:
+                post.pause([task])
+
+        def forget(future):
+            with self.lock:
+                self.tasks.remove(task)
+
+        future.add_done_callback(forget)
+        return future
+
+    def mux(self, task):
+        """run the `PostTask` in the download slot"""
+        cmd = ffmpeg_command(task, temp_path(task))
+        with self.lock:
+            if self.stopped:
+                return False
+            self.process = spawn(cmd, stdin=subprocess.DEVNULL)
+            if self.paused and CAN_SUSPEND:
+                suspend(self.process)
+        try:
+            if self.process.wait() != 0:
+                return False
+        finally:
+            with self.lock:
+                self.process = None
+        finish_task(task)
+        return True
+
+    def partial_paths(self):
+        return [stream.part for stream in self.streams]
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            for stream in self.streams:
+                stream.stop()
+            if self.process:
+                reaper.stop(self.process)
+            post.stop(self.tasks)
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.running.clear()
+            if self.process and CAN_SUSPEND:
+                suspend(self.process)
+            post.pause(self.tasks)
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.running.set()
+            if self.process and CAN_SUSPEND:
+                resume(self.process)
+            post.resume(self.tasks)
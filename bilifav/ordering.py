@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# default order of the downloads, the one of the listing
+DEFAULT_ORDER = "listing"
+
+
+def part_duration(media):
+    """
+    Seconds of a video or of one of its parts, the parts of a video share
+    its duration evenly. None when the listing did not give it
+    """
+    duration = media.get("duration")
+    if duration is None:
+        return None
+    return duration / max(media.get("page") or 1, 1)
+
+
+def fav_time(media):
+    return media.get("fav_time")
+
+
+# order -> (value of a media the order uses, whether the highest go first)
+ORDERS = {
+    # as listed, the newest favorites first
+    "listing": (lambda media: 0, False),
+    # the most videos done per hour
+    "shortest": (part_duration, False),
+    # no long download left alone at the end, the size of a video follows
+    # its duration at a given quality
+    "largest": (part_duration, True),
+    # the newest favorites first, the retries of earlier syncs included
+    "newest": (fav_time, True),
+}
+
+
+def order_names():
+    return list(ORDERS)
+
+
+def get_order(name):
+    """
+    Return the sort key of the medias queued in the order `name`, the
+    lowest first. Medias without the value the order uses, the ones resumed
+    from an interrupted run, go first
+    """
+    if name not in ORDERS:
+        raise ValueError(f"unknown order: {name}")
+    value, descending = ORDERS[name]
+
+    def key(media):
+        v = value(media)
+        if v is None:
+            return (0,)
+        return (1, -v if descending else v)
+
+    return key
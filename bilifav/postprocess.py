@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .backend import Stopped
+from .metrics import metrics
+from .processes import CAN_SUSPEND, reaper, resume, spawn, suspend
+
+# ffmpeg processes muxing at the same time by default, one per core
+POST_JOBS = os.cpu_count() or 1
+# ffmpeg options of the video codecs a video can be transcoded to
+TRANSCODES = {
+    "h264": ["-c:v:0", "libx264", "-preset", "medium", "-crf", "23"],
+    "hevc": ["-c:v:0", "libx265", "-preset", "medium", "-crf", "28"],
+}
+
+# `inputs` are the downloaded streams, muxed into `target` with the cover
+# image `cover` and the title `title` when they are not None
+PostTask = namedtuple("PostTask", "inputs target title cover transcode")
+
+
+def ffmpeg_command(task, output):
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    for path in task.inputs:
+        cmd += ["-i", path]
+    if task.cover:
+        cmd += ["-i", task.cover]
+    for i in range(len(task.inputs)):
+        cmd += ["-map", str(i)]
+    if task.cover:
+        cmd += ["-map", str(len(task.inputs)), "-disposition:v:1", "attached_pic"]
+    cmd += ["-c", "copy"]
+    if task.transcode:
+        cmd += TRANSCODES[task.transcode]
+    if task.title:
+        cmd += ["-metadata", f"title={task.title}"]
+    return cmd + [output]
+
+
+def temp_path(task):
+    return task.target + ".tmp.mp4"
+
+
+def finish_task(task):
+    """replace the target by the muxed file, return its size"""
+    os.replace(temp_path(task), task.target)
+    for path in task.inputs + [task.cover]:
+        if path and path != task.target:
+            os.remove(path)
+    return os.path.getsize(task.target)
+
+
+class PostProcessor:
+    """
+    CPU-bound stage after the downloads, shared by every sync of the process
+
+    Muxing the downloaded streams, transcoding and embedding the cover and
+    the title run in at most `jobs` ffmpeg processes at a time, one per
+    core by default, each started by a thread of a pool, so a download
+    slot is free for the next video as soon as the streams are on disk.
+    With `jobs` 0 the backends mux in the download slot.
+
+    Like a download, a submitted task can be stopped, paused and resumed
+    by the backend that submitted it, its ffmpeg runs in a process group of
+    its own stopped by the `reaper`
+    """
+
+    def __init__(self, jobs=POST_JOBS, transcode=None, embed=False):
+        self.lock = threading.Lock()
+        self.pool = None
+        # targets submitted and not finished yet, the ones stopped or
+        # paused among them, and the ffmpeg running for a target
+        self.pending = set()
+        self.stopped = set()
+        self.paused = set()
+        self.processes = {}
+        self.configure(jobs, transcode, embed)
+
+    def configure(self, jobs=POST_JOBS, transcode=None, embed=False):
+        if transcode is not None and transcode not in TRANSCODES:
+            raise ValueError(f"unknown codec: {transcode}")
+        self.jobs = jobs
+        # codec to transcode the videos to, None to keep them as they are
+        self.transcode = transcode
+        # whether the cover and the title are embedded into the videos
+        self.embed = embed
+
+    def active(self):
+        return self.jobs > 0
+
+    def task(self, inputs, target, title=None, cover=None):
+        """the `PostTask` of a downloaded video"""
+        if not self.embed:
+            title = cover = None
+        return PostTask(inputs, target, title, cover, self.transcode)
+
+    def needed(self, task):
+        """whether ffmpeg has anything to do, a single stream is kept as is"""
+        return bool(len(task.inputs) > 1 or task.title or task.cover or task.transcode)
+
+    def submit(self, task):
+        """return a future of the size of the processed video"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.jobs, thread_name_prefix="post")
+            self.pending.add(task.target)
+            future = self.pool.submit(self.run, task)
+        submitted = time.perf_counter()
+
+        def done(future):
+            metrics.observe(
+                "bilifav_stage_seconds", time.perf_counter() - submitted, stage="post"
+            )
+
+        future.add_done_callback(done)
+        return future
+
+    def run(self, task):
+        """run `task` in a thread of the pool, return the size of the video"""
+        cmd = ffmpeg_command(task, temp_path(task))
+        target = task.target
+        try:
+            with self.lock:
+                if target in self.stopped:
+                    raise Stopped()
+                process = self.processes[target] = spawn(cmd, stdin=subprocess.DEVNULL)
+                if target in self.paused and CAN_SUSPEND:
+                    suspend(process)
+            returncode = process.wait()
+            with self.lock:
+                del self.processes[target]
+                if target in self.stopped:
+                    raise Stopped()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+            return finish_task(task)
+        finally:
+            with self.lock:
+                self.pending.discard(target)
+                self.stopped.discard(target)
+                self.paused.discard(target)
+
+    def stop(self, tasks):
+        """stop the submitted `tasks`, the ones not started yet fail at once"""
+        with self.lock:
+            for task in tasks:
+                if task.target not in self.pending:
+                    continue
+                self.stopped.add(task.target)
+                process = self.processes.get(task.target)
+                if process:
+                    reaper.stop(process)
+
+    def pause(self, tasks):
+        """suspend the ffmpeg of the submitted `tasks` until `resume`"""
+        with self.lock:
+            for task in tasks:
+                if task.target not in self.pending:
+                    continue
+                self.paused.add(task.target)
+                process = self.processes.get(task.target)
+                if process and CAN_SUSPEND:
+                    suspend(process)
+
+    def resume(self, tasks):
+        with self.lock:
+            for task in tasks:
+                self.paused.discard(task.target)
+                process = self.processes.get(task.target)
+                if process and CAN_SUSPEND:
+                    resume(process)
+
+    def close(self):
+        """
+        Wait for the submitted tasks and let the threads of the pool go, a
+        later `submit` starts a new pool
+        """
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown()
+
+
+# shared by every sync of the process
+post = PostProcessor()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from .metrics import metrics
+
+# seconds a stopped process and its children have to exit before they are
+# killed
+GRACE_PERIOD = 0.5
+# processes can only be suspended where there are job control signals
+CAN_SUSPEND = hasattr(signal, "SIGSTOP")
+POSIX = os.name == "posix"
+# seconds between two checks whether the children of a process exited
+POLL_INTERVAL = 0.02
+
+
+def spawn(cmd, **kwargs):
+    """
+    Start `cmd` in its own process group, out of reach of Ctrl-C, so that
+    it is stopped, suspended or killed together with its children
+    """
+    if POSIX:
+        kwargs["start_new_session"] = True
+    else:
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    return subprocess.Popen(cmd, **kwargs)
+
+
+def signal_group(process, signum):
+    """send `signum` to the process group of `process`, if it is still there"""
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        # every process of the group exited
+        pass
+
+
+def group_alive(process):
+    """whether a process of the group of `process` is still there"""
+    try:
+        os.killpg(process.pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def exited(process, deadline):
+    """wait until `process` and its children exit, False if they did not in time"""
+    if not POSIX:
+        # a process tree can only be told through its root
+        try:
+            process.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            return False
+        return True
+    # asked through the group, the thread that started the process may be
+    # waiting for it already
+    while group_alive(process):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def terminate(process):
+    """ask `process` and its children to exit"""
+    if not POSIX:
+        if process.poll() is None:
+            try:
+                process.send_signal(signal.CTRL_BREAK_EVENT)
+            except OSError:
+                pass
+        return
+    signal_group(process, signal.SIGTERM)
+    # a suspended process only exits once it runs again
+    signal_group(process, signal.SIGCONT)
+
+
+def kill(process):
+    """kill `process` and its children"""
+    if POSIX:
+        signal_group(process, signal.SIGKILL)
+        return
+    if process.poll() is None:
+        subprocess.call(
+            ["TASKKILL", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def suspend(process):
+    signal_group(process, signal.SIGSTOP)
+
+
+def resume(process):
+    signal_group(process, signal.SIGCONT)
+
+
+class Reaper:
+    """
+    Stops child processes without blocking the caller
+
+    `stop` asks a process and the other processes of its group to exit
+    right away, and a thread of the reaper kills the ones still running
+    `grace` seconds later and reaps them. Every process gets the same grace
+    period from the time it was stopped, so stopping hundreds of downloads
+    takes about as long as stopping one
+    """
+
+    def __init__(self, grace=GRACE_PERIOD):
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # heap of (when it is killed, number, process)
+        self.pending = []
+        self.numbers = itertools.count()
+        self.thread = None
+
+    def stop(self, process):
+        terminate(process)
+        with self.lock:
+            deadline = time.monotonic() + self.grace
+            heapq.heappush(self.pending, (deadline, next(self.numbers), process))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.changed.notify_all()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.changed.wait()
+                deadline, _, process = self.pending[0]
+            if not exited(process, deadline):
+                metrics.inc("bilifav_processes_killed_total")
+            # the children may outlive the process that started them
+            kill(process)
+            process.wait()
+            with self.lock:
+                heapq.heappop(self.pending)
+                self.changed.notify_all()
+
+    def wait(self):
+        """block until every process stopped so far is gone"""
+        with self.lock:
+            while self.pending:
+                self.changed.wait()
+
+
+# shared by every backend of the process
+reaper = Reaper()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import namedtuple
+
+# seconds between two progress reports of a sync
+REPORT_INTERVAL = 0.5
+# weight of the latest sample in the smoothed download rate
+RATE_SMOOTHING = 0.3
+
+ProgressStats = namedtuple("ProgressStats", "percent finished total bytes rate eta")
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+def describe(stats):
+    """one line summary of a `ProgressStats`"""
+    return (
+        f"{stats.finished}/{stats.total} videos, "
+        f"{format_size(stats.rate)}/s, ETA {format_eta(stats.eta)}"
+    )
+
+
+def combine(stats):
+    """`ProgressStats` of several syncs running at the same time"""
+    finished = sum(s.finished for s in stats)
+    total = sum(s.total for s in stats)
+    rate = sum(s.rate for s in stats)
+    percent = sum(s.percent * s.total for s in stats) // max(total, 1)
+    # remaining bytes of the syncs that have an estimate
+    remaining = sum(s.eta * s.rate for s in stats if s.eta is not None)
+    eta = remaining / rate if rate > 0 else None
+    return ProgressStats(
+        percent, finished, total, sum(s.bytes for s in stats), rate, eta
+    )
+
+
+class Progress:
+    """
+    Progress aggregated over the videos downloaded at the same time
+
+    Workers report their bytes done and total with `update`. `snapshot`
+    sums them a few times per second and derives the overall percentage,
+    the smoothed download rate and the ETA, `running` copies them for the
+    progress of each video
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # job -> (bytes done, bytes total, percent)
+        self.active = {}
+        self.finished = 0
+        # bytes of the finished videos, and how many of them had a known size
+        self.finished_bytes = 0
+        self.sized = 0
+        self.rate = 0.0
+        self.last = None
+
+    def update(self, job, done, total, percent):
+        with self.lock:
+            self.active[job] = (done, total, percent)
+
+    def running(self):
+        """return the (bytes done, bytes total, percent) of the running jobs"""
+        with self.lock:
+            return dict(self.active)
+
+    def finish(self, job, ok=True, size=None):
+        """count `job` as finished, the bytes of a failed job are discarded"""
+        with self.lock:
+            entry = self.active.pop(job, None)
+            self.finished += 1
+            if ok and size is None and entry is not None:
+                size = entry[1]
+            if ok and size:
+                self.finished_bytes += size
+                self.sized += 1
+
+    def remove(self, job):
+        """forget `job`, which will be downloaded again"""
+        with self.lock:
+            self.active.pop(job, None)
+
+    def snapshot(self, total):
+        """return the `ProgressStats` of a sync of `total` videos"""
+        now = time.monotonic()
+        with self.lock:
+            active = list(self.active.values())
+            finished = self.finished
+            finished_bytes = self.finished_bytes
+            sized = self.sized
+
+        done_bytes = finished_bytes + sum(done for done, _, _ in active)
+        if self.last is not None and now > self.last[0]:
+            sample = max(done_bytes - self.last[1], 0) / (now - self.last[0])
+            self.rate += RATE_SMOOTHING * (sample - self.rate)
+        self.last = (now, done_bytes)
+
+        total = max(total, finished + len(active), 1)
+        done = finished + sum(percent for _, _, percent in active) / 100
+        percent = min(int(done / total * 100), 100)
+
+        # videos not started yet are assumed to be of the average size
+        known = [size for _, size, _ in active if size]
+        eta = None
+        if sized + len(known) and self.rate > 0:
+            average = (finished_bytes + sum(known)) / (sized + len(known))
+            waiting = total - finished - len(active)
+            remaining = waiting * average + sum(
+                (size or average) - done for done, size, _ in active
+            )
+            eta = max(remaining, 0) / self.rate
+        return ProgressStats(percent, finished, total, done_bytes, self.rate, eta)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+import time
+
+# longest sleep before the rate is checked again, so that a new limit
+# applies to the waiting downloads at once
+MAX_WAIT = 0.5
+# smallest burst allowed by a bucket, in bytes
+MIN_BURST = 64 * 1024
+
+RATE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?(?:/s)?\s*$", re.IGNORECASE)
+SCHEDULE = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)$")
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_rate(text):
+    """parse a rate such as `500K` or `2M` into bytes/s, None for no limit"""
+    if text is None or text.strip().lower() in ("", "0", "off", "none"):
+        return None
+    match = RATE.match(text)
+    if not match:
+        raise ValueError(f"not a rate: {text}")
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()]) or None
+
+
+def parse_schedule(text):
+    """
+    Parse a time-of-day schedule such as `09:00-18:00=1M,18:00-09:00=off`
+    into a list of (start minute, end minute, rate)
+    """
+    schedule = []
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        match = SCHEDULE.match(part)
+        if not match:
+            raise ValueError(f"not a schedule: {part}")
+        h1, m1, h2, m2, rate = match.groups()
+        schedule.append(
+            (int(h1) * 60 + int(m1), int(h2) * 60 + int(m2), parse_rate(rate))
+        )
+    return schedule
+
+
+class TokenBucket:
+    """
+    Token bucket of `rate` bytes per second, None for no limit
+
+    `reserve` takes the tokens at once and may leave the bucket in debt,
+    `wait_time` tells how long until the debt is paid back
+    """
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate is None:
+            self.tokens = 0.0
+        else:
+            burst = max(self.rate, MIN_BURST)
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, burst)
+        self.stamp = now
+
+    def reserve(self, n):
+        with self.lock:
+            self.refill()
+            if self.rate is not None:
+                self.tokens -= n
+
+    def wait_time(self):
+        with self.lock:
+            self.refill()
+            if self.rate is None or self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class BandwidthLimiter:
+    """
+    Bandwidth limit shared by every download of the process
+
+    The global rate follows the time-of-day `schedule` when one of its
+    windows covers the current time, `rate` otherwise. Each job also gets
+    its own bucket capped at `job_rate`. All rates can be changed while
+    downloads are running
+    """
+
+    def __init__(self, rate=None, job_rate=None, schedule=None):
+        self.rate = rate
+        self.job_rate = job_rate
+        self.schedule = schedule or []
+        self.bucket = TokenBucket(rate)
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def set_job_rate(self, rate):
+        self.job_rate = rate
+        with self.lock:
+            for bucket in self.jobs:
+                bucket.set_rate(rate)
+
+    def set_schedule(self, schedule):
+        self.schedule = schedule
+
+    def current_rate(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            # a window may wrap around midnight
+            if start <= minute < end or (
+                end <= start and (minute >= start or minute < end)
+            ):
+                return rate
+        return self.rate
+
+    def active(self):
+        return self.current_rate() is not None or self.job_rate is not None
+
+    def job(self):
+        """return the limiter of a new download job"""
+        bucket = TokenBucket(self.job_rate)
+        with self.lock:
+            self.jobs.append(bucket)
+        return JobLimiter(self, bucket)
+
+    def release(self, bucket):
+        with self.lock:
+            self.jobs.remove(bucket)
+
+    def sync_rate(self):
+        rate = self.current_rate()
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+
+
+class JobLimiter:
+    """limits one download job by the global bucket and its own cap"""
+
+    def __init__(self, limiter, bucket):
+        self.limiter = limiter
+        self.bucket = bucket
+
+    def reserve(self, n):
+        self.limiter.sync_rate()
+        self.limiter.bucket.reserve(n)
+        self.bucket.reserve(n)
+
+    def wait_time(self):
+        self.limiter.sync_rate()
+        return max(self.limiter.bucket.wait_time(), self.bucket.wait_time())
+
+    def consume(self, n, stopped=None):
+        """take `n` bytes worth of tokens, sleeping until the rates allow it"""
+        self.reserve(n)
+        while not (stopped and stopped()):
+            wait = self.wait_time()
+            if wait <= 0:
+                break
+            time.sleep(min(wait, MAX_WAIT))
+
+    def close(self):
+        self.limiter.release(self.bucket)
+
+
+# shared by every sync of the process
+limiter = BandwidthLimiter()
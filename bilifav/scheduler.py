@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from .failures import retry_delay
+from .metrics import metrics
+
+
+def batch_length(pending, maximum, share=1):
+    """
+    Jobs to take at once out of `pending` ones, up to `maximum`: a fair
+    `share` of them, so that the last jobs are spread over the workers
+    instead of queued behind a single one
+    """
+    return max(1, min(maximum, pending // max(share, 1)))
+
+
+class DownloadQueue:
+    """
+    Work queue shared by the annie workers
+
+    `get` blocks until a job is available and returns None once the queue
+    is closed and every job is done, `join` blocks until then. Jobs are
+    taken by the lowest `key` they were put with, in the order they were
+    put for equal keys. A failed job put back with `retry` waits for its
+    backoff before it is taken again, first in line, see `retry_delay` for
+    `retry_delays`. While the queue is paused, `get` hands out no job
+    """
+
+    def __init__(self, lock=None, has_jobs=None, retry_delays=None):
+        # the lanes of a `FairQueue` share its lock and wake up its workers
+        self.lock = lock or threading.Lock()
+        self.has_jobs = has_jobs or threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        # heap of (key, number, job, when it was queued)
+        self.jobs = []
+        self.numbers = itertools.count()
+        # heap of (when it is due, number, job) of the jobs to retry
+        self.delayed = []
+        # job -> times it failed
+        self.attempts = {}
+        self.retry_delays = retry_delays
+        self.closed = False
+        self.cancelled = False
+        self.paused = False
+        # jobs put into the queue
+        self.submitted = 0
+        # jobs finished, whether they succeeded or not
+        self.finished = 0
+        # jobs failed
+        self.failed = 0
+
+    def put(self, job, key=(1,)):
+        with self.lock:
+            # cancelled
+            if self.closed:
+                return
+            self.push(job, key)
+            self.submitted += 1
+            self.has_jobs.notify()
+
+    def push(self, job, key):
+        """queue a job, the lock is held"""
+        # with the time it was queued
+        heapq.heappush(self.jobs, (key, next(self.numbers), job, time.monotonic()))
+
+    def get(self):
+        with self.lock:
+            return self.take() if self.wait() else None
+
+    def get_batch(self, maximum, share=1):
+        """like `get`, but return a list of up to `maximum` jobs, see `batch_length`"""
+        with self.lock:
+            if not self.wait():
+                return None
+            n = batch_length(len(self.jobs), maximum, share)
+            return [self.take() for _ in range(n)]
+
+    def wait(self):
+        """
+        Wait for a job, return False once the queue is done, the lock is
+        held. A running job may still fail and be retried until then
+        """
+        while True:
+            due = self.ready()
+            if self.jobs and not self.paused:
+                return True
+            if self.done():
+                return False
+            self.has_jobs.wait(due)
+
+    def ready(self):
+        """
+        Queue the retries that are due, return the seconds until the next
+        one, None if there is none, the lock is held
+        """
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self.delayed)
+            # an empty key sorts before the key of any job
+            self.push(job, ())
+        return self.delayed[0][0] - now if self.delayed else None
+
+    def done(self):
+        """whether every job is finished and no more will come"""
+        return self.closed and self.finished == self.submitted
+
+    def retry(self, job, kind):
+        """
+        Put back a job that failed with `kind` after its backoff, return
+        the delay, or None if the job is not retried: its failure is not
+        transient, its retries are used up or the queue is cancelled
+        """
+        with self.lock:
+            attempts = self.attempts.get(job, 0) + 1
+            self.attempts[job] = attempts
+            delay = retry_delay(kind, attempts, self.retry_delays)
+            if delay is None or self.cancelled:
+                return None
+            due = time.monotonic() + delay
+            heapq.heappush(self.delayed, (due, next(self.numbers), job))
+            # the waiting workers wait for it
+            self.has_jobs.notify_all()
+            return delay
+
+    def take(self):
+        """pop the next job, the lock is held"""
+        _, _, job, queued = heapq.heappop(self.jobs)
+        metrics.observe("bilifav_queue_wait_seconds", time.monotonic() - queued)
+        return job
+
+    def task_done(self, ok=True):
+        with self.lock:
+            self.finished += 1
+            if not ok:
+                self.failed += 1
+            if self.done():
+                self.all_done.notify_all()
+                # the workers waiting for a retry exit
+                self.has_jobs.notify_all()
+            return self.finished
+
+    def close(self):
+        """no more jobs will be put"""
+        with self.lock:
+            self.closed = True
+            self.has_jobs.notify_all()
+            if self.finished == self.submitted:
+                self.all_done.notify_all()
+
+    def pause(self):
+        """keep the jobs until `resume`, the running ones go on"""
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.has_jobs.notify_all()
+
+    def cancel(self):
+        """drop the pending jobs and the retries and close the queue"""
+        with self.lock:
+            self.cancelled = True
+            self.submitted -= len(self.jobs) + len(self.delayed)
+            self.jobs.clear()
+            self.delayed.clear()
+        self.close()
+
+    def join(self):
+        with self.lock:
+            while not self.done():
+                self.all_done.wait()
+
+
+class FairQueue:
+    """
+    Work queue shared by the favorites of a batch
+
+    Each favorite puts its jobs into its own lane, a `DownloadQueue`, and
+    `get` takes them from the lanes in turn, so that a small favorite is
+    not starved behind a large one. `get` returns a (lane, job) pair, or
+    None once the queue is closed and every lane is done, or once
+    `timeout` seconds have passed. Pausing the queue pauses every lane.
+    The lanes retry their failed jobs after `retry_delays`
+    """
+
+    def __init__(self, retry_delays=None):
+        self.retry_delays = retry_delays
+        self.lock = threading.Lock()
+        self.has_jobs = threading.Condition(self.lock)
+        self.lanes = deque()
+        self.closed = False
+        self.paused = False
+
+    def lane(self):
+        lane = DownloadQueue(self.lock, self.has_jobs, self.retry_delays)
+        with self.lock:
+            self.lanes.append(lane)
+        return lane
+
+    def get(self, timeout=None):
+        batch = self.get_batch(1, timeout=timeout)
+        if batch is None:
+            return None
+        lane, jobs = batch
+        return lane, jobs[0]
+
+    def get_batch(self, maximum, share=1, timeout=None):
+        """
+        Like `get`, but return a (lane, jobs) pair of up to `maximum` jobs
+        of the same lane, see `batch_length`
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                # seconds until the next retry of a lane is due
+                wait = None
+                for _ in range(0 if self.paused else len(self.lanes)):
+                    lane = self.lanes.popleft()
+                    due = lane.ready()
+                    if lane.jobs and not lane.paused:
+                        # served, wait for the other lanes
+                        self.lanes.append(lane)
+                        n = batch_length(len(lane.jobs), maximum, share)
+                        return lane, [lane.take() for _ in range(n)]
+                    if due is not None:
+                        wait = due if wait is None else min(wait, due)
+                    # drop the lanes that will get no more jobs, a running
+                    # job may still be retried
+                    if not lane.done():
+                        self.lanes.append(lane)
+                if self.closed:
+                    return None
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        return None
+                    wait = left if wait is None else min(wait, left)
+                self.has_jobs.wait(wait)
+
+    def requeue(self, lane, job):
+        """
+        Put back a job taken from `lane` that was not finished, first in
+        line and without counting it as submitted again
+        """
+        with self.lock:
+            # an empty key sorts before the key of any job
+            lane.push(job, ())
+            # the lane was dropped if it was closed and drained
+            if lane not in self.lanes:
+                self.lanes.append(lane)
+            self.has_jobs.notify()
+
+    def pause(self):
+        """hand out no job until `resume`, the running ones go on"""
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.has_jobs.notify_all()
+
+    def close(self):
+        """no more lanes will be added"""
+        with self.lock:
+            self.closed = True
+            self.has_jobs.notify_all()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import threading
+from concurrent.futures import Future
+
+from .backend import Backend
+from .metrics import metrics
+
+# quality of the streams the backends pick, part of the key of a video
+QUALITY = "best"
+# content store kept next to the output directories by default
+STORE_NAME = ".bilifav-store"
+
+
+def store_key(bvid, quality=QUALITY):
+    return f"{bvid}-{quality}"
+
+
+def default_store_path(output_path):
+    """
+    Store shared by the output directories next to `output_path`, on the
+    same file system as them most of the time, so that hardlinks work
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(output_path)), STORE_NAME)
+
+
+class ContentStore:
+    """
+    Downloaded videos shared by every favorite and output directory
+
+    A video is downloaded once into `incoming/<key>` and moved to
+    `objects/<key>` when complete. Output directories get hardlinks to its
+    files, or symlinks where hardlinks are not possible, so a video in
+    several favorites costs neither the traffic nor the disk space twice
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+        self.incoming = os.path.join(path, "incoming")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.incoming, exist_ok=True)
+        self.lock = threading.Lock()
+        # key -> lock held while the video is downloaded
+        self.claims = {}
+
+    def object_path(self, key):
+        return os.path.join(self.objects, key)
+
+    def incoming_path(self, key):
+        return os.path.join(self.incoming, key)
+
+    def files(self, key):
+        path = self.object_path(key)
+        if not os.path.isdir(path):
+            return []
+        return [entry for entry in os.scandir(path) if entry.is_file()]
+
+    def has(self, key):
+        return bool(self.files(key))
+
+    def claim(self, key):
+        """return the lock to hold while downloading the video of `key`"""
+        with self.lock:
+            return self.claims.setdefault(key, threading.Lock())
+
+    def commit(self, key):
+        """move the downloaded video of `key` from incoming to the objects"""
+        target = self.object_path(key)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(self.incoming_path(key), target)
+
+    def link(self, key, output_path):
+        """
+        Link the files of `key` into `output_path`, return their size or
+        None if the video is not in the store
+        """
+        files = self.files(key)
+        if not files:
+            return None
+        os.makedirs(output_path, exist_ok=True)
+        size = 0
+        for entry in files:
+            size += entry.stat().st_size
+            target = os.path.join(output_path, entry.name)
+            if os.path.lexists(target):
+                # linked before, or a file of the user that is kept
+                continue
+            try:
+                os.link(entry.path, target)
+                metrics.inc("bilifav_store_links_total", kind="hardlink")
+            except OSError:
+                os.symlink(os.path.abspath(entry.path), target)
+                metrics.inc("bilifav_store_links_total", kind="symlink")
+        return size
+
+
+class StoredBackend(Backend):
+    """
+    Backend downloading into a `ContentStore` and linking the video into
+    its output directory, a video already in the store is only linked
+    """
+
+    def __init__(self, backend, store):
+        super(StoredBackend, self).__init__(backend.output_path)
+        self.backend = backend
+        self.store = store
+        self.name = backend.name
+
+    def download(self, bvid, on_progress=None):
+        self.failure = None
+        self.message = None
+        key = store_key(bvid)
+        # another favorite may be downloading the same video
+        claim = self.store.claim(key)
+        claim.acquire()
+        try:
+            if self.store.has(key):
+                metrics.inc("bilifav_dedup_total", stage="download")
+                return True, self.store.link(key, self.output_path)
+            self.backend.output_path = self.store.incoming_path(key)
+            os.makedirs(self.backend.output_path, exist_ok=True)
+            ok, size = self.backend.download(bvid, on_progress)
+            if not ok:
+                self.failure = self.backend.failure
+                self.message = self.backend.message
+                return False, size
+            if isinstance(size, Future):
+                # committed once post-processed, the claim is held till then
+                linked = Future()
+                size.add_done_callback(
+                    lambda future, held=claim: self.commit_later(
+                        key, future, linked, held
+                    )
+                )
+                claim = None
+                return True, linked
+            self.store.commit(key)
+            return True, self.store.link(key, self.output_path)
+        finally:
+            if claim is not None:
+                claim.release()
+
+    def commit_later(self, key, future, linked, claim):
+        try:
+            future.result()
+            self.store.commit(key)
+            linked.set_result(self.store.link(key, self.output_path))
+        except BaseException as e:
+            linked.set_exception(e)
+        finally:
+            claim.release()
+
+    def partial_paths(self):
+        return self.backend.partial_paths()
+
+    def reset(self, paused=False):
+        self.backend.reset(paused)
+
+    def stop(self):
+        self.backend.stop()
+
+    def pause(self):
+        self.backend.pause()
+
+    def resume(self):
+        self.backend.resume()
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+from .api import ApiError, fetch_listing, iter_pages, space_detail_url
+from .backend import DEFAULT_BACKEND, get_backend, part_job
+from .concurrency import AdaptiveConcurrency
+from .failures import PERMANENT, STOPPED, Failure
+from .index import DownloadIndex
+from .journal import DONE, FAILED, JOURNAL_INTERVAL, QUEUED, RUNNING, Journal
+from .metrics import diff, metrics
+from .ordering import DEFAULT_ORDER, get_order
+from .postprocess import post
+from .progress import REPORT_INTERVAL, Progress
+from .scheduler import DownloadQueue
+from .store import StoredBackend, store_key
+from .worker import Worker
+
+# default number of videos downloaded at the same time
+MAX_JOBS = 4
+# summary of the last sync of a favorite, kept in the output directory
+SUMMARY_NAME = ".summary-{}.json"
+
+
+def batch_videos(backend, store, batch_size):
+    """
+    Videos downloaded with one run of `backend`, one unless it is
+    `batched`: the videos of the content `store` each go to their own
+    directory, so they are downloaded one by one
+    """
+    if store is not None or not get_backend(backend).batched:
+        return 1
+    return max(1, batch_size)
+
+
+def make_backend(backend, output_path, store=None):
+    """
+    Return a downloader of the `backend` class into `output_path`, linking
+    the videos of the content `store` instead when one is given
+    """
+    downloader = backend(output_path)
+    if store is not None:
+        downloader = StoredBackend(downloader, store)
+    return downloader
+
+
+def expand_parts(media):
+    """
+    Split a multi-part video into a media per part, named by `part_job`, so
+    that its parts are downloaded in parallel and retried on their own
+    """
+    pages = media.get("page") or 1
+    if pages < 2:
+        return [media]
+    return [
+        dict(
+            media,
+            bvid=part_job(media["bvid"], page),
+            title=f"{media.get('title')} P{page}",
+        )
+        for page in range(1, pages + 1)
+    ]
+
+
+class Sync:
+    """
+    Download the videos of a favorite into `output_path`
+
+    Each part of a multi-part video is a job of its own. At most `jobs`
+    videos or parts are downloaded at the same time, by the downloader
+    `backend`, while the listing pages are fetched and fed into the queue.
+    With `adaptive`, `jobs` is only the most workers, the number of videos
+    downloaded at the same time follows an `AdaptiveConcurrency`.
+    `batch_size` is the most videos a worker downloads with one annie run,
+    see `Worker`. The queued videos are downloaded in the `order` of
+    `ORDERS`, among the ones listed so far.
+    Videos recorded as downloaded in the index of the output directory are
+    skipped, and videos found in the content `store` are linked into
+    `output_path` instead of queued.
+
+    A video that failed for a transient reason is retried after a backoff
+    starting at `retry_delays`, see `retry_delay`, one that failed for good
+    is put on the dead-letter list of the index, and the ones that are
+    unavailable are not tried again by later syncs.
+    `missing` maps the videos still missing to their `Failure`.
+
+    `on_progress(stats)` is called with the `ProgressStats` of the whole
+    favorite every `REPORT_INTERVAL` seconds, `on_complete(bvid)` and
+    `on_error(bvid)` after each video, `on_retry(bvid)` when a video is
+    put back for a retry, all from the sync's own threads.
+    A JSON summary of the sync is written to the output directory at the end.
+
+    A sync that is part of a `Batch` queues its videos into a lane of the
+    batch and leaves the downloads to the workers of the batch
+    """
+
+    def __init__(
+        self,
+        media_id,
+        output_path,
+        jobs=MAX_JOBS,
+        backend=DEFAULT_BACKEND,
+        media_counts=None,
+        first_page_medias=None,
+        on_progress=None,
+        on_complete=None,
+        on_error=None,
+        on_retry=None,
+        batch=None,
+        store=None,
+        adaptive=False,
+        batch_size=1,
+        order=DEFAULT_ORDER,
+        retry_delays=None,
+    ):
+        self.media_id = media_id
+        self.output_path = output_path
+        self.jobs = jobs
+        self.backend = get_backend(backend)
+        self.media_counts = media_counts
+        self.page_medias = first_page_medias
+        # whether the first page was fetched past the cache
+        self.fresh = False
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.on_retry = on_retry
+        self.store = store
+        self.adaptive = adaptive
+        self.batch_size = batch_videos(backend, store, batch_size)
+        # sort key of the medias in the queue
+        self.order = get_order(order)
+
+        self.batch = batch
+        if batch is None:
+            self.queue = DownloadQueue(retry_delays=retry_delays)
+        else:
+            self.queue = batch.lane(self)
+        self.threads = []
+        self.index = None
+        self.journal = None
+        # bvid -> when its progress was last journaled
+        self.journaled = {}
+        # videos or parts listed and skipped because an earlier sync
+        # downloaded them, the ones older than the last sync are not listed
+        self.skipped = 0
+        # videos linked from the content store
+        self.linked = 0
+        # videos skipped because they are unavailable, and retries
+        self.unavailable = 0
+        self.retries = 0
+        # bvid -> Failure of the videos given up on
+        self.missing = {}
+        self.progress = Progress()
+        self.reported = threading.Event()
+        self.stopped = False
+
+    def run(self):
+        """download the whole favorite, return whether every video succeeded"""
+        started = time.time()
+        before = metrics.snapshot()
+        ok = None
+        try:
+            ok = self.fetch_and_download()
+            return ok
+        finally:
+            self.write_summary(started, before, ok)
+            if self.batch is None:
+                # the threads of the pool are not needed until the next sync
+                post.close()
+
+    def fetch_first_page(self):
+        """
+        Fetch the first listing page past the cache, where the videos
+        favorited since the last sync show up
+        """
+        listing = fetch_listing(self.media_id, 1, fresh=True)
+        if listing.get("code") != 0:
+            raise ApiError(
+                space_detail_url(self.media_id, 1),
+                listing.get("code"),
+                listing.get("message"),
+            )
+        data = listing["data"]
+        self.media_counts = data["info"]["media_count"]
+        self.page_medias = data["medias"] or []
+        self.fresh = True
+
+    def fetch_and_download(self):
+        if self.media_counts is None:
+            self.fetch_first_page()
+
+        if self.batch is not None:
+            # the batch owns the index and the journal
+            self.index = self.batch.index
+            self.journal = self.batch.journal
+            return self.download()
+
+        os.makedirs(self.output_path, exist_ok=True)
+        self.index = DownloadIndex(self.output_path)
+        self.journal = Journal(self.output_path)
+        try:
+            return self.download()
+        finally:
+            self.journal.compact()
+            self.journal.close()
+            self.index.close()
+
+    def download(self):
+        if self.batch is None:
+            self.start_workers()
+        else:
+            self.threads = self.batch.workers
+        reporter = threading.Thread(target=self.report, daemon=True)
+        reporter.start()
+
+        ok = True
+        try:
+            # queue videos for the workers as soon as their page arrives
+            for media in self.new_medias():
+                if self.stopped:
+                    break
+                if self.link(media["bvid"]):
+                    continue
+                self.journal.record(self.media_id, media["bvid"], QUEUED)
+                self.queue.put(media["bvid"], self.order(media))
+        except Exception as e:
+            print(e)
+            ok = False
+        finally:
+            self.queue.close()
+
+        # wait for the queued videos, then for the workers to exit
+        self.queue.join()
+        if self.batch is None:
+            for t in self.threads:
+                t.join()
+        self.reported.set()
+        reporter.join()
+        return ok and not self.queue.failed and not self.stopped
+
+    def write_summary(self, started, before, ok):
+        """
+        Write what the sync did to the output directory, the metrics are the
+        ones of the whole process while the sync ran
+        """
+        finished = time.time()
+        summary = {
+            "media_id": str(self.media_id),
+            "started": started,
+            "finished": finished,
+            "elapsed": finished - started,
+            # None if the sync raised
+            "ok": ok,
+            "stopped": self.stopped,
+            "downloaded": self.queue.finished - self.queue.failed,
+            "failed": self.queue.failed,
+            "skipped": self.skipped,
+            "linked": self.linked,
+            "unavailable": self.unavailable,
+            "retries": self.retries,
+            "missing": [
+                dict(failure._asdict(), bvid=bvid)
+                for bvid, failure in self.missing.items()
+            ],
+            "bytes": self.progress.finished_bytes,
+            "metrics": diff(before, metrics.snapshot()),
+        }
+        path = os.path.join(self.output_path, SUMMARY_NAME.format(self.media_id))
+        try:
+            os.makedirs(self.output_path, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(e)
+
+    def link(self, bvid):
+        """link a video of the content store, return whether it was there"""
+        if self.store is None:
+            return False
+        size = self.store.link(store_key(bvid), self.output_path)
+        if size is None:
+            return False
+        self.linked += 1
+        metrics.inc("bilifav_dedup_total", stage="queue")
+        self.index.mark_done(self.media_id, bvid, size)
+        self.journal.record(self.media_id, bvid, DONE)
+        return True
+
+    def make_backend(self):
+        return make_backend(self.backend, self.output_path, self.store)
+
+    def start_workers(self):
+        # no more workers than videos to download
+        jobs = max(1, min(self.jobs, self.media_counts))
+        concurrency = AdaptiveConcurrency(jobs) if self.adaptive else None
+        for _ in range(jobs):
+            t = Worker(
+                self.queue,
+                self.make_backend(),
+                on_start=self.start_slot,
+                on_progress=self.progress_slot,
+                on_complete=self.complete_slot,
+                on_error=self.error_slot,
+                on_retry=self.retry_slot,
+                concurrency=concurrency,
+                batch_size=self.batch_size,
+                peers=jobs,
+            )
+            t.start()
+            self.threads.append(t)
+
+    def workers(self):
+        """the workers downloading a video of this sync"""
+        return [t for t in self.threads if t.lane is self.queue]
+
+    def new_medias(self):
+        """
+        Yield the medias to download, skipping the ones downloaded before
+
+        The listing is ordered by fav time, so once it reaches a video
+        favorited before the last sync, the remaining pages are not fetched
+        """
+        since = self.index.last_sync(self.media_id)
+        completed = self.index.completed(self.media_id)
+        # unavailable videos given up on by an earlier sync
+        dead = {
+            letter["bvid"]: letter
+            for letter in self.index.dead_letters(self.media_id, PERMANENT)
+        }
+        seen = set()
+        # resume the jobs interrupted by the last run first
+        for record in self.journal.unfinished(self.media_id):
+            if record["bvid"] not in completed and not self.is_dead(record, dead):
+                seen.add(record["bvid"])
+                yield {"bvid": record["bvid"]}
+        # then retry the videos left unfinished by the last sync
+        for media in self.index.pending(self.media_id):
+            if media["bvid"] in seen or self.is_dead(media, dead):
+                continue
+            seen.add(media["bvid"])
+            yield media
+
+        newest = since
+        if since and not self.fresh:
+            # the first page given may be a cached one from before the
+            # latest favorites
+            self.fetch_first_page()
+        # stopping early needs the pages in order, and pages as they are now
+        for medias in iter_pages(
+            self.media_id,
+            self.media_counts,
+            self.page_medias,
+            ordered=bool(since) or self.jobs == 1,
+            fresh=bool(since),
+        ):
+            for media in medias:
+                fav_time = media.get("fav_time") or 0
+                if since and fav_time <= since:
+                    self.index.set_last_sync(self.media_id, newest)
+                    return
+                newest = max(newest, fav_time)
+                for part in expand_parts(media):
+                    if part["bvid"] in seen:
+                        # queued above from the journal or the index
+                        continue
+                    if part["bvid"] in completed:
+                        self.skipped += 1
+                        continue
+                    if self.is_dead(part, dead):
+                        continue
+                    seen.add(part["bvid"])
+                    self.index.add(self.media_id, part)
+                    yield part
+        self.index.set_last_sync(self.media_id, newest)
+
+    def is_dead(self, media, dead):
+        """
+        Whether a media is on the dead-letter list in `dead`, counting it
+        as missing the first time
+        """
+        letter = dead.get(media["bvid"])
+        if letter is None:
+            return False
+        if media["bvid"] not in self.missing:
+            self.unavailable += 1
+            self.missing[media["bvid"]] = Failure(
+                *(letter[key] for key in Failure._fields)
+            )
+        return True
+
+    def total_counts(self):
+        """videos to download in this sync"""
+        if self.queue.closed:
+            return max(self.queue.submitted, 1)
+        left = self.media_counts - self.skipped - self.linked - self.unavailable
+        return max(left, self.queue.submitted, 1)
+
+    def report(self):
+        while True:
+            done = self.reported.wait(REPORT_INTERVAL)
+            if self.on_progress:
+                self.on_progress(self.progress.snapshot(self.total_counts()))
+            if done:
+                break
+
+    def start_slot(self, bvid):
+        self.journaled[bvid] = time.monotonic()
+        self.journal.record(self.media_id, bvid, RUNNING)
+
+    def progress_slot(self, bvid, done, total, per):
+        self.progress.update(bvid, done, total, per)
+        now = time.monotonic()
+        if now - self.journaled.get(bvid, 0) >= JOURNAL_INTERVAL:
+            self.journaled[bvid] = now
+            paths = [
+                path
+                for t in self.workers()
+                if t.bvid == bvid
+                for path in t.backend.partial_paths()
+            ]
+            self.journal.record(self.media_id, bvid, RUNNING, paths, done)
+
+    def complete_slot(self, bvid, size):
+        self.journaled.pop(bvid, None)
+        self.progress.finish(bvid, True, size)
+        self.index.mark_done(self.media_id, bvid, size)
+        self.journal.record(self.media_id, bvid, DONE)
+        if self.on_complete:
+            self.on_complete(bvid)
+
+    def error_slot(self, bvid, failure=None):
+        self.journaled.pop(bvid, None)
+        self.progress.finish(bvid, False)
+        # aborted by `stop`, resume it first next time
+        if not self.stopped and (failure is None or failure.kind != STOPPED):
+            self.journal.record(self.media_id, bvid, FAILED)
+            if failure is not None:
+                self.missing[bvid] = failure
+                self.index.add_dead_letter(self.media_id, bvid, failure)
+        if self.on_error:
+            self.on_error(bvid)
+
+    def retry_slot(self, bvid, kind, delay):
+        self.retries += 1
+        self.journaled.pop(bvid, None)
+        # waiting for its retry, not running
+        self.progress.remove(bvid)
+        if self.on_retry:
+            self.on_retry(bvid)
+
+    def stop(self):
+        """drop the queued videos and abort the running downloads"""
+        self.stopped = True
+        # let the workers exit once their current video is aborted, a
+        # worker that took a video before sees the queue cancelled
+        self.queue.cancel()
+        for t in self.workers():
+            t.backend.stop()
+
+    def pause(self):
+        """
+        Hand out no more videos and suspend the running downloads until
+        `resume`, keeping what they downloaded. In a batch, the running
+        videos of the favorite finish instead, see `Batch.pause`
+        """
+        self.queue.pause()
+        if self.batch is None:
+            for t in self.threads:
+                t.pause()
+
+    def resume(self):
+        if self.batch is None:
+            for t in self.threads:
+                t.resume()
+        self.queue.resume()
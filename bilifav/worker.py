@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from concurrent.futures import Future
+
+from .backend import Stopped
+from .failures import STOPPED, Failure, classify, error_text
+from .metrics import RATE_BUCKETS, metrics
+
+
+def finish_job(lane, bvid, ok, size, failure, message, callbacks=(None, None, None)):
+    """
+    Count a downloaded video as finished in its queue `lane`, or put it back
+    for a retry if it failed for a transient reason, and call the matching
+    `(on_complete, on_error, on_retry)` of `callbacks`, see `Worker`. Return
+    the kind of the failure, None if the video succeeded
+    """
+    on_complete, on_error, on_retry = callbacks
+    if ok:
+        lane.task_done(True)
+        if on_complete:
+            on_complete(bvid, size)
+        return None
+    kind = classify(failure, message)
+    delay = lane.retry(bvid, kind)
+    if delay is not None:
+        metrics.inc("bilifav_retries_total", kind=kind)
+        if on_retry:
+            on_retry(bvid, kind, delay)
+        return kind
+    # count the video as finished even if it failed
+    lane.task_done(False)
+    if kind != STOPPED:
+        metrics.inc("bilifav_dead_letters_total", kind=kind)
+    if on_error:
+        on_error(bvid, Failure(kind, failure, message, lane.attempts[bvid]))
+    return kind
+
+
+def record_job(ok, size, failure, elapsed):
+    """count a finished download in the metrics"""
+    metrics.inc("bilifav_jobs_total", result="ok" if ok else "failed")
+    metrics.observe("bilifav_job_seconds", elapsed)
+    if not ok:
+        metrics.inc("bilifav_failures_total", reason=failure or "unknown")
+    elif size and elapsed > 0:
+        metrics.observe(
+            "bilifav_job_bytes_per_second", size / elapsed, buckets=RATE_BUCKETS
+        )
+
+
+# download videos from the queue using a backend
+class Worker(threading.Thread):
+    """
+    Worker downloading the videos of the queue one after another
+
+    The callbacks are called from the worker thread: `on_start(bvid)` and
+    `on_progress(bvid, done, total, percent)` while a video downloads, then
+    `on_complete(bvid, size)` or `on_error(bvid, failure)`, with the
+    `Failure` of the video, once it is counted as finished. A video that
+    failed for a transient reason is put back into its queue for a retry
+    instead, with `on_retry(bvid, kind, delay)`. With an
+    `AdaptiveConcurrency`, a worker waits for a slot of it before taking
+    each video, and gives it back with the kind of the last failure.
+
+    With a `batch_size` above 1 and a `batched` backend, a worker takes up
+    to `batch_size` videos at once and downloads them with one run of the
+    backend, fewer when the queue is short, so that its `peers` get their
+    share of the last videos.
+
+    `pause` suspends the running download and the next ones until
+    `resume`, while the queue keeps the waiting videos. A worker checks
+    whether its queue was cancelled once it took its videos, so that a
+    stop never misses a download about to begin
+    """
+
+    def __init__(
+        self,
+        queue,
+        backend,
+        on_start=None,
+        on_progress=None,
+        on_complete=None,
+        on_error=None,
+        on_retry=None,
+        concurrency=None,
+        batch_size=1,
+        peers=1,
+    ):
+        super(Worker, self).__init__(daemon=True)
+        self.queue = queue
+        self.backend = backend
+        # video being downloaded and the queue it came from
+        self.bvid = None
+        self.lane = None
+        self.on_start = on_start
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.on_retry = on_retry
+        # kind of the last failure of the worker, None if it succeeded
+        self.kind = None
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.peers = peers
+        # held while the lane and the backend change, or are paused
+        self.lock = threading.Lock()
+        self.paused = False
+
+    def run(self):
+        while True:
+            self.acquire()
+            bvids = self.queue.get_batch(self.batch_size, self.share())
+            if bvids is None:
+                self.release()
+                break
+            self.kind = None
+            self.process_batch(self.queue, bvids)
+            self.release(self.kind)
+
+    def share(self):
+        """workers the queued videos are spread over"""
+        if self.concurrency:
+            return self.concurrency.target
+        return self.peers
+
+    def acquire(self):
+        if self.concurrency:
+            self.concurrency.acquire()
+
+    def release(self, kind=None):
+        if self.concurrency:
+            self.concurrency.release(kind)
+
+    def begin(self, lane):
+        """
+        Take the videos of `lane` with the backend, return False if the
+        lane was cancelled meanwhile. From now on, a stop of the lane
+        finds the worker downloading its videos
+        """
+        with self.lock:
+            self.lane = lane
+            self.backend.reset(self.paused)
+        return not lane.cancelled
+
+    def pause(self):
+        """suspend the running download and the next ones until `resume`"""
+        with self.lock:
+            self.paused = True
+            if self.backend is not None:
+                self.backend.pause()
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            if self.backend is not None:
+                self.backend.resume()
+
+    def process(self, lane, bvid):
+        self.lane = lane
+        self.bvid = bvid
+        if self.on_start:
+            self.on_start(bvid)
+        start = time.perf_counter()
+        ok, size = self.download(bvid)
+        self.bvid = None
+        self.lane = None
+        self.complete(lane, bvid, ok, size, start)
+
+    def process_batch(self, lane, bvids):
+        """download `bvids` with one run of the backend"""
+        if not self.begin(lane):
+            start = time.perf_counter()
+            for bvid in bvids:
+                self.finish(lane, bvid, False, None, "stopped", None, start)
+            self.lane = None
+            return
+        if len(bvids) == 1:
+            self.process(lane, bvids[0])
+            return
+        self.lane = lane
+        for bvid in bvids:
+            if self.on_start:
+                self.on_start(bvid)
+        pending = list(bvids)
+        # a video of the batch starts when the one before it is done
+        start = time.perf_counter()
+        # bytes of each video counted into the throughput of the pool
+        counted = dict.fromkeys(bvids, 0)
+
+        def on_progress(bvid, done, total, percent):
+            self.bvid = bvid
+            if self.concurrency:
+                self.concurrency.add_bytes(max(done - counted[bvid], 0))
+                counted[bvid] = done
+            if self.on_progress:
+                self.on_progress(bvid, done, total, percent)
+
+        def on_result(bvid, ok, size):
+            nonlocal start
+            pending.remove(bvid)
+            if ok and isinstance(size, int) and self.concurrency:
+                self.concurrency.add_bytes(max(size - counted[bvid], 0))
+            self.complete(lane, bvid, ok, size, start)
+            start = time.perf_counter()
+
+        try:
+            self.backend.download_batch(bvids, on_progress, on_result)
+        except Exception as e:
+            print(e)
+            self.backend.failure = type(e).__name__
+            self.backend.message = error_text(e)
+        # the videos the backend gave up on without a result
+        for bvid in list(pending):
+            self.finish(
+                lane,
+                bvid,
+                False,
+                None,
+                self.backend.failure,
+                self.backend.message,
+                start,
+            )
+        self.bvid = None
+        self.lane = None
+
+    def complete(self, lane, bvid, ok, size, start):
+        """finish a downloaded video, once post-processed if `size` is a future"""
+        # the worker may serve another sync by the time the video is
+        # post-processed
+        callbacks = (self.on_complete, self.on_error, self.on_retry)
+        if isinstance(size, Future):
+            # finished by the post-processing pool, take the next video
+            size.add_done_callback(
+                lambda future: self.finish(
+                    lane, bvid, *self.settle(future), start, callbacks
+                )
+            )
+            return
+        failure, message = self.backend.failure, self.backend.message
+        self.finish(lane, bvid, ok, size, failure, message, start, callbacks)
+
+    def finish(self, lane, bvid, ok, size, failure, message, start, callbacks=None):
+        record_job(ok, size, failure, time.perf_counter() - start)
+        kind = finish_job(
+            lane,
+            bvid,
+            ok,
+            size,
+            failure,
+            message,
+            callbacks or (self.on_complete, self.on_error, self.on_retry),
+        )
+        if kind is not None:
+            self.kind = kind
+
+    @staticmethod
+    def settle(future):
+        """
+        Return whether a post-processed video succeeded, its size, failure
+        and error output
+        """
+        try:
+            return True, future.result(), None, None
+        except Stopped:
+            return False, None, "stopped", None
+        except Exception as e:
+            print(e)
+            return False, None, "mux", error_text(e)
+
+    def download(self, bvid):
+        on_progress = None
+        # bytes of the video counted into the throughput of the pool
+        counted = 0
+        if self.on_progress or self.concurrency:
+
+            def on_progress(done, total, percent):
+                nonlocal counted
+                if self.concurrency:
+                    # annie starts again from 0 for each stream
+                    self.concurrency.add_bytes(max(done - counted, 0))
+                    counted = done
+                if self.on_progress:
+                    self.on_progress(bvid, done, total, percent)
+
+        try:
+            ok, size = self.backend.download(bvid, on_progress)
+        except Exception as e:
+            print(e)
+            self.backend.failure = type(e).__name__
+            self.backend.message = error_text(e)
+            return False, None
+        if ok and isinstance(size, int) and self.concurrency:
+            self.concurrency.add_bytes(max(size - counted, 0))
+        return ok, size
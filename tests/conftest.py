@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+from bilifav import api, cache
+
+# the stand-ins of api.bilibili.com and annie of the benchmarks
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+sys.path.insert(0, BENCHMARKS)
+
+from fake_api import FakeApi  # noqa: E402
+from run import make_annie  # noqa: E402
+
+# bytes of each video of the fake annie
+VIDEO_SIZE = 4096
+
+
+@pytest.fixture(autouse=True)
+def listing_cache(tmp_path, monkeypatch):
+    """a listing cache of its own for each test"""
+    monkeypatch.setattr(cache, "cache", cache.DiskCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(api, "cache", cache.cache)
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    """start a `FakeApi` of favorites of `count` videos, stopped after the test"""
+    servers = []
+
+    def start(count, server_class=FakeApi):
+        server = server_class(count).start()
+        servers.append(server)
+        monkeypatch.setattr(api, "API_BASE", server.url)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def fake_annie(tmp_path, monkeypatch):
+    """put the fake annie of the benchmarks first in PATH"""
+    bin_dir = str(tmp_path / "bin")
+    make_annie(bin_dir)
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("BENCH_VIDEO_SIZE", str(VIDEO_SIZE))
+    monkeypatch.setenv("BENCH_REFRESH", "0.01")
+    return bin_dir
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+from bilifav import annie
+from bilifav.annie import AnnieBackend, find_job, video_url
+
+BV1 = "BV1xx411c7mD"
+BV2 = "BV1Zs411c7mE"
+BV3 = "BV1Ab411c7mF"
+
+
+def block(title, size):
+    """the info block annie prints before downloading a video"""
+    return (
+        "\n"
+        " Site:      哔哩哔哩 bilibili.com\n"
+        f" Title:     {title}\n"
+        " Type:      video\n"
+        " Stream:   \n"
+        "     [default]  -------------------\n"
+        "     Quality:         高清 1080P\n"
+        f"     Size:            {size / 1024**2:.2f} MiB ({size} Bytes)\n"
+        "     # download with: annie -f default ...\n"
+        "\n"
+    )
+
+
+def bars(size):
+    """progress bars redrawn with `\\r`, then the merge of the streams"""
+    mib = size / 1024**2
+    return (
+        f"\r {mib / 4:.2f} MiB / {mib:.2f} MiB [==>---------]  25.00% 1.00 MiB/s 3s"
+        f"\r {mib:.2f} MiB / {mib:.2f} MiB [============] 100.00% 1.00 MiB/s 0s"
+        "\nMerging video parts into video.mp4\n"
+    )
+
+
+def error(bvid, reason="request error: HTTP 412"):
+    return f"Downloading {video_url(bvid)} error:\n{reason}\n"
+
+
+@pytest.fixture
+def replay(monkeypatch, tmp_path):
+    """make annie print `output` and exit with `code`, or by SIGKILL if None"""
+
+    def install(output, code=0):
+        recorded = tmp_path / "annie.out"
+        recorded.write_bytes(output.encode())
+        exit = "os.kill(os.getpid(), 9)" if code is None else f"sys.exit({code})"
+        script = (
+            "import os, sys\n"
+            f"sys.stdout.buffer.write(open({str(recorded)!r}, 'rb').read())\n"
+            "sys.stdout.flush()\n"
+            f"{exit}\n"
+        )
+        spawn = annie.spawn
+        monkeypatch.setattr(
+            annie,
+            "spawn",
+            lambda cmd, **kw: spawn([sys.executable, "-c", script], **kw),
+        )
+
+    return install
+
+
+def run(bvids, tmp_path):
+    backend = AnnieBackend(str(tmp_path))
+    results = {}
+    progress = {}
+
+    def on_result(bvid, ok, size):
+        results[bvid] = ok, size, backend.failure, backend.message
+
+    def on_progress(bvid, done, total, percent):
+        progress.setdefault(bvid, []).append((done, total))
+
+    backend.download_batch(bvids, on_progress, on_result)
+    return results, progress
+
+
+def test_find_job_prefers_longest_url():
+    urls = {video_url(f"{BV1}-1"): "p1", video_url(f"{BV1}-12"): "p12"}
+    line = f"Downloading {video_url(BV1 + '-12')} error:".encode()
+    assert find_job(line, urls) == "p12"
+    assert find_job(b"request error: HTTP 412", urls) is None
+
+
+def test_blocks_follow_url_order(replay, tmp_path, monkeypatch):
+    # report every bar
+    monkeypatch.setattr(annie, "PROGRESS_INTERVAL", 0)
+    replay(block("a", 1048576) + bars(1048576) + block("b", 2097152) + bars(2097152))
+    results, progress = run([BV1, BV2], tmp_path)
+    assert results == {
+        BV1: (True, 1048576, None, None),
+        BV2: (True, 2097152, None, None),
+    }
+    assert progress[BV1] == [(262144, 1048576), (1048576, 1048576)]
+    assert progress[BV2] == [(524288, 2097152), (2097152, 2097152)]
+
+
+def test_error_without_block(replay, tmp_path):
+    output = (
+        block("a", 1048576)
+        + bars(1048576)
+        + error(BV2)
+        + block("c", 3145728)
+        + bars(3145728)
+    )
+    replay(output, 1)
+    results, progress = run([BV1, BV2, BV3], tmp_path)
+    assert results[BV1] == (True, 1048576, None, None)
+    assert results[BV2] == (False, None, "annie_exit", "request error: HTTP 412")
+    assert results[BV3] == (True, 3145728, None, None)
+    assert BV2 not in progress
+
+
+def test_error_after_block(replay, tmp_path):
+    output = (
+        block("a", 1048576)
+        + error(BV1, "read tcp 10.0.0.2:50000: connection reset by peer")
+        + block("b", 2097152)
+        + bars(2097152)
+    )
+    replay(output, 1)
+    results, _ = run([BV1, BV2], tmp_path)
+    assert results[BV1][:3] == (False, 1048576, "annie_exit")
+    assert "connection reset" in results[BV1][3]
+    assert results[BV2] == (True, 2097152, None, None)
+
+
+def test_last_video_fails(replay, tmp_path):
+    replay(block("a", 1048576) + bars(1048576) + error(BV2), 1)
+    results, _ = run([BV1, BV2], tmp_path)
+    assert results[BV1][0] is True
+    assert results[BV2][:3] == (False, None, "annie_exit")
+
+
+@pytest.mark.skipif(os.name != "posix", reason="killed by a signal")
+def test_killed_in_the_middle(replay, tmp_path):
+    replay(block("a", 1048576) + bars(1048576) + block("b", 2097152), None)
+    results, _ = run([BV1, BV2, BV3], tmp_path)
+    assert results[BV1][0] is True
+    assert results[BV2][:3] == (False, 2097152, "killed")
+    assert results[BV3][:3] == (False, None, "killed")
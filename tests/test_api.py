@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from bilifav.api import PAGE_SIZE, fetch_listing, iter_pages
+
+# put on the path by conftest.py
+from fake_api import FakeApi
+
+PAGES = 6
+COUNT = PAGE_SIZE * PAGES
+
+
+class SlowPages(FakeApi):
+    """answers page 2 last, and counts the listing requests running at once"""
+
+    def __init__(self, count):
+        super(SlowPages, self).__init__(count)
+        self.running = 0
+        self.most = 0
+        self.pages = []
+
+    def handle(self, path):
+        page = int(parse_qs(urlsplit(path).query)["pn"][0])
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        time.sleep(0.3 if page == 2 else 0.05)
+        with self.lock:
+            self.running -= 1
+            self.pages.append(page)
+        return super(SlowPages, self).handle(path)
+
+
+def first_page(server):
+    data = fetch_listing("1", 1)["data"]
+    server.pages.clear()
+    return data["info"]["media_count"], data["medias"]
+
+
+def page_numbers(pages):
+    """the listing page of each yielded page, from the index of its first video"""
+    return [page[0]["id"] // PAGE_SIZE + 1 for page in pages]
+
+
+def test_pages_fetched_concurrently(fake_api):
+    server = fake_api(COUNT, SlowPages)
+    pages = list(iter_pages("1", *first_page(server), max_fetches=3))
+    assert sum(len(page) for page in pages) == COUNT
+    assert server.most == 3
+    # yielded as they arrive, the slow page 2 last
+    numbers = page_numbers(pages)
+    assert numbers[0] == 1 and numbers[-1] == 2
+    assert sorted(numbers) == list(range(1, PAGES + 1))
+
+
+def test_ordered_pages(fake_api):
+    server = fake_api(COUNT, SlowPages)
+    pages = iter_pages("1", *first_page(server), ordered=True)
+    assert page_numbers(pages) == list(range(1, PAGES + 1))
+
+
+def test_early_stop_cancels_fetches(fake_api):
+    server = fake_api(COUNT, SlowPages)
+    pages = iter_pages("1", *first_page(server), max_fetches=1, ordered=True)
+    next(pages)
+    next(pages)
+    pages.close()
+    time.sleep(0.3)
+    # the page being fetched at most, not the remaining ones
+    assert len(server.pages) <= 2
+    assert server.running == 0
+
+
+def test_fresh_pages_bypass_the_cache(fake_api):
+    server = fake_api(COUNT, SlowPages)
+    count, medias = first_page(server)
+    list(iter_pages("1", count, medias))
+    server.pages.clear()
+    list(iter_pages("1", count, medias))
+    assert server.pages == []
+    list(iter_pages("1", count, medias, fresh=True))
+    assert sorted(server.pages) == list(range(2, PAGES + 1))
+
+
+def test_single_page(fake_api):
+    server = fake_api(3, SlowPages)
+    count, medias = first_page(server)
+    assert list(iter_pages("1", count, medias)) == [medias]
+    assert server.pages == []
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from bilifav.cache import DiskCache
+
+
+def test_created_on_first_use(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    cache = DiskCache()
+    assert os.listdir(tmp_path) == []
+    assert cache.get("key") is None
+    assert os.listdir(tmp_path) == ["bili-favorite-downloader"]
+
+
+def test_ttl(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"))
+    cache.put("key", b"data")
+    assert cache.get("key", 60) == b"data"
+    path = os.path.join(cache.path, os.listdir(cache.path)[0])
+    # stored two minutes ago
+    stored = os.stat(path).st_mtime - 120
+    os.utime(path, (stored, stored))
+    assert cache.get("key", 60) is None
+    assert cache.get("key") == b"data"
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (b"aaaa", b"cccc")
+    # found again by the next process
+    assert DiskCache(str(tmp_path)).get("a") == b"aaaa"
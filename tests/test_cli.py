@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from bilifav import cli
+from bilifav.failures import RETRY_DELAYS
+from bilifav.sync import MAX_JOBS
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """the calls of `sync_all` made by `main`, which downloads nothing"""
+    calls = []
+
+    def sync_all(favorites, output_path, **options):
+        calls.append((favorites, output_path, options))
+        return True
+
+    monkeypatch.setattr(cli, "sync_all", sync_all)
+    # main terminates on SIGTERM like on Ctrl-C, not pytest
+    previous = signal.getsignal(signal.SIGTERM)
+    yield calls
+    signal.signal(signal.SIGTERM, previous)
+
+
+def test_sync_options(calls, tmp_path):
+    url = "https://space.bilibili.com/1/favlist?fid=42&ftype=create"
+    args = ["sync", "7", url, "-o", str(tmp_path), "-j", "3", "--adaptive"]
+    args += ["--retry-delays", "network=2", "--order", "shortest"]
+    assert cli.main(args) == 0
+    [(favorites, output, options)] = calls
+    # the favorite URL is reduced to its id
+    assert (favorites, output) == (["7", "42"], str(tmp_path))
+    assert options["jobs"] == 3 and options["adaptive"]
+    assert options["order"] == "shortest" and options["store"] is None
+    assert options["retry_delays"] == dict(RETRY_DELAYS, network=2.0)
+
+
+def test_sync_defaults(calls):
+    # a space URL is kept, to be expanded into the favorites of the user
+    assert cli.main(["sync", "space.bilibili.com/5/favlist"]) == 0
+    [(favorites, output, options)] = calls
+    assert (favorites, output) == (["space.bilibili.com/5/favlist"], "videos")
+    assert options["jobs"] == MAX_JOBS and not options["adaptive"]
+    assert (options["batch_size"], options["retry_delays"]) == (1, RETRY_DELAYS)
+
+
+def test_failed_sync(calls, monkeypatch):
+    monkeypatch.setattr(cli, "sync_all", lambda *args, **options: False)
+    assert cli.main(["sync", "7"]) == 1
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        [],
+        ["sync"],
+        ["sync", "not-a-favorite"],
+        ["sync", "7", "--limit", "fast"],
+        ["sync", "7", "--schedule", "9-18=1M"],
+        ["sync", "7", "--retry-delays", "slow=1"],
+        ["sync", "7", "--backend", "wget"],
+        ["worker", "http://host:8360", "--order", "shortest"],
+    ],
+)
+def test_bad_arguments(calls, capsys, args):
+    with pytest.raises(SystemExit) as e:
+        cli.main(args)
+    assert e.value.code == 2
+    assert "error:" in capsys.readouterr().err
+    assert calls == []
+
+
+def test_daemon_survives_failed_passes(calls, monkeypatch):
+    passes = []
+
+    def sync_all(favorites, output_path, **options):
+        passes.append(favorites)
+        if len(passes) == 1:
+            raise OSError("network is unreachable")
+        return True
+
+    def sleep(seconds):
+        assert seconds == 0.5
+        if len(passes) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(cli, "sync_all", sync_all)
+    monkeypatch.setattr(cli.time, "sleep", sleep)
+    # stopped like with Ctrl-C
+    assert cli.main(["daemon", "7", "--interval", "0.5"]) == 130
+    assert passes == [["7"]] * 3
+
+
+def test_missing_without_index(calls, tmp_path, capsys):
+    assert cli.main(["missing", "-o", str(tmp_path)]) == 1
+    assert "nothing synced there" in capsys.readouterr().err
+
+
+def test_no_qt_imported():
+    code = "import sys, bilifav.cli; print('PyQt6' in sys.modules)"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert out.strip() == "False"
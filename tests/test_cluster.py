@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from bilifav.cluster import Client, Coordinator, WorkerNode
+from bilifav.index import DownloadIndex
+
+# videos of each favorite
+COUNT = 3
+FAVORITES = ["1", "2"]
+BVIDS = sorted(f"BV{media_id}x{i:07d}" for media_id in FAVORITES for i in range(COUNT))
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def start(target):
+    """run `target` in a thread, return the thread and the list of its result"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(target()), daemon=True)
+    thread.start()
+    return thread, result
+
+
+def start_coordinator(output_path, **options):
+    coordinator = Coordinator(FAVORITES, output_path, port=0, **options)
+    thread, result = start(coordinator.run)
+    wait_for(lambda: coordinator.server is not None)
+    url = f"http://127.0.0.1:{coordinator.server.server_port}"
+    return coordinator, url, thread, result
+
+
+def test_expired_lease_is_downloaded_once(tmp_path, fake_api, fake_annie):
+    fake_api(COUNT)
+    output = str(tmp_path / "coordinator")
+    coordinator, url, thread, result = start_coordinator(output, lease_time=0.5)
+    # a worker that leases a video, then dies
+    client = Client(url)
+    status, dead = client.post("/lease", {"worker": "dead"})
+    assert status == 200 and dead["job"] in BVIDS
+    wait_for(lambda: dead["lease"] not in coordinator.leases)
+    # its late result is refused, the video was put back
+    assert client.post("/complete", {"lease": dead["lease"], "ok": True})[0] == 409
+
+    completed = []
+    nodes = [
+        WorkerNode(
+            url,
+            str(tmp_path / f"worker{i}"),
+            jobs=1,
+            on_complete=lambda bvid, size: completed.append(bvid),
+        )
+        for i in range(2)
+    ]
+    threads = [start(node.run)[0] for node in nodes]
+    for t in threads:
+        t.join(30)
+        assert not t.is_alive()
+    thread.join(10)
+    assert result == [True]
+    # every video counted exactly once, the expired one included
+    assert sorted(completed) == BVIDS
+    index = DownloadIndex(output)
+    assert sorted(b for m in FAVORITES for b in index.completed(m)) == BVIDS
+    index.close()
+    for sync in coordinator.syncs.values():
+        assert (sync.queue.finished, sync.queue.failed) == (COUNT, 0)
+
+
+def test_stopped_node_leases_no_more(tmp_path, fake_api, fake_annie, monkeypatch):
+    fake_api(COUNT)
+    # a few seconds per video
+    monkeypatch.setenv("BENCH_RATE", "1024")
+    coordinator, url, thread, result = start_coordinator(
+        str(tmp_path / "coordinator"), lease_time=1
+    )
+    node = WorkerNode(url, str(tmp_path / "worker"), jobs=1)
+    node_thread, _ = start(node.run)
+    wait_for(lambda: coordinator.leases)
+    [lease] = coordinator.leases.values()
+    node.stop()
+    node_thread.join(5)
+    assert not node_thread.is_alive()
+    # the aborted video is not reported, nothing else was leased
+    assert list(coordinator.leases.values()) == [lease]
+    coordinator.stop()
+    thread.join(10)
+    assert result == [False]
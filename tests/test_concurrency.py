@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+from bilifav import concurrency as concurrency_module
+from bilifav.concurrency import ADJUST_INTERVAL, AdaptiveConcurrency
+from bilifav.failures import NETWORK, THROTTLED, UNAVAILABLE
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """the time seen by the controller, moved on by the test"""
+    now = [1000.0]
+    monkeypatch.setattr(concurrency_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def interval(controller, clock, n):
+    """download `n` bytes in one whole interval"""
+    clock[0] += ADJUST_INTERVAL
+    controller.add_bytes(n)
+
+
+def test_additive_increase(clock):
+    controller = AdaptiveConcurrency(4, start=1)
+    controller.acquire()
+    interval(controller, clock, 1000)
+    assert controller.target == 2
+    controller.acquire()
+    interval(controller, clock, 2000)
+    assert controller.target == 3
+    # a slot is idle, more jobs would not help
+    interval(controller, clock, 4000)
+    assert controller.target == 3
+
+
+def test_last_job_taken_back_without_gain(clock):
+    controller = AdaptiveConcurrency(4, start=1)
+    controller.acquire()
+    interval(controller, clock, 1000)
+    controller.acquire()
+    interval(controller, clock, 2000)
+    assert controller.target == 3
+    controller.acquire()
+    interval(controller, clock, 1000)
+    assert controller.target == 2
+
+
+def test_multiplicative_back_off(clock):
+    controller = AdaptiveConcurrency(8, start=8)
+    for _ in range(3):
+        controller.acquire()
+    controller.release(THROTTLED)
+    assert controller.target == 4
+    # the other failures of the same burst count once
+    controller.release(NETWORK)
+    assert controller.target == 4
+    clock[0] += ADJUST_INTERVAL
+    controller.release(THROTTLED)
+    assert controller.target == 2
+    # not a sign of throttling
+    controller.acquire()
+    clock[0] += ADJUST_INTERVAL
+    controller.release(UNAVAILABLE)
+    assert controller.target == 2
+
+
+def test_clamps(clock):
+    assert AdaptiveConcurrency(3, start=10).target == 3
+    assert AdaptiveConcurrency(0).target == 1
+    controller = AdaptiveConcurrency(2, start=2)
+    controller.acquire()
+    controller.acquire()
+    interval(controller, clock, 1000)
+    assert controller.target == 2
+    controller = AdaptiveConcurrency(8, minimum=2, start=2)
+    controller.acquire()
+    controller.release(THROTTLED)
+    assert controller.target == 2
+
+
+def test_acquire_waits_for_a_slot():
+    controller = AdaptiveConcurrency(4, start=1)
+    controller.acquire()
+    thread = threading.Thread(target=controller.acquire)
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    controller.release()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert controller.running == 1
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from bilifav.failures import THROTTLED, UNAVAILABLE, Failure
+from bilifav.index import DownloadIndex
+
+
+def test_kept_across_reopen(tmp_path):
+    index = DownloadIndex(str(tmp_path))
+    index.add(1, {"bvid": "a", "title": "A", "fav_time": 20})
+    index.add(1, {"bvid": "b", "title": "B", "fav_time": 10})
+    index.mark_done(1, "a", 100)
+    index.set_last_sync(1, 20)
+    index.add_dead_letter(1, "b", Failure(UNAVAILABLE, "ApiError", "HTTP 404", 1))
+    index.add_dead_letter(2, "c", Failure(THROTTLED, "annie_exit", "HTTP 412", 4))
+    index.close()
+
+    index = DownloadIndex(str(tmp_path))
+    assert index.last_sync(1) == 20
+    # never synced
+    assert index.last_sync(2) == 0
+    assert index.completed(1) == {"a"}
+    assert index.pending(1) == [{"bvid": "b", "title": "B", "fav_time": 10}]
+    [letter] = index.dead_letters(1)
+    assert (letter["bvid"], letter["kind"], letter["attempts"]) == ("b", UNAVAILABLE, 1)
+    assert [d["bvid"] for d in index.dead_letters(kinds=[THROTTLED])] == ["c"]
+    index.close()
+
+
+def test_dead_letter_dropped_once_downloaded(tmp_path):
+    index = DownloadIndex(str(tmp_path))
+    index.add(1, {"bvid": "a"})
+    index.add_dead_letter(1, "a", Failure(THROTTLED, "annie_exit", None, 4))
+    index.add_dead_letter(1, "b", Failure(THROTTLED, "annie_exit", None, 4))
+    index.mark_done(1, "a")
+    assert [d["bvid"] for d in index.dead_letters()] == ["b"]
+    assert index.clear_dead_letters(1) == 1
+    assert index.dead_letters() == []
+    index.close()
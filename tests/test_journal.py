@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from bilifav import journal as journal_module
+from bilifav.journal import DONE, FAILED, JOURNAL_NAME, QUEUED, RUNNING, Journal
+
+
+def test_replay_last_state(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.record(1, "a", QUEUED)
+    journal.record(1, "a", RUNNING, ["a.part"], 10)
+    journal.record(1, "b", QUEUED)
+    journal.record(1, "c", DONE)
+    journal.close()
+    journal = Journal(str(tmp_path))
+    assert [r["bvid"] for r in journal.unfinished(1)] == ["a", "b"]
+    assert journal.unfinished(1)[0]["paths"] == ["a.part"]
+    journal.close()
+
+
+def test_torn_line_is_cut_off(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.record(1, "a", QUEUED)
+    journal.close()
+    path = tmp_path / JOURNAL_NAME
+    with open(path, "a") as f:
+        # a record cut short by a crash
+        f.write('{"time": 1, "media_id": "1", "bvid": "b", "sta')
+    journal = Journal(str(tmp_path))
+    journal.record(1, "c", QUEUED)
+    journal.close()
+    # the record after the torn line is not lost with it
+    journal = Journal(str(tmp_path))
+    assert sorted(r["bvid"] for r in journal.unfinished(1)) == ["a", "c"]
+    journal.close()
+    assert path.read_text().count("\n") == 2
+
+
+def test_torn_only_line(tmp_path):
+    path = tmp_path / JOURNAL_NAME
+    path.write_text('{"time": 1, "media_id": "1"')
+    journal = Journal(str(tmp_path))
+    journal.record(1, "a", QUEUED)
+    journal.close()
+    assert [r["bvid"] for r in Journal(str(tmp_path)).unfinished(1)] == ["a"]
+
+
+def test_state_changes_are_synced(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(
+        journal_module.os, "fsync", lambda fd: synced.append(fd) or fsync(fd)
+    )
+    journal = Journal(str(tmp_path))
+    # listed again if lost
+    for bvid in "abc":
+        journal.record(1, bvid, QUEUED)
+    assert synced == []
+    journal.record(1, "a", RUNNING, done=1)
+    # progress of a running job
+    journal.record(1, "a", RUNNING, done=2)
+    journal.record(1, "a", RUNNING, done=3)
+    journal.record(1, "a", DONE)
+    journal.record(1, "b", RUNNING)
+    journal.record(1, "b", FAILED)
+    assert len(synced) == 4
+    journal.close()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from bilifav.metrics import Metrics, diff
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    metrics.inc("bilifav_jobs_total", result="ok")
+    metrics.inc("bilifav_jobs_total", 2, result="ok")
+    metrics.inc("bilifav_jobs_total", result="failed")
+    metrics.set("bilifav_concurrency_target", 3)
+    for value in (0.5, 1, 4):
+        metrics.observe("bilifav_job_seconds", value, buckets=(1, 2))
+    assert metrics.render() == (
+        "# HELP bilifav_jobs_total Videos downloaded, by result\n"
+        "# TYPE bilifav_jobs_total counter\n"
+        'bilifav_jobs_total{result="failed"} 1\n'
+        'bilifav_jobs_total{result="ok"} 3\n'
+        "# HELP bilifav_concurrency_target "
+        "Videos allowed to download at the same time\n"
+        "# TYPE bilifav_concurrency_target gauge\n"
+        "bilifav_concurrency_target 3\n"
+        "# HELP bilifav_job_seconds Time to download a video\n"
+        "# TYPE bilifav_job_seconds histogram\n"
+        'bilifav_job_seconds_bucket{le="1"} 2\n'
+        'bilifav_job_seconds_bucket{le="2"} 2\n'
+        'bilifav_job_seconds_bucket{le="+Inf"} 3\n'
+        "bilifav_job_seconds_sum 5.5\n"
+        "bilifav_job_seconds_count 3\n"
+    )
+
+
+def test_served_and_written(tmp_path):
+    metrics = Metrics()
+    metrics.inc("bilifav_leases_total")
+    server = metrics.serve(0, "127.0.0.1")
+    url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with urllib.request.urlopen(url + "/metrics") as r:
+            assert r.headers["Content-Type"].startswith("text/plain")
+            assert r.read().decode() == metrics.render()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+    path = str(tmp_path / "bilifav.prom")
+    metrics.write(path)
+    assert "bilifav_leases_total 1\n" in open(path).read()
+
+
+def test_spans_traced(tmp_path):
+    metrics = Metrics()
+    path = tmp_path / "trace.jsonl"
+    metrics.set_trace(str(path))
+    with metrics.span("listing", page=2):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.span("mux"):
+            raise ValueError
+    metrics.set_trace(None)
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(s["stage"], s["ok"]) for s in spans] == [("listing", True), ("mux", False)]
+    assert spans[0]["page"] == 2
+    stages = metrics.snapshot()["histograms"]
+    assert stages['bilifav_stage_seconds{stage="mux"}']["count"] == 1
+
+
+def test_diff():
+    metrics = Metrics()
+    metrics.inc("bilifav_jobs_total", result="ok")
+    metrics.observe("bilifav_job_seconds", 1)
+    before = metrics.snapshot()
+    metrics.inc("bilifav_jobs_total", result="ok")
+    metrics.inc("bilifav_retries_total", kind="network")
+    metrics.observe("bilifav_job_seconds", 3)
+    change = diff(before, metrics.snapshot())
+    assert change["counters"] == {
+        'bilifav_jobs_total{result="ok"}': 1,
+        'bilifav_retries_total{kind="network"}': 1,
+    }
+    assert change["histograms"]["bilifav_job_seconds"] == {
+        "count": 1,
+        "sum": 3,
+        "mean": 3,
+        "max": 3,
+    }
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from bilifav import api
+from bilifav.failures import ERROR, NETWORK, THROTTLED, UNAVAILABLE, classify
+from bilifav.native import NativeBackend, SegmentedDownload
+from bilifav.worker import Worker
+
+BVID = "BV1xx411c7mD"
+# not a multiple of the segment size, the last segment is short
+DATA = bytes(range(256)) * 40 + b"tail"
+SEGMENT_SIZE = 1024
+RANGE = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler=None):
+        super(Server, self).__init__(("127.0.0.1", 0), handler or Handler)
+        self.base = f"http://127.0.0.1:{self.server_port}"
+        # `Range` headers of the stream requests
+        self.ranges = []
+        # stream served by the playurl API
+        self.stream = "/stream/ok"
+        # API responses refused with HTTP 200 and a JSON code before the data
+        self.refusals = []
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/x/web-interface/view":
+            self.send_json({"title": query["bvid"][0], "cid": 1, "pages": []})
+        elif url.path == "/x/player/playurl":
+            # a single video stream, kept as it is without ffmpeg
+            stream = {"id": 80, "bandwidth": 1, "baseUrl": self.server.base}
+            stream["baseUrl"] += self.server.stream
+            self.send_json({"dash": {"video": [stream], "audio": None}})
+        elif url.path.startswith("/stream/"):
+            self.send_stream(url.path.rsplit("/", 1)[-1])
+        else:
+            self.send_error(404)
+
+    def send_json(self, data):
+        if self.server.refusals:
+            code = self.server.refusals.pop(0)
+            body = {"code": code, "message": "请求过于频繁"}
+            self.send_body(200, json.dumps(body).encode())
+            return
+        self.send_body(200, json.dumps({"code": 0, "data": data}).encode())
+
+    def send_stream(self, fault):
+        if fault == "missing":
+            self.send_error(404)
+            return
+        start, end = map(int, RANGE.match(self.headers["Range"]).groups())
+        self.server.ranges.append((start, end))
+        body = DATA[start : end + 1]
+        headers = {"Content-Range": f"bytes {start}-{end}/{len(DATA)}"}
+        if fault == "short" and end > start:
+            # fewer bytes than asked for
+            body = body[:-1]
+        if fault == "drop" and end > start:
+            # fewer bytes than announced, then the connection is gone
+            self.send_response(206)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body[:-1])
+            self.close_connection = True
+            return
+        self.send_body(206, body, headers)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class IdleClosingHandler(Handler):
+    # keep-alive connections idle for longer are closed by the server
+    timeout = 0.2
+
+
+def serve(monkeypatch, handler=None):
+    server = Server(handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # `api_url` and the streams point to the local server
+    monkeypatch.setattr(api, "API_BASE", server.base)
+    monkeypatch.setattr(api.api, "backoff", 0.01)
+    return server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = serve(monkeypatch)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def closing_server(monkeypatch):
+    server = serve(monkeypatch, IdleClosingHandler)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def segments(size, segment_size=SEGMENT_SIZE):
+    return [
+        (start, min(start + segment_size, size) - 1)
+        for start in range(0, size, segment_size)
+    ]
+
+
+def test_range_splitting(server, tmp_path):
+    path = str(tmp_path / "video.mp4")
+    download = SegmentedDownload(
+        server.base + "/stream/ok", path, connections=3, segment_size=SEGMENT_SIZE
+    )
+    done = []
+    download.run(lambda: done.append(download.done))
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    # the probe, then every segment once
+    assert server.ranges[0] == (0, 0)
+    assert sorted(server.ranges[1:]) == segments(len(DATA))
+    assert server.ranges[-1][1] <= len(DATA) - 1
+    assert done[-1] == len(DATA)
+    assert not os.path.exists(path + ".part")
+    assert not os.path.exists(path + ".part.done")
+
+
+def test_resume_from_part(server, tmp_path):
+    path = str(tmp_path / "video.mp4")
+    finished = [0, 2, 5]
+    # the finished segments of an interrupted run, zeros elsewhere
+    part = bytearray(len(DATA))
+    for start, end in (segments(len(DATA))[i] for i in finished):
+        part[start : end + 1] = DATA[start : end + 1]
+    with open(path + ".part", "wb") as f:
+        f.write(part)
+    with open(path + ".part.done", "w") as f:
+        # a torn last line is ignored
+        f.write("".join(f"{i}\n" for i in finished) + "1")
+    download = SegmentedDownload(
+        server.base + "/stream/ok", path, segment_size=SEGMENT_SIZE
+    )
+    download.run()
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    missing = [r for i, r in enumerate(segments(len(DATA))) if i not in finished]
+    assert sorted(server.ranges[1:]) == missing
+
+
+def test_resume_without_part(server, tmp_path):
+    path = str(tmp_path / "video.mp4")
+    # the log of segments whose data is gone
+    with open(path + ".part.done", "w") as f:
+        f.write("0\n1\n")
+    download = SegmentedDownload(
+        server.base + "/stream/ok", path, segment_size=SEGMENT_SIZE
+    )
+    download.run()
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert sorted(server.ranges[1:]) == segments(len(DATA))
+
+
+def test_backend_download(server, tmp_path):
+    backend = NativeBackend(str(tmp_path))
+    ok, size = backend.download(BVID)
+    assert (ok, size) == (True, len(DATA))
+    with open(tmp_path / f"{BVID}.mp4", "rb") as f:
+        assert f.read() == DATA
+
+
+def test_refused_with_200_is_retried(server):
+    server.refusals = [-412, -509]
+    url = api.api_url(f"/x/web-interface/view?bvid={BVID}")
+    assert api.fetch_json(url)["title"] == BVID
+    assert server.refusals == []
+
+
+def test_refused_until_out_of_retries(server, monkeypatch):
+    server.refusals = [-412] * 3
+    monkeypatch.setattr(api.api, "retries", 1)
+    with pytest.raises(api.ApiError) as e:
+        api.fetch_json(api.api_url(f"/x/web-interface/view?bvid={BVID}"))
+    assert e.value.status == -412
+    assert classify("ApiError", str(e.value)) == THROTTLED
+    assert len(server.refusals) == 1
+
+
+def test_idle_connections_closed_by_server(closing_server):
+    client = api.ApiClient(backoff=1)
+    url = api.api_url(f"/x/web-interface/view?bvid={BVID}")
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: client.get(url), range(8)))
+    assert client.pool
+    time.sleep(0.5)
+    # every pooled connection is gone, replaced without a retry or a wait
+    start = time.monotonic()
+    for _ in range(3):
+        assert json.loads(client.get(url))["data"]["title"] == BVID
+    assert time.monotonic() - start < 1
+    assert client.stats()["retries"] == 0
+    assert client.stats()["failures"] == 0
+
+
+def test_old_idle_connections_dropped(server):
+    client = api.ApiClient(max_idle_age=0.1)
+    url = api.api_url(f"/x/web-interface/view?bvid={BVID}")
+    client.get(url)
+    [idle] = client.pool.values()
+    [(conn, _)] = idle
+    time.sleep(0.2)
+    client.get(url)
+    # the old connection was closed, the new one is kept
+    assert conn.sock is None
+    assert [c for c, _ in idle] != [conn]
+
+
+@pytest.mark.parametrize(
+    "fault, failure, text, kind",
+    [
+        ("missing", "ApiError", "HTTP 404", UNAVAILABLE),
+        ("short", "OSError", "bad range response", ERROR),
+        ("drop", "IncompleteRead", "IncompleteRead", NETWORK),
+    ],
+)
+def test_failure_code(server, tmp_path, monkeypatch, fault, failure, text, kind):
+    server.stream = f"/stream/{fault}"
+    monkeypatch.setattr(api.api, "retries", 0)
+    backend = NativeBackend(str(tmp_path))
+    worker = Worker(None, backend)
+    assert worker.download(BVID) == (False, None)
+    assert backend.failure == failure
+    assert text in backend.message
+    assert classify(backend.failure, backend.message) == kind
+    # the finished segments are kept for the next run
+    if fault != "missing":
+        assert os.path.exists(tmp_path / f"{BVID}.mp4.part.done")
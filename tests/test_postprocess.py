@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from bilifav.backend import Stopped
+from bilifav.postprocess import PostProcessor, ffmpeg_command
+
+# joins its inputs into its output, after FAKE_FFMPEG_DELAY seconds, and
+# logs when it ran into FAKE_FFMPEG_LOG
+FFMPEG = """\
+import os, sys, time
+start = time.time()
+time.sleep(float(os.environ["FAKE_FFMPEG_DELAY"]))
+args = sys.argv[1:]
+inputs = [args[i + 1] for i, arg in enumerate(args) if arg == "-i"]
+if any("fail" in path for path in inputs):
+    sys.exit(1)
+with open(args[-1], "wb") as out:
+    for path in inputs:
+        with open(path, "rb") as f:
+            out.write(f.read())
+with open(os.environ["FAKE_FFMPEG_LOG"], "a") as log:
+    log.write(f"{start} {time.time()}\\n")
+"""
+
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    """put a fake ffmpeg first in PATH, return the file it logs its runs to"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffmpeg.py").write_text(FFMPEG)
+    path = bin_dir / "ffmpeg"
+    path.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{bin_dir}/ffmpeg.py" "$@"\n')
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_FFMPEG_DELAY", "0.2")
+    log = tmp_path / "ffmpeg.log"
+    monkeypatch.setenv("FAKE_FFMPEG_LOG", str(log))
+    return log
+
+
+def streams(tmp_path, name):
+    """the downloaded video and audio streams of a video, and its target"""
+    inputs = []
+    for kind in ("video", "audio"):
+        path = tmp_path / f"{name}.{kind}.m4s"
+        path.write_bytes(kind.encode())
+        inputs.append(str(path))
+    return inputs, str(tmp_path / f"{name}.mp4")
+
+
+def most_at_once(log):
+    runs = [tuple(map(float, line.split())) for line in log.read_text().splitlines()]
+    return max(sum(start <= t < end for start, end in runs) for t, _ in runs)
+
+
+def post_threads(before=()):
+    """the threads of post-processing pools, but the ones in `before`"""
+    return [
+        t
+        for t in threading.enumerate()
+        if t.name.startswith("post") and t not in before
+    ]
+
+
+def test_pool_size_and_close(tmp_path, ffmpeg):
+    before = post_threads()
+    post = PostProcessor(jobs=2)
+    futures = []
+    for i in range(5):
+        inputs, target = streams(tmp_path, f"v{i}")
+        futures.append(post.submit(post.task(inputs, target)))
+    assert len(post_threads(before)) <= 2
+    # waits for every submitted task
+    post.close()
+    assert all(f.done() for f in futures)
+    assert [f.result() for f in futures] == [len(b"videoaudio")] * 5
+    assert most_at_once(ffmpeg) == 2
+    assert post_threads(before) == []
+    # the streams are replaced by the video
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        ["bin", "ffmpeg.log"] + [f"v{i}.mp4" for i in range(5)]
+    )
+    # a new pool for the next sync
+    inputs, target = streams(tmp_path, "next")
+    assert post.submit(post.task(inputs, target)).result() == len(b"videoaudio")
+    post.close()
+
+
+def test_failed_and_stopped_tasks(tmp_path, ffmpeg):
+    post = PostProcessor(jobs=1)
+    inputs, target = streams(tmp_path, "fail")
+    failed = post.submit(post.task(inputs, target))
+    running = post.task(*streams(tmp_path, "running"))
+    queued = post.task(*streams(tmp_path, "queued"))
+    futures = [post.submit(running), post.submit(queued)]
+    with pytest.raises(subprocess.CalledProcessError):
+        failed.result()
+    # the streams are kept for the next try
+    assert all(os.path.exists(path) for path in inputs)
+    post.stop([running, queued])
+    for future in futures:
+        with pytest.raises(Stopped):
+            future.result()
+    post.close()
+    assert post.pending == set() and post.processes == {}
+
+
+def test_ffmpeg_command():
+    post = PostProcessor(jobs=1, transcode="h264", embed=True)
+    task = post.task(["v.m4s", "a.m4s"], "out.mp4", title="t", cover="c.jpg")
+    assert " ".join(ffmpeg_command(task, "out.tmp.mp4")) == (
+        "ffmpeg -y -loglevel error -i v.m4s -i a.m4s -i c.jpg "
+        "-map 0 -map 1 -map 2 -disposition:v:1 attached_pic -c copy "
+        "-c:v:0 libx264 -preset medium -crf 23 -metadata title=t out.tmp.mp4"
+    )
+    # without embed, a single stream needs no ffmpeg
+    post.configure(jobs=1)
+    assert not post.needed(post.task(["v.mp4"], "v.mp4", title="t", cover="c"))
+    with pytest.raises(ValueError):
+        post.configure(transcode="vp9")
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from bilifav import progress as progress_module
+from bilifav.progress import (
+    RATE_SMOOTHING,
+    Progress,
+    ProgressStats,
+    combine,
+    describe,
+    format_eta,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(progress_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_aggregated_over_running_jobs(clock):
+    progress = Progress()
+    progress.update("a", 50, 100, 50)
+    progress.update("b", 0, None, 0)
+    progress.finish("c", size=200)
+    stats = progress.snapshot(4)
+    # one video of four done, two halfway and not started
+    assert (stats.finished, stats.total, stats.bytes) == (1, 4, 250)
+    assert stats.percent == int((1 + 0.5) / 4 * 100)
+    # no rate measured yet
+    assert (stats.rate, stats.eta) == (0.0, None)
+
+
+def test_rate_and_eta(clock):
+    progress = Progress()
+    progress.update("a", 0, 1000, 0)
+    progress.snapshot(2)
+    clock[0] += 1
+    progress.update("a", 500, 1000, 50)
+    stats = progress.snapshot(2)
+    assert stats.rate == pytest.approx(RATE_SMOOTHING * 500)
+    # the waiting video is assumed to be of the average size
+    assert stats.eta == pytest.approx((500 + 1000) / stats.rate)
+
+
+def test_finished_jobs(clock):
+    progress = Progress()
+    progress.update("a", 100, 100, 100)
+    progress.update("b", 40, 100, 40)
+    # the size of the last update, the bytes of a failure are discarded
+    progress.finish("a")
+    progress.finish("b", ok=False)
+    stats = progress.snapshot(2)
+    assert (stats.finished, stats.bytes, stats.percent) == (2, 100, 100)
+    progress.update("c", 10, 100, 10)
+    progress.remove("c")
+    assert progress.running() == {}
+    # more videos than announced
+    assert progress.snapshot(1).total == 2
+
+
+def test_running_is_a_copy():
+    progress = Progress()
+    progress.update("a", 1, 2, 50)
+    running = progress.running()
+    progress.update("b", 1, 2, 50)
+    assert running == {"a": (1, 2, 50)}
+
+
+def test_combine():
+    stats = combine(
+        [
+            ProgressStats(50, 1, 2, 1000, 100.0, 10.0),
+            ProgressStats(0, 0, 2, 0, 300.0, None),
+        ]
+    )
+    assert (stats.percent, stats.finished, stats.total) == (25, 1, 4)
+    assert (stats.bytes, stats.rate) == (1000, 400.0)
+    # the remaining bytes of the first sync at the combined rate
+    assert stats.eta == pytest.approx(1000 / 400)
+    assert describe(stats) == "1/4 videos, 400.0 B/s, ETA 00:02"
+    assert format_eta(3725) == "1:02:05"
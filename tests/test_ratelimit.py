@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+import pytest
+
+from bilifav import ratelimit
+from bilifav.ratelimit import (
+    MIN_BURST,
+    BandwidthLimiter,
+    TokenBucket,
+    parse_rate,
+    parse_schedule,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """the time seen by the buckets, moved on by the test and by sleeps"""
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(ratelimit.time, "sleep", sleep)
+    return SimpleNamespace(now=now, sleeps=sleeps)
+
+
+def at(monkeypatch, hour, minute):
+    monkeypatch.setattr(
+        ratelimit.time,
+        "localtime",
+        lambda: SimpleNamespace(tm_hour=hour, tm_min=minute),
+    )
+
+
+def test_bucket_refill(clock):
+    bucket = TokenBucket(1000)
+    bucket.reserve(5000)
+    assert bucket.wait_time() == pytest.approx(5)
+    clock.now[0] += 2
+    assert bucket.wait_time() == pytest.approx(3)
+    # tokens saved while idle are capped to a burst
+    clock.now[0] += 3600
+    bucket.reserve(MIN_BURST)
+    assert bucket.wait_time() == 0
+    bucket.reserve(1000)
+    assert bucket.wait_time() == pytest.approx(1)
+
+
+def test_bucket_without_limit(clock):
+    bucket = TokenBucket()
+    bucket.reserve(10**9)
+    assert bucket.wait_time() == 0
+    # limited from now on, the bytes before are not owed
+    bucket.set_rate(1000)
+    assert bucket.wait_time() == 0
+
+
+def test_consume_blocks_until_paid(clock):
+    limiter = BandwidthLimiter(rate=1000)
+    job = limiter.job()
+    job.consume(2000)
+    assert sum(clock.sleeps) == pytest.approx(2)
+    # woken up often, so that a new rate applies at once
+    assert max(clock.sleeps) <= ratelimit.MAX_WAIT
+    job.close()
+    assert limiter.jobs == []
+
+
+def test_job_rate(clock):
+    limiter = BandwidthLimiter(job_rate=1000)
+    job = limiter.job()
+    job.reserve(3000)
+    assert job.wait_time() == pytest.approx(3)
+    # applies to the running jobs too
+    limiter.set_job_rate(None)
+    assert job.wait_time() == 0
+
+
+def test_consume_stops(clock):
+    job = BandwidthLimiter(rate=1).job()
+    job.consume(10**6, stopped=lambda: True)
+    assert clock.sleeps == []
+
+
+def test_schedule_wraps_past_midnight(monkeypatch):
+    limiter = BandwidthLimiter(
+        rate=parse_rate("2M"),
+        schedule=parse_schedule("22:00-07:30=500K, 12:00-13:00=off"),
+    )
+    for hour, minute, rate in [
+        (23, 0, 500 * 1024),
+        (0, 0, 500 * 1024),
+        (7, 29, 500 * 1024),
+        (7, 30, 2 * 1024**2),
+        (21, 59, 2 * 1024**2),
+        (12, 30, None),
+    ]:
+        at(monkeypatch, hour, minute)
+        assert limiter.current_rate() == rate
+
+
+def test_parse():
+    assert parse_rate("1.5M") == 3 * 512 * 1024
+    assert parse_rate("500KiB/s") == 500 * 1024
+    assert parse_rate("off") is None
+    assert parse_schedule("09:00-18:00=1M,18:00-09:00=off") == [
+        (540, 1080, 1024**2),
+        (1080, 540, None),
+    ]
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["09:00-18:00", "9-18=1M", "09:00-18:00=fast", "09:00 18:00=1M", "=1M"],
+)
+def test_bad_schedule(text):
+    with pytest.raises(ValueError):
+        parse_schedule(text)
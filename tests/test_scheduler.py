@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from bilifav.failures import (
+    NETWORK,
+    RETRIES,
+    RETRY_DELAYS,
+    THROTTLED,
+    UNAVAILABLE,
+    parse_retry_delays,
+    retry_delay,
+)
+from bilifav.ordering import get_order, order_names
+from bilifav.scheduler import DownloadQueue, FairQueue, batch_length
+from bilifav.worker import Worker
+
+
+def drain(queue):
+    """take every queued job, finishing each one"""
+    jobs = []
+    while True:
+        job = queue.get()
+        if job is None:
+            return jobs
+        jobs.append(job)
+        queue.task_done()
+
+
+def test_jobs_in_order_of_keys():
+    queue = DownloadQueue()
+    queue.put("c", (2,))
+    queue.put("a", (1,))
+    queue.put("b", (1,))
+    queue.close()
+    # the lowest key first, in the order they were put for equal keys
+    assert drain(queue) == ["a", "b", "c"]
+    assert (queue.submitted, queue.finished, queue.failed) == (3, 3, 0)
+
+
+def test_get_waits_until_done():
+    queue = DownloadQueue()
+    queue.put("a")
+    queue.close()
+    assert queue.get() == "a"
+    got = []
+    thread = threading.Thread(target=lambda: got.append(queue.get()))
+    thread.start()
+    # a running job may still be retried
+    thread.join(0.1)
+    assert thread.is_alive()
+    queue.task_done(False)
+    thread.join(1)
+    assert got == [None]
+    assert queue.failed == 1
+    queue.join()
+
+
+def test_batches_are_shared():
+    assert batch_length(20, 8) == 8
+    # the last jobs are spread over the workers
+    assert batch_length(6, 8, share=3) == 2
+    assert batch_length(2, 8, share=4) == 1
+    queue = DownloadQueue()
+    for job in "abcde":
+        queue.put(job)
+    assert queue.get_batch(4, share=2) == ["a", "b"]
+    assert queue.get_batch(4) == ["c", "d", "e"]
+
+
+def test_cancel_drops_pending_jobs():
+    queue = DownloadQueue()
+    for job in "abc":
+        queue.put(job)
+    assert queue.get() == "a"
+    queue.cancel()
+    # nothing more is put or handed out, the running job is waited for
+    queue.put("d")
+    assert not queue.done()
+    queue.task_done(False)
+    assert queue.done()
+    assert queue.get() is None
+    assert queue.submitted == 1
+
+
+def test_lanes_take_turns():
+    queue = FairQueue()
+    large, small = queue.lane(), queue.lane()
+    for i in range(5):
+        large.put(f"large{i}")
+    small.put("small0")
+    small.put("small1")
+    taken = []
+    for _ in range(7):
+        lane, job = queue.get(timeout=1)
+        taken.append(job)
+        lane.task_done()
+    # the small favorite is not starved behind the large one
+    assert taken[:4] == ["large0", "small0", "large1", "small1"]
+    assert taken[4:] == ["large2", "large3", "large4"]
+
+
+def test_lane_batches_stay_in_lane():
+    queue = FairQueue()
+    a, b = queue.lane(), queue.lane()
+    for job in ("a0", "a1", "a2"):
+        a.put(job)
+    b.put("b0")
+    assert queue.get_batch(4, timeout=1) == (a, ["a0", "a1", "a2"])
+    assert queue.get_batch(4, timeout=1) == (b, ["b0"])
+
+
+def test_requeue_jumps_the_line():
+    queue = FairQueue()
+    lane = queue.lane()
+    for job in "abc":
+        lane.put(job)
+    assert queue.get(timeout=1) == (lane, "a")
+    assert queue.get(timeout=1) == (lane, "b")
+    queue.requeue(lane, "b")
+    # first in line, and not counted twice
+    assert queue.get(timeout=1) == (lane, "b")
+    assert lane.submitted == 3
+
+
+def test_requeue_into_drained_lane():
+    queue = FairQueue()
+    lane = queue.lane()
+    lane.put("a")
+    lane.close()
+    assert queue.get(timeout=1) == (lane, "a")
+    queue.requeue(lane, "a")
+    assert queue.get(timeout=1) == (lane, "a")
+    lane.task_done()
+    queue.close()
+    # every lane is done
+    assert queue.get(timeout=1) is None
+
+
+def test_get_times_out():
+    queue = FairQueue()
+    queue.lane()
+    assert queue.get(timeout=0.05) is None
+
+
+# as listed: the newest favorites first, `resumed` comes from the journal
+MEDIAS = [
+    {"bvid": "long", "duration": 600, "page": 1, "fav_time": 300},
+    {"bvid": "parts", "duration": 600, "page": 4, "fav_time": 200},
+    {"bvid": "short", "duration": 60, "page": 1, "fav_time": 100},
+    {"bvid": "resumed"},
+]
+
+
+@pytest.mark.parametrize(
+    "order, expected",
+    [
+        ("listing", ["long", "parts", "short", "resumed"]),
+        # a part lasts the duration of the video over its parts
+        ("shortest", ["resumed", "short", "parts", "long"]),
+        ("largest", ["resumed", "long", "parts", "short"]),
+        ("newest", ["resumed", "long", "parts", "short"]),
+    ],
+)
+def test_orders(order, expected):
+    key = get_order(order)
+    queue = DownloadQueue()
+    for media in MEDIAS:
+        queue.put(media["bvid"], key(media))
+    queue.close()
+    assert drain(queue) == expected
+
+
+def test_unknown_order():
+    assert "listing" in order_names()
+    with pytest.raises(ValueError):
+        get_order("random")
+
+
+def test_retry_delays_double():
+    assert [retry_delay(THROTTLED, n) for n in range(1, RETRIES + 2)] == [
+        30,
+        60,
+        120,
+        None,
+    ]
+    assert retry_delay(UNAVAILABLE, 1) is None
+    assert retry_delay(NETWORK, 2, {NETWORK: 0.5}) == 1.0
+    # a kind left out is not retried
+    assert retry_delay(THROTTLED, 1, {NETWORK: 0.5}) is None
+
+
+def test_parse_retry_delays():
+    assert parse_retry_delays("0") == dict.fromkeys(RETRY_DELAYS, 0.0)
+    delays = parse_retry_delays("throttled=60, network=0.5")
+    assert delays == dict(RETRY_DELAYS, throttled=60.0, network=0.5)
+    for text in ("unavailable=1", "network=soon"):
+        with pytest.raises(ValueError):
+            parse_retry_delays(text)
+
+
+def test_retry_waits_then_jumps_the_line():
+    queue = DownloadQueue(retry_delays={NETWORK: 0.1})
+    queue.put("a")
+    queue.put("b")
+    assert queue.get() == "a"
+    start = time.monotonic()
+    assert queue.retry("a", NETWORK) == pytest.approx(0.1)
+    # not due yet
+    assert queue.get() == "b"
+    queue.task_done()
+    assert queue.get() == "a"
+    assert time.monotonic() - start >= 0.09
+    assert queue.attempts["a"] == 1
+
+
+def test_retry_before_queued_jobs():
+    queue = DownloadQueue(retry_delays={NETWORK: 0})
+    queue.put("a")
+    queue.put("b")
+    assert queue.get() == "a"
+    queue.retry("a", NETWORK)
+    assert queue.get() == "a"
+
+
+def test_no_retry_once_cancelled():
+    queue = DownloadQueue(retry_delays={NETWORK: 10})
+    queue.put("a")
+    queue.put("b")
+    assert queue.get() == "a"
+    queue.retry("a", NETWORK)
+    queue.cancel()
+    # the delayed retry is dropped with the queued jobs, nothing runs
+    assert queue.submitted == 0
+    assert queue.done()
+    assert queue.retry("a", NETWORK) is None
+
+
+def test_lanes_keep_retry_delays():
+    queue = FairQueue({NETWORK: 0})
+    lane = queue.lane()
+    lane.put("a")
+    assert queue.get(timeout=1) == (lane, "a")
+    assert lane.retry("a", NETWORK) == 0
+    assert queue.get(timeout=1) == (lane, "a")
+
+
+def test_dead_letter_after_retries():
+    queue = DownloadQueue(retry_delays=dict.fromkeys(RETRY_DELAYS, 0))
+    retried, dead = [], []
+    worker = Worker(
+        queue,
+        None,
+        on_retry=lambda bvid, kind, delay: retried.append((bvid, kind)),
+        on_error=lambda bvid, failure: dead.append((bvid, failure)),
+    )
+    queue.put("a")
+    queue.close()
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        message = "Downloading a error:\nrequest error: HTTP 412"
+        worker.finish(
+            queue, job, False, None, "annie_exit", message, time.perf_counter()
+        )
+    assert retried == [("a", THROTTLED)] * RETRIES
+    [(bvid, failure)] = dead
+    assert (bvid, failure.kind, failure.reason) == ("a", THROTTLED, "annie_exit")
+    assert failure.attempts == RETRIES + 1
+    assert (queue.finished, queue.failed) == (1, 1)
+
+
+def test_permanent_failure_not_retried():
+    queue = DownloadQueue(retry_delays=dict.fromkeys(RETRY_DELAYS, 0))
+    dead = []
+    worker = Worker(queue, None, on_error=lambda bvid, failure: dead.append(failure))
+    queue.put("a")
+    assert queue.get() == "a"
+    worker.finish(queue, "a", False, None, "ApiError", "HTTP 404", time.perf_counter())
+    assert [(f.kind, f.attempts) for f in dead] == [(UNAVAILABLE, 1)]
+
+
+def taker(get):
+    """take a job in a thread, return the thread and the list it goes into"""
+    got = []
+    thread = threading.Thread(target=lambda: got.append(get()))
+    thread.start()
+    return thread, got
+
+
+def test_paused_queue_hands_out_nothing():
+    queue = DownloadQueue()
+    queue.put("a")
+    queue.pause()
+    thread, got = taker(queue.get)
+    thread.join(0.1)
+    assert thread.is_alive()
+    queue.resume()
+    thread.join(1)
+    assert got == ["a"]
+
+
+def test_paused_fair_queue():
+    queue = FairQueue()
+    lane = queue.lane()
+    lane.put("a")
+    queue.pause()
+    assert queue.get(timeout=0.05) is None
+    queue.resume()
+    assert queue.get(timeout=1) == (lane, "a")
+
+
+def test_paused_lane_is_skipped():
+    queue = FairQueue()
+    paused, running = queue.lane(), queue.lane()
+    paused.put("a")
+    running.put("b")
+    paused.pause()
+    assert queue.get(timeout=1) == (running, "b")
+    assert queue.get(timeout=0.05) is None
+    thread, got = taker(lambda: queue.get(timeout=1))
+    paused.resume()
+    thread.join(1)
+    assert got == [(paused, "a")]
+
+
+def test_cancel_wakes_waiting_workers():
+    queue = DownloadQueue()
+    queue.pause()
+    queue.put("a")
+    thread, got = taker(queue.get)
+    queue.cancel()
+    thread.join(1)
+    # the paused job is dropped, not handed out
+    assert got == [None]
+
+
+def test_worker_skips_cancelled_lane():
+    queue = DownloadQueue(retry_delays=dict.fromkeys(RETRY_DELAYS, 0))
+
+    class Backend:
+        def reset(self, paused=False):
+            pass
+
+    worker = Worker(queue, Backend())
+    queue.put("a")
+    assert queue.get() == "a"
+    queue.cancel()
+    # a stop while the video was taken, before it began
+    assert not worker.begin(queue)
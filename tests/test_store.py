@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from concurrent.futures import Future
+
+from bilifav import store as store_module
+from bilifav.backend import Backend
+from bilifav.store import ContentStore, StoredBackend, store_key
+
+BVID = "BV1xx411c7mD"
+DATA = b"video"
+
+
+class FakeBackend(Backend):
+    """writes a video file, once `gate` is set"""
+
+    name = "fake"
+
+    def __init__(self, output_path, downloads, gate=None, post=None):
+        super(FakeBackend, self).__init__(output_path)
+        self.downloads = downloads
+        self.gate = gate
+        # future of the post-processing, if any
+        self.post = post
+
+    def download(self, bvid, on_progress=None):
+        self.downloads.append(bvid)
+        if self.gate is not None:
+            self.gate.wait(5)
+        with open(os.path.join(self.output_path, f"{bvid}.mp4"), "wb") as f:
+            f.write(DATA)
+        if self.post is not None:
+            return True, self.post
+        return True, len(DATA)
+
+
+def backend(store, output_path, downloads, **options):
+    return StoredBackend(FakeBackend(str(output_path), downloads, **options), store)
+
+
+def test_stored_video_is_only_linked(tmp_path):
+    store = ContentStore(str(tmp_path / "store"))
+    downloads = []
+    assert backend(store, tmp_path / "a", downloads).download(BVID) == (True, len(DATA))
+    # another favorite, in another output directory
+    assert backend(store, tmp_path / "b", downloads).download(BVID) == (True, len(DATA))
+    assert downloads == [BVID]
+    a, b = (tmp_path / name / f"{BVID}.mp4" for name in "ab")
+    assert os.path.samefile(a, b)
+    assert os.path.samefile(a, os.path.join(store.object_path(store_key(BVID)), a.name))
+    assert os.listdir(store.incoming) == []
+
+
+def test_same_video_downloaded_once(tmp_path):
+    store = ContentStore(str(tmp_path / "store"))
+    downloads = []
+    gate = threading.Event()
+    first = backend(store, tmp_path / "a", downloads, gate=gate)
+    second = backend(store, tmp_path / "b", downloads)
+    results = {}
+    threads = [
+        threading.Thread(target=lambda b=b, n=n: results.update({n: b.download(BVID)}))
+        for n, b in (("a", first), ("b", second))
+    ]
+    threads[0].start()
+    while not downloads:
+        threads[0].join(0.01)
+    # the second waits for the claim of the first instead of downloading
+    threads[1].start()
+    threads[1].join(0.1)
+    assert threads[1].is_alive()
+    gate.set()
+    for t in threads:
+        t.join(5)
+    assert results == {"a": (True, len(DATA)), "b": (True, len(DATA))}
+    assert downloads == [BVID]
+    # released for the next download of the video
+    assert not store.claim(store_key(BVID)).locked()
+
+
+def test_claim_held_until_post_processed(tmp_path):
+    store = ContentStore(str(tmp_path / "store"))
+    post = Future()
+    ok, linked = backend(store, tmp_path / "a", [], post=post).download(BVID)
+    assert ok and not linked.done()
+    claim = store.claim(store_key(BVID))
+    assert claim.locked()
+    post.set_result(len(DATA))
+    assert linked.result() == len(DATA)
+    assert not claim.locked()
+    assert os.path.exists(tmp_path / "a" / f"{BVID}.mp4")
+
+
+def test_symlink_when_hardlink_fails(tmp_path, monkeypatch):
+    store = ContentStore(str(tmp_path / "store"))
+    backend(store, tmp_path / "a", []).download(BVID)
+
+    def link(source, target):
+        raise OSError("Invalid cross-device link")
+
+    monkeypatch.setattr(store_module.os, "link", link)
+    assert store.link(store_key(BVID), str(tmp_path / "b")) == len(DATA)
+    target = tmp_path / "b" / f"{BVID}.mp4"
+    assert target.is_symlink()
+    assert target.read_bytes() == DATA
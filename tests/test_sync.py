@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from urllib.parse import parse_qs, urlsplit
+
+from bilifav.annie import video_url
+from bilifav.api import PAGE_SIZE
+from bilifav.backend import part_job, split_job
+from bilifav.index import DownloadIndex
+from bilifav.sync import Sync, expand_parts
+
+# put on the path by conftest.py
+from fake_api import FakeApi
+
+# more than two listing pages
+COUNT = PAGE_SIZE * 2 + 5
+
+
+class Favorites(FakeApi):
+    """favorites whose videos can be added in front, like newly favorited ones"""
+
+    def __init__(self, count):
+        super(Favorites, self).__init__(count)
+        # newest first, like the real listing
+        self.medias = [self.media(i, count - i) for i in range(count)]
+        # listing pages requested
+        self.pages = []
+
+    @staticmethod
+    def media(i, fav_time):
+        return {"id": i, "bvid": f"BV1x{i:07d}", "page": 1, "fav_time": fav_time}
+
+    def split(self, i, pages):
+        """make the video `i` one of `pages` parts"""
+        self.medias[i] = dict(self.medias[i], page=pages, title=f"video {i}")
+        return self.medias[i]["bvid"]
+
+    def prepend(self, n):
+        """favorite `n` new videos, return their bvids"""
+        newest = self.medias[0]["fav_time"]
+        first = len(self.medias)
+        new = [self.media(first + i, newest + n - i) for i in range(n)]
+        self.medias[:0] = new
+        self.count = len(self.medias)
+        return [media["bvid"] for media in new]
+
+    def handle(self, path):
+        self.pages.append(int(parse_qs(urlsplit(path).query)["pn"][0]))
+        return super(Favorites, self).handle(path)
+
+    def listing(self, media_id, page, size):
+        listing = super(Favorites, self).listing(media_id, page, size)
+        medias = self.medias[(page - 1) * size : page * size]
+        listing["data"]["medias"] = medias or None
+        return listing
+
+
+def sync(output, **options):
+    """run a sync of favorite 1, return it with the videos it downloaded"""
+    completed = []
+    task = Sync("1", output, jobs=2, on_complete=completed.append, **options)
+    assert task.run()
+    return task, completed
+
+
+def test_second_run_queues_nothing(tmp_path, fake_api, fake_annie):
+    server = fake_api(COUNT, Favorites)
+    output = str(tmp_path / "videos")
+    task, completed = sync(output)
+    assert len(completed) == COUNT
+    server.pages.clear()
+    task, completed = sync(output)
+    assert (task.queue.submitted, completed) == (0, [])
+    # the first page reaches the videos seen before, nothing more is listed
+    assert server.pages == [1]
+
+
+def test_only_new_favorites_queued(tmp_path, fake_api, fake_annie):
+    server = fake_api(COUNT, Favorites)
+    output = str(tmp_path / "videos")
+    sync(output)
+    new = server.prepend(3)
+    server.pages.clear()
+    task, completed = sync(output)
+    assert sorted(completed) == sorted(new)
+    assert task.queue.submitted == 3
+    assert server.pages == [1]
+
+
+def test_parts_expanded():
+    media = {"bvid": "BV1x", "title": "video", "page": 3, "duration": 90}
+    parts = expand_parts(media)
+    assert [p["bvid"] for p in parts] == [part_job("BV1x", p) for p in (1, 2, 3)]
+    assert [p["title"] for p in parts] == ["video P1", "video P2", "video P3"]
+    # the rest of the media is kept
+    assert all(p["duration"] == 90 for p in parts)
+    assert expand_parts({"bvid": "BV1y", "page": 1}) == [{"bvid": "BV1y", "page": 1}]
+    assert split_job(parts[1]["bvid"]) == ("BV1x", 2)
+    assert split_job("BV1y") == ("BV1y", None)
+    assert video_url(parts[1]["bvid"]).endswith("/BV1x?p=2")
+
+
+def test_parts_are_jobs_of_their_own(tmp_path, fake_api, fake_annie):
+    server = fake_api(3, Favorites)
+    bvid = server.split(1, 2)
+    task, completed = sync(str(tmp_path / "videos"))
+    parts = [part_job(bvid, 1), part_job(bvid, 2)]
+    assert task.queue.submitted == 4
+    assert sorted(completed) == sorted(
+        parts + [m["bvid"] for m in server.medias if m["bvid"] != bvid]
+    )
+    # each part is done on its own in the index
+    index = DownloadIndex(str(tmp_path / "videos"))
+    assert set(parts) <= index.completed("1")
+    assert bvid not in index.completed("1")
+    index.close()